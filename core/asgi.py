@@ -8,9 +8,80 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 """
 
 import os
+import logging
 
+from asgiref.sync import sync_to_async
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+logger = logging.getLogger(__name__)
+
+
+def _close_db_pools():
+    from django.db import connections
+    # Пул общий для процесса (не привязан к потоку), поэтому берем все алиасы
+    for connection in connections.all():
+        if hasattr(connection, 'close_pool'):  # Django 5.1+ (DB_POOL)
+            connection.close_pool()
+
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan: Django сам его не обрабатывает, поэтому закрываем
+    общие ресурсы (HTTP-клиенты LLM, пулы инференса, пул БД) здесь.
+    """
+    from vision.llm_client import LLMClientPool
+    from vision.executors import InferenceExecutors
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await LLMClientPool.aclose_all()
+                InferenceExecutors.shutdown(wait=False)
+                await sync_to_async(_close_db_pools)()
+            except Exception as e:
+                logger.error(f"Lifespan shutdown error: {e}")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def _websocket_routes():
+    # Импорт после get_asgi_application(): модулям vision нужен настроенный Django
+    from vision.streaming_stt import stt_socket
+    from vision.glasses_session import glasses_session_socket
+    return {
+        '/ws/stt/': stt_socket,
+        '/ws/session/': glasses_session_socket,
+    }
+
+
+_routes = None
+
+
+async def websocket(scope, receive, send):
+    """WebSocket-маршруты (Django их не обслуживает)"""
+    global _routes
+    if _routes is None:
+        _routes = _websocket_routes()
+    handler = _routes.get(scope['path'].rstrip('/') + '/')
+    if handler is None:
+        await receive()  # websocket.connect
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    await handler(scope, receive, send)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+    if scope['type'] == 'websocket':
+        await websocket(scope, receive, send)
+        return
+    await django_application(scope, receive, send)
@@ -62,7 +62,7 @@ AUTH_USER_MODEL = 'vision.User'
 # REST Framework Settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'vision.identity_cache.CachedTokenAuthentication',  # TokenAuthentication + кэш процесса
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -116,13 +116,30 @@ WSGI_APPLICATION = 'core.wsgi.application'
 
 import dj_database_url
 
+# Переиспользование соединений:
+# - DB_POOL=True (Postgres, Django 5.1+, psycopg[pool]) - пул соединений процесса.
+#   Под ASGI это основной режим: sync_to_async выполняет каждый запрос в своем потоке,
+#   и постоянные соединения (CONN_MAX_AGE > 0) там копятся по потокам.
+# - DB_CONN_MAX_AGE > 0 - постоянные соединения с проверкой живости (WSGI / runserver).
 DATABASES = {
     'default': dj_database_url.config(
         default=os.getenv('DATABASE_URL', f'sqlite:///{BASE_DIR / "db.sqlite3"}'),
-        conn_max_age=0
+        conn_max_age=int(os.getenv('DB_CONN_MAX_AGE', '0')),
+        conn_health_checks=os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
     )
 }
 
+if os.getenv('DB_POOL', 'False') == 'True' and DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    import django
+    if django.VERSION >= (5, 1):
+        # Пул несовместим с постоянными соединениями
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -161,6 +178,10 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / "vision" / "static"]
 
+# Media files (сгенерированное аудио TTS: media/tts)
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 
@@ -1,11 +1,16 @@
 import os
 import uuid
+import asyncio
 import logging
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import torch
 
+# Очистка аудио - общая с основным проектом (модуль без зависимостей от Django).
+# Корень проекта должен быть в PYTHONPATH (см. README_SETUP.txt)
+from vision.tts_system.retention import AudioRetention
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("KaniTTS_Server")
@@ -15,6 +20,13 @@ AUDIO_DIR = "audio_output"
 MODEL_NAME = "nineninesix/kani-tts-450m-0.1-pt"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Ограничение хранения сгенерированных файлов в AUDIO_DIR
+AUDIO_MAX_BYTES = int(float(os.getenv("AUDIO_MAX_MB", "500")) * 1024 * 1024)
+AUDIO_MAX_AGE = float(os.getenv("AUDIO_MAX_AGE", "3600"))      # секунд
+AUDIO_MAX_FILES = int(os.getenv("AUDIO_MAX_FILES", "1000"))
+AUDIO_GRACE = float(os.getenv("AUDIO_GRACE", "120"))          # клиент может еще скачивать файл
+CLEANUP_INTERVAL = float(os.getenv("AUDIO_CLEANUP_INTERVAL", "300"))
+
 # Создаем папку если нет
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
@@ -39,6 +51,27 @@ async def load_model():
         logger.critical(f"❌ Failed to load model: {e}")
         # Не падаем, чтобы сервер работал и отдавал 500 ошибку, если что
 
+retention = AudioRetention(
+    [AUDIO_DIR],
+    max_bytes=AUDIO_MAX_BYTES,
+    max_age=AUDIO_MAX_AGE,
+    max_files=AUDIO_MAX_FILES,
+    grace=AUDIO_GRACE,
+)
+
+async def cleanup_loop():
+    """Фоновая очистка: работает в отдельном потоке, event loop не блокируется"""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        try:
+            await asyncio.to_thread(retention.sweep)
+        except Exception as e:
+            logger.error(f"Audio cleanup failed: {e}")
+
+@app.on_event("startup")
+async def start_cleanup():
+    asyncio.create_task(cleanup_loop())
+
 @app.post("/tts")
 async def generate_speech(request: TTSRequest):
     """
@@ -74,6 +107,11 @@ async def generate_speech(request: TTSRequest):
         logger.error(f"Generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/retention")
+async def retention_stats():
+    """Статистика очистки AUDIO_DIR: удалено файлов, освобождено байт"""
+    return retention.stats()
+
 # Раздача статики (чтобы скачивать файлы)
 app.mount("/audio", StaticFiles(directory=AUDIO_DIR), name="audio")
 
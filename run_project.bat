@@ -38,4 +38,4 @@ echo Server running at http://127.0.0.1:8000
 echo Ctrl+C to stop.
 echo.
 
-python manage.py runserver 0.0.0.0:8000
+uvicorn core.asgi:application --host 0.0.0.0 --port 8000
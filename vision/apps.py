@@ -1,13 +1,54 @@
+import os
+import sys
 from django.apps import AppConfig
 
+# Исполняемые файлы серверов, в которых запускаются фоновые задачи TTS
+SERVER_ENTRY_POINTS = ('uvicorn', 'gunicorn', 'daphne', 'hypercorn')
+
 
 class VisionConfig(AppConfig):
     name = 'vision'
 
     def ready(self):
+        # Счетчик SQL-запросов (QueryCounter) на каждом новом соединении
+        from django.db.backends.signals import connection_created
+        from .unit_of_work import install_query_counter
+        connection_created.connect(install_query_counter, dispatch_uid='vision_query_counter')
+        from .db_stats import ConnectionStats
+        connection_created.connect(ConnectionStats.on_connection_created, dispatch_uid='vision_connection_stats')
+
         # Avoid running in reloader thread to prevent duplicates (simple check)
-        import os
         if os.environ.get('RUN_MAIN') == 'true':
             from .wake_word import WakeWordListener
             # WakeWordListener.start()
             pass
+
+        if self._is_server_process():
+            from .tts_system.config import TTSConfig
+            from .tts_system.manager import start_prerender_job, start_retention_job
+            start_retention_job()
+            if TTSConfig.PRERENDER:
+                start_prerender_job()
+
+    @staticmethod
+    def _is_server_process():
+        """
+        True только для настоящего сервера: uvicorn/gunicorn/daphne/hypercorn или
+        manage.py runserver. Тесты, celery, бот, python -c и management-команды
+        не запускают prerender (сетевые вызовы EdgeTTS) и поток очистки аудио.
+        VISION_BACKGROUND_JOBS=True/False переопределяет проверку (например, mod_wsgi).
+        """
+        forced = os.getenv('VISION_BACKGROUND_JOBS')
+        if forced:
+            return forced == 'True'
+        if not sys.argv:
+            return False
+        entry = os.path.basename(sys.argv[0])
+        if entry == '__main__.py':  # python -m uvicorn ...
+            entry = os.path.basename(os.path.dirname(sys.argv[0]))
+        if entry == 'manage.py':
+            if 'runserver' not in sys.argv:
+                return False
+            # runserver с автоперезагрузкой: работаем только в дочернем процессе
+            return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+        return entry.split('.')[0] in SERVER_ENTRY_POINTS
@@ -0,0 +1,151 @@
+"""
+Прием аудио без контейнера: сырой PCM 16 кГц моно (int16 / float32) или Opus-пакеты.
+
+Загрузка в m4a/ogg проходит через универсальный декодер faster-whisper
+(PyAV: определение контейнера, декодирование AAC/Opus, ресемплинг), даже для
+3-секундной команды. Если клиент объявил сырой PCM, тело оборачивается в numpy
+без копирования (np.frombuffer) и сразу отдается в WhisperModel.transcribe.
+float32 передается как есть; int16 (формат микрофона очков, см. wake_word.py)
+требует одного умножения для нормировки в [-1, 1].
+
+Как объявить формат:
+    multipart: поле audio + audio_format=pcm_s16le|pcm_f32le|opus
+               (+ sample_rate=16000, channels=1)
+    сырое тело: Content-Type: audio/pcm; format=s16le; rate=16000; channels=1
+                Content-Type: audio/opus; rate=16000
+                (остальные параметры запроса - в query string)
+
+Opus: последовательность пакетов, каждый с 2-байтовым префиксом длины
+(big-endian). Нужен пакет opuslib (необязательная зависимость).
+Без объявленного формата аудио обрабатывается как раньше (файл-контейнер).
+"""
+import struct
+
+import numpy as np
+
+WHISPER_SAMPLE_RATE = 16000
+
+PCM_DTYPES = {
+    'pcm_s16le': np.dtype('<i2'),
+    'pcm_f32le': np.dtype('<f4'),
+}
+_FORMAT_ALIASES = {
+    's16le': 'pcm_s16le', 'int16': 'pcm_s16le', 'pcm_s16le': 'pcm_s16le',
+    'f32le': 'pcm_f32le', 'float32': 'pcm_f32le', 'pcm_f32le': 'pcm_f32le',
+    'opus': 'opus',
+}
+_RAW_CONTENT_TYPES = ('audio/pcm', 'audio/opus')
+
+# Максимальная длительность Opus-пакета - 120 мс
+_OPUS_MAX_FRAME = WHISPER_SAMPLE_RATE * 120 // 1000
+
+
+class AudioFormatError(ValueError):
+    """Объявленный формат аудио не поддерживается или тело не соответствует ему"""
+
+
+def normalize_format(value):
+    audio_format = _FORMAT_ALIASES.get((value or '').strip().lower())
+    if audio_format is None:
+        raise AudioFormatError(f"Unsupported audio format: {value}")
+    return audio_format
+
+
+def pcm_to_array(data, audio_format):
+    """Сырой PCM -> float32 numpy для Whisper (float32 - без копирования)"""
+    dtype = PCM_DTYPES[audio_format]
+    usable = len(data) - len(data) % dtype.itemsize  # отбрасываем неполный последний сэмпл
+    samples = np.frombuffer(data, dtype=dtype, count=usable // dtype.itemsize)
+    if dtype.kind == 'f':
+        return samples
+    return samples.astype(np.float32) * (1.0 / 32768.0)
+
+
+def opus_to_array(data):
+    """Пакеты Opus с префиксом длины -> float32 numpy (16 кГц моно)"""
+    try:
+        import opuslib
+    except ImportError:
+        raise AudioFormatError("Opus input requires the opuslib package")
+    except Exception as e:
+        # opuslib без системной libopus падает при импорте обычным Exception
+        raise AudioFormatError(f"Opus decoder unavailable: {e}")
+
+    try:
+        decoder = opuslib.Decoder(WHISPER_SAMPLE_RATE, 1)
+        chunks = []
+        offset = 0
+        while offset + 2 <= len(data):
+            (length,) = struct.unpack_from('>H', data, offset)
+            offset += 2
+            packet = data[offset:offset + length]
+            if len(packet) != length:
+                raise AudioFormatError("Truncated Opus packet")
+            offset += length
+            chunks.append(decoder.decode(packet, _OPUS_MAX_FRAME))
+    except opuslib.OpusError as e:
+        raise AudioFormatError(f"Invalid Opus data: {e}")
+    pcm = b''.join(chunks)
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32) * (1.0 / 32768.0)
+
+
+def decode_declared_audio(data, audio_format, sample_rate=WHISPER_SAMPLE_RATE, channels=1):
+    """Байты в объявленном формате -> float32 numpy 16 кГц моно"""
+    audio_format = normalize_format(audio_format)
+    if int(sample_rate) != WHISPER_SAMPLE_RATE:
+        raise AudioFormatError(f"Raw audio must be {WHISPER_SAMPLE_RATE} Hz, got {sample_rate}")
+    if int(channels) != 1:
+        raise AudioFormatError(f"Raw audio must be mono, got {channels} channels")
+    if audio_format == 'opus':
+        return opus_to_array(data)
+    return pcm_to_array(data, audio_format)
+
+
+def _content_type_params(content_type):
+    parts = [p.strip() for p in content_type.split(';')]
+    params = {}
+    for part in parts[1:]:
+        if '=' in part:
+            key, value = part.split('=', 1)
+            params[key.strip().lower()] = value.strip()
+    return parts[0].lower(), params
+
+
+def is_raw_audio_request(request):
+    return request.content_type in _RAW_CONTENT_TYPES
+
+
+def read_audio_input(request, params):
+    """
+    Аудио запроса: float32 numpy (объявленный PCM/Opus), загруженный файл
+    (контейнер - декодирует faster-whisper) или None.
+    params - поля запроса (request.POST или request.GET для сырого тела).
+    """
+    if is_raw_audio_request(request):
+        media_type, ct_params = _content_type_params(request.META.get('CONTENT_TYPE', ''))
+        audio_format = 'opus' if media_type == 'audio/opus' else ct_params.get('format', 's16le')
+        body = request.body
+        if not body:
+            return None
+        return decode_declared_audio(
+            body, audio_format,
+            sample_rate=ct_params.get('rate', WHISPER_SAMPLE_RATE),
+            channels=ct_params.get('channels', 1),
+        )
+
+    audio_file = request.FILES.get('audio')
+    if audio_file is None:
+        return None
+    audio_format = params.get('audio_format')
+    if not audio_format:
+        return audio_file
+    return decode_declared_audio(
+        audio_file.read(), audio_format,
+        sample_rate=params.get('sample_rate', WHISPER_SAMPLE_RATE),
+        channels=params.get('channels', 1),
+    )
+
+
+def request_params(request):
+    """Поля запроса: форма, а для сырого аудио в теле - query string"""
+    return request.GET if is_raw_audio_request(request) else request.POST
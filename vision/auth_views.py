@@ -5,6 +5,8 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import authenticate, get_user_model
 from .serializers import UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer
+from .quota import QuotaManager
+from .identity_cache import IdentityCache
 
 User = get_user_model()
 
@@ -71,6 +73,7 @@ def logout(request):
     POST /api/auth/logout/
     Headers: Authorization: Token <token>
     """
+    IdentityCache.invalidate_user(request.user.pk)
     request.user.auth_token.delete()
     return Response({'message': 'Logout successful'})
 
@@ -97,6 +100,7 @@ def profile(request):
         serializer = UserProfileSerializer(request.user, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
+            IdentityCache.invalidate_user(request.user.pk)
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -108,21 +112,7 @@ def check_limits(request):
     
     GET /api/auth/check-limits/
     """
-    user = request.user
-    can_request = user.can_make_request()
-    
-    limits = {'free': 10, 'premium': 999999, 'pro': 999999}
-    limit = limits.get(user.subscription_type, 10)
-    remaining = max(0, limit - user.daily_requests_count)
-    
-    return Response({
-        'can_make_request': can_request,
-        'subscription_type': user.subscription_type,
-        'daily_limit': limit,
-        'requests_used': user.daily_requests_count,
-        'requests_remaining': remaining,
-        'total_requests': user.total_requests
-    })
+    return Response(QuotaManager.status(request.user))
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
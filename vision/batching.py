@@ -0,0 +1,153 @@
+"""
+Динамический micro-batching для YOLO.
+
+Кадры, пришедшие в пределах короткого окна (YOLO_BATCH_WINDOW_MS, по умолчанию
+10 мс), собираются в один батч до YOLO_MAX_BATCH штук и прогоняются одним
+вызовом model.predict. Результаты раздаются ожидающим запросам по порядку.
+YOLO_BATCH_WINDOW_MS=0 отключает батчинг (прямой вызов predict).
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from .model_registry import ModelRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class DetectionBatcher:
+    """
+    Собирает одиночные запросы детекции в батчи в фоновом потоке.
+
+    Использование:
+        result = DetectionBatcher.default().predict(img)  # ultralytics Results
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, model_id='yolo', window_ms=10.0, max_batch=8, **predict_kwargs):
+        self.model_id = model_id
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.predict_kwargs = predict_kwargs
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        # Метрики
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = {}
+        self._delays = deque(maxlen=1000)
+        self._requests = 0
+        self._batches = 0
+
+    @classmethod
+    def default(cls):
+        """Общий батчер YOLO для /api/detect/ и режима навигатора"""
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls(
+                        model_id='yolo',
+                        window_ms=float(os.getenv('YOLO_BATCH_WINDOW_MS', '10')),
+                        max_batch=int(os.getenv('YOLO_MAX_BATCH', '8')),
+                        conf=0.3,
+                        iou=0.45,
+                        verbose=False,
+                    )
+        return cls._default
+
+    def predict(self, img):
+        """Блокирующий вызов: детекция одного кадра (BGR numpy) через общий батч"""
+        if self.window <= 0 or self.max_batch == 1:
+            with ModelRegistry.lease(self.model_id) as model:
+                if model is None:
+                    return None
+                self._record(1, [0.0])
+                return model.predict(img, **self.predict_kwargs)[0]
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((img, future, time.perf_counter()))
+        return future.result()
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"batcher-{self.model_id}", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        """Ждет первый кадр, затем добирает батч до окна или max_batch"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            images = [item[0] for item in batch]
+            futures = [item[1] for item in batch]
+            self._record(len(batch), [started - item[2] for item in batch])
+
+            try:
+                # Аренда только на время батча: между батчами поток не держит модель,
+                # и вытеснение из ModelRegistry действительно освобождает память
+                with ModelRegistry.lease(self.model_id) as model:
+                    if model is None:
+                        results = [None] * len(batch)
+                    else:
+                        results = model.predict(images, **self.predict_kwargs)
+            except Exception as e:
+                logger.error(f"Batched predict failed ({len(batch)} frames): {e}")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def _record(self, batch_size, delays):
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += batch_size
+            self._batch_sizes[batch_size] = self._batch_sizes.get(batch_size, 0) + 1
+            self._delays.extend(delays)
+
+    def stats(self):
+        """Распределение размеров батчей и задержка в очереди (мс)"""
+        with self._stats_lock:
+            delays = sorted(self._delays)
+            sizes = dict(sorted(self._batch_sizes.items()))
+            requests, batches = self._requests, self._batches
+
+        def percentile(p):
+            if not delays:
+                return None
+            return round(delays[min(len(delays) - 1, int(p * len(delays)))] * 1000, 2)
+
+        return {
+            'window_ms': self.window * 1000,
+            'max_batch': self.max_batch,
+            'requests': requests,
+            'batches': batches,
+            'avg_batch_size': round(requests / batches, 2) if batches else None,
+            'batch_size_histogram': sizes,
+            'queue_delay_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'max': percentile(1.0)},
+            'queue_depth': self._queue.qsize(),
+        }
@@ -1,9 +1,19 @@
 import logging
 from datetime import datetime
 from .models import VisionUser
+from .unit_of_work import save_fields
 
 logger = logging.getLogger(__name__)
 
+# Статический префикс: не содержит ничего, что меняется от запроса к запросу,
+# чтобы контекстный кэш провайдера (DeepSeek context caching) попадал всегда.
+STATIC_SYSTEM_PROMPT = (
+    "Ты — A-Vision, умный помощник в очках. Твоя цель — помогать пользователю ориентироваться и решать задачи.\n"
+    "Отвечай кратко (1-3 предложения), живо и по-человечески.\n"
+    "\nИнструкция: Если пользователь спрашивает 'что ты видишь', опиши сцену. Если просит помощи, помоги.\n"
+    "Ниже в разделе КОНТЕКСТ - сведения о пользователе, времени и том, что ты видишь."
+)
+
 class CAGSystem:
     """
     Context-Affect-Guidance Orchestrator
@@ -11,7 +21,8 @@ class CAGSystem:
     def __init__(self, user: VisionUser):
         self.user = user
         # Инициализация фактов, если пусто
-        if not self.user.facts:
+        self._initialized = not self.user.facts
+        if self._initialized:
             self.user.facts = {
                 "name": None,
                 "interests": [],
@@ -23,6 +34,7 @@ class CAGSystem:
         """Обновляет аффективное состояние (настроение)"""
         text = user_text.lower()
         facts = self.user.facts
+        before = dict(facts)
         
         # Простейшая эвристика (можно заменить на классификатор)
         if any(w in text for w in ["устал", "спать", "нет сил"]):
@@ -42,39 +54,51 @@ class CAGSystem:
                 facts["name"] = name
 
         self.user.facts = facts
-        self.user.save()
+        # Пишем только если что-то изменилось (и только поле facts)
+        if facts != before or self._initialized:
+            # Экземпляр в IdentityCache - этот же объект, он уже содержит новые факты;
+            # другие процессы увидят их по истечении IDENTITY_CACHE_TTL
+            save_fields(self.user, 'facts')
+            self._initialized = False
 
     def build_system_prompt(self, visual_context=None) -> str:
-        """Собирает системный промпт для LLM"""
+        """
+        Собирает системный промпт для LLM.
+        Статический префикс всегда байт-в-байт одинаковый (его кэширует провайдер),
+        все изменчивое (профиль, настроение, время, зрение) - в хвосте.
+        """
+        return STATIC_SYSTEM_PROMPT + self.build_dynamic_context(visual_context)
+
+    def build_dynamic_context(self, visual_context=None) -> str:
+        """Изменчивая часть промпта: профиль, аффект, время, визуальный контекст"""
         f = self.user.facts
+        prompt = "\n\nКОНТЕКСТ:\n"
         
-        # 1. Личность
-        prompt = (
-            "Ты — A-Vision, умный помощник в очках. Твоя цель — помогать пользователю ориентироваться и решать задачи.\n"
-            "Отвечай кратко (1-3 предложения), живо и по-человечески.\n\n"
-        )
-        
-        # 2. Профиль пользователя
+        # 1. Профиль пользователя
         if f.get("name"):
             prompt += f"Пользователя зовут {f['name']}. Обращайся по имени иногда.\n"
         
         if f.get("interests"):
             prompt += f"Интересы пользователя: {', '.join(f['interests'])}.\n"
             
-        # 3. Состояние (Affect)
+        # 2. Состояние (Affect)
         mood_map = {"tired": "У пользователя мало сил, отвечай мягко и поддерживающе.", 
                    "happy": "Пользователь рад, поддерживай позитив!",
                    "neutral": ""}
-        prompt += f"{mood_map.get(f.get('mood'), '')}\n\n"
+        mood = mood_map.get(f.get('mood'), '')
+        if mood:
+            prompt += f"{mood}\n"
         
-        # 4. Контекст времени
-        hour = datetime.now().hour
-        time_desc = "День" if 9 <= hour < 18 else "Вечер/Ночь"
-        prompt += f"Сейчас {time_desc} ({hour}:00).\n"
+        # 3. Контекст времени
+        prompt += time_context()
         
         if visual_context:
-            prompt += f"\nТы видишь: {visual_context}\n"
-            
-        prompt += "\nИнструкция: Если пользователь спрашивает 'что ты видишь', опиши сцену. Если просит помощи, помоги."
+            prompt += f"Ты видишь: {visual_context}\n"
         
         return prompt
+
+
+def time_context() -> str:
+    hour = datetime.now().hour
+    time_desc = "День" if 9 <= hour < 18 else "Вечер/Ночь"
+    return f"Сейчас {time_desc} ({hour}:00).\n"
@@ -0,0 +1,137 @@
+"""
+Выделенные пулы исполнителей для инференса моделей.
+
+`sync_to_async` по умолчанию работает с thread_sensitive=True, то есть все
+вызовы моделей (и ORM всех остальных запросов) выстраиваются в очередь на
+одном общем sync-потоке. Здесь у каждой модели свой именованный пул, поэтому
+STT и Vision реально выполняются параллельно и не блокируют доступ к БД.
+
+Размер и тип пула задаются через окружение:
+    INFERENCE_POOL_WHISPER=2
+    INFERENCE_POOL_OCR_KIND=process    # thread (по умолчанию) или process
+
+Тип process разрешен только для пулов из PROCESS_POOLS: туда отправляются
+модульные функции с picklable аргументами и без общего состояния процесса.
+Остальные пулы в отдельном процессе сломались бы или тихо потеряли бы общее
+состояние: tts отправляет связанный метод модели (pickle всей модели), yolo
+держит батчер и кэш сцен родителя, blip - кэш подписей, whisper получает
+загруженные файлы Django. Для них _KIND=process игнорируется с предупреждением.
+"""
+import os
+import asyncio
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Размеры пулов по умолчанию (потоков/процессов на ASGI воркер)
+DEFAULT_POOL_SIZES = {
+    'whisper': 2,
+    'blip': 1,        # BLIP сам использует все ядра через torch
+    'yolo': 8,        # потоки в основном ждут общий батч (см. batching.py)
+    'ocr': 1,
+    'tts': 1,
+    'preprocess': 2,  # декодирование и resize изображений
+}
+
+# Пулы, которые можно вынести в ProcessPoolExecutor (см. docstring модуля)
+PROCESS_POOLS = {'ocr', 'preprocess'}
+
+
+class InferenceExecutors:
+    """
+    Реестр именованных пулов. Пулы создаются лениво при первом обращении.
+    """
+    _pools = {}
+    _stats = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _pool_config(cls, name):
+        env_name = f"INFERENCE_POOL_{name.upper()}"
+        size = int(os.getenv(env_name, DEFAULT_POOL_SIZES.get(name, 1)))
+        kind = os.getenv(f"{env_name}_KIND", 'thread').lower()
+        if kind not in ('thread', 'process'):
+            logger.warning(f"{env_name}_KIND={kind} is unknown, using thread")
+            kind = 'thread'
+        elif kind == 'process' and name not in PROCESS_POOLS:
+            logger.warning(
+                f"{env_name}_KIND=process is not supported for '{name}' "
+                f"(allowed: {', '.join(sorted(PROCESS_POOLS))}), using thread"
+            )
+            kind = 'thread'
+        return max(1, size), kind
+
+    @classmethod
+    def get(cls, name):
+        pool = cls._pools.get(name)
+        if pool is not None:
+            return pool
+
+        with cls._lock:
+            pool = cls._pools.get(name)
+            if pool is None:
+                size, kind = cls._pool_config(name)
+                if kind == 'process':
+                    # Аргументы и результаты должны быть picklable,
+                    # модели загружаются отдельно в каждом процессе.
+                    pool = ProcessPoolExecutor(max_workers=size)
+                else:
+                    pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"infer-{name}")
+                cls._pools[name] = pool
+                cls._stats[name] = {
+                    'kind': kind,
+                    'size': size,
+                    'submitted': 0,
+                    'completed': 0,
+                    'failed': 0,
+                    'active': 0,
+                }
+                logger.info(f"Inference pool '{name}' created ({kind}, size={size})")
+        return pool
+
+    @classmethod
+    def _track(cls, name, key, delta=1):
+        with cls._lock:
+            cls._stats[name][key] += delta
+
+    @classmethod
+    def stats(cls):
+        """Снимок счетчиков по всем пулам (для мониторинга)"""
+        with cls._lock:
+            return {name: dict(values) for name, values in cls._stats.items()}
+
+    @classmethod
+    def shutdown(cls, wait=True):
+        with cls._lock:
+            pools = list(cls._pools.values())
+            cls._pools.clear()
+            cls._stats.clear()
+        for pool in pools:
+            pool.shutdown(wait=wait)
+
+
+async def run_inference(pool_name, func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию модели в её выделенном пуле.
+
+    Пример:
+        text = await run_inference('whisper', speech_to_text, audio_file)
+    """
+    executor = InferenceExecutors.get(pool_name)
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+
+    InferenceExecutors._track(pool_name, 'submitted')
+    InferenceExecutors._track(pool_name, 'active')
+    try:
+        result = await loop.run_in_executor(executor, call)
+        InferenceExecutors._track(pool_name, 'completed')
+        return result
+    except Exception:
+        InferenceExecutors._track(pool_name, 'failed')
+        raise
+    finally:
+        InferenceExecutors._track(pool_name, 'active', -1)
@@ -0,0 +1,235 @@
+"""
+Кадр, декодированный один раз.
+
+Раньше загрузка декодировалась в optimize_image, пережималась в JPEG, а затем
+заново декодировалась в BLIP (PIL), EasyOCR и YOLO (еще раз resize + CLAHE).
+Frame хранит numpy-буфер и лениво вычисляет производные представления,
+которые используют все модели.
+
+Большие JPEG с телефона (часто 12 Мп) декодируются сразу в уменьшенном
+разрешении (DCT-масштабирование), а не целиком с последующим resize.
+"""
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+# DCT-масштабирование libjpeg: декодер сразу выдает 1/2, 1/4 или 1/8 разрешения
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# EXIF Orientation -> преобразование (повороты/отражения)
+_ORIENTATION_OPS = {
+    2: lambda img: cv2.flip(img, 1),
+    3: lambda img: cv2.rotate(img, cv2.ROTATE_180),
+    4: lambda img: cv2.flip(img, 0),
+    5: lambda img: cv2.flip(cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE), 1),
+    6: lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+    7: lambda img: cv2.flip(cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE), 1),
+    8: lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
+}
+
+# Маркеры SOF (Start Of Frame), в которых лежат размеры изображения
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _exif_orientation(app1):
+    """Читает тег Orientation (0x0112) из сегмента APP1/Exif"""
+    if not app1.startswith(b'Exif\x00\x00'):
+        return 1
+    tiff = app1[6:]
+    if len(tiff) < 8:
+        return 1
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None:
+        return 1
+    ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return 1
+    count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    for i in range(count):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > len(tiff):
+            break
+        tag = struct.unpack(endian + 'H', tiff[entry:entry + 2])[0]
+        if tag == 0x0112:
+            return struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])[0]
+    return 1
+
+
+def jpeg_header(data):
+    """
+    Разбирает заголовок JPEG без декодирования пикселей.
+    Возвращает (width, height, orientation) или None, если это не JPEG.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    orientation = 1
+    pos = 2
+    size = len(data)
+    while pos + 4 <= size:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # заполняющие байты
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1:
+            orientation = _exif_orientation(segment)
+        elif marker in _SOF_MARKERS and len(segment) >= 5:
+            height, width = struct.unpack('>HH', segment[1:5])
+            return width, height, orientation
+        elif marker == 0xDA:  # начало данных скана, SOF уже должен был встретиться
+            return None
+        pos += 2 + length
+    return None
+
+
+def decode_image(image_bytes, max_dim=None):
+    """
+    Декодирует изображение с учетом целевого размера.
+
+    Для JPEG сначала читается заголовок и выбирается наибольший коэффициент
+    DCT-уменьшения (2/4/8), при котором большая сторона остается >= max_dim;
+    остаток доводится обычным resize. EXIF-ориентация применяется вручную.
+    Остальные форматы (PNG, WebP...) декодируются целиком.
+    """
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    header = jpeg_header(image_bytes) if max_dim else None
+    if header is None:
+        return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+    width, height, orientation = header
+    flags = cv2.IMREAD_COLOR
+    for factor, reduced_flag in _REDUCED_FLAGS:
+        if max(width, height) // factor >= max_dim:
+            flags = reduced_flag
+            break
+
+    img = cv2.imdecode(nparr, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        # Битый заголовок или экзотический JPEG - пробуем полный путь
+        return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+    op = _ORIENTATION_OPS.get(orientation)
+    return op(img) if op else img
+
+
+class Frame:
+    """
+    Изображение BGR (формат OpenCV) + кэш производных представлений.
+
+    Использование:
+        frame = Frame.from_bytes(image_bytes, max_dim=640)
+        frame.image   # BGR, уменьшенный до max_dim
+        frame.rgb     # для BLIP
+        frame.clahe   # для YOLO
+        frame.gray
+    """
+
+    def __init__(self, bgr, max_dim=None):
+        self.bgr = bgr
+        self.max_dim = max_dim
+        self._views = {}
+        # RLock: rgb/gray/clahe вычисляются из image, который сам лениво кэшируется
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_bytes(cls, image_bytes, max_dim=None):
+        """
+        Декодирует загрузку. Возвращает None, если это не изображение.
+        При заданном max_dim большие JPEG декодируются сразу в уменьшенном виде.
+        """
+        img = decode_image(image_bytes, max_dim=max_dim)
+        if img is None:
+            return None
+        return cls(img, max_dim=max_dim)
+
+    @classmethod
+    def ensure(cls, image, max_dim=None):
+        """Принимает Frame или сырые байты (для обратной совместимости)"""
+        if isinstance(image, Frame):
+            return image
+        return cls.from_bytes(image, max_dim=max_dim)
+
+    def __getstate__(self):
+        # Lock не сериализуется (нужно для process-пулов)
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _view(self, key, compute):
+        view = self._views.get(key)
+        if view is None:
+            with self._lock:
+                view = self._views.get(key)
+                if view is None:
+                    view = self._views[key] = compute()
+        return view
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def resized(self, max_dim):
+        """BGR-изображение, у которого большая сторона не превышает max_dim"""
+        h, w = self.bgr.shape[:2]
+        if not max_dim or max(h, w) <= max_dim:
+            return self.bgr
+
+        def compute():
+            scale = max_dim / max(h, w)
+            return cv2.resize(self.bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+        return self._view(('resized', max_dim), compute)
+
+    @property
+    def image(self):
+        """Рабочее BGR-изображение (уменьшенное до max_dim кадра)"""
+        return self.resized(self.max_dim)
+
+    @property
+    def rgb(self):
+        return self._view('rgb', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB))
+
+    @property
+    def gray(self):
+        return self._view('gray', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def clahe(self):
+        """Улучшение контраста (CLAHE по каналу L) для детекции"""
+        def compute():
+            lab = cv2.cvtColor(self.image, cv2.COLOR_BGR2LAB)
+            l, a, b = cv2.split(lab)
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+            l = clahe.apply(l)
+            return cv2.cvtColor(cv2.merge([l, a, b]), cv2.COLOR_LAB2BGR)
+
+        return self._view('clahe', compute)
+
+    @property
+    def dhash(self):
+        """64-битный разностный хэш (dHash) для поиска почти одинаковых кадров"""
+        def compute():
+            small = cv2.resize(self.gray, (9, 8), interpolation=cv2.INTER_AREA)
+            bits = (small[:, 1:] > small[:, :-1]).flatten()
+            value = 0
+            for bit in bits:
+                value = (value << 1) | int(bit)
+            return value
+
+        return self._view('dhash', compute)
@@ -0,0 +1,213 @@
+"""
+Постоянная сессия очков по WebSocket: ws://<host>/ws/session/
+
+Вместо отдельного multipart POST на каждый кадр и каждую фразу (TLS,
+аутентификация, VisionUser.get_or_create, разбор формы) очки держат одно
+соединение. Пользователь, VisionUser с фактами CAG, последний кадр и последние
+детекции живут в памяти сессии, поэтому кадр стоит только инференса.
+
+Протокол:
+    подключение: /ws/session/?user_id=...&token=...&mode=navigator|chat
+                 &format=pcm_s16le&stt_profile=fast&stream=1
+    клиент -> сервер (бинарные, первый байт - тип):
+        0x01 + JPEG   - кадр камеры (если предыдущий еще обрабатывается,
+                        остается только самый свежий)
+        0x02 + PCM    - аудио 16 кГц моно (как в /ws/stt/)
+    клиент -> сервер (JSON):
+        {"type": "mode", "mode": "chat"|"navigator"}
+        {"type": "ask", "text": "..."}   - вопрос текстом (по последнему кадру)
+        {"type": "end"} / {"type": "reset"} - конец фразы / сброс аудио
+        {"type": "ping"}
+    сервер -> клиент:
+        {"type": "ready", ...}
+        {"type": "detections", "events": [...], "objects": [...], "message": "..."}
+                      - режим navigator, только при изменениях сцены (см. tracker.py)
+        partial / final / reply / text / audio / done / error - как в /ws/stt/
+        {"type": "pong", "stats": {...}}
+
+Настройки:
+    SESSION_FRAME_MAX_AGE=10   # секунд: более старый кадр не используется как контекст
+"""
+import os
+import time
+import asyncio
+import logging
+
+from .executors import run_inference
+from .frames import Frame
+from .audio_input import pcm_to_array
+from .services import analyze_image_local, detect_boxes_local
+from .pipeline import maybe_read_text
+from .tracker import ObjectTracker
+from .navigator import ru_names, navigator_message
+from .streaming_stt import STTSocket, accept_audio_socket
+from .websocket import WebSocketDisconnect, release_db_connections
+
+logger = logging.getLogger(__name__)
+
+FRAME_IMAGE = 0x01
+FRAME_AUDIO = 0x02
+MODES = ('chat', 'navigator')
+
+FRAME_MAX_AGE = float(os.getenv('SESSION_FRAME_MAX_AGE', '10'))
+
+
+class GlassesSession(STTSocket):
+    """Состояние одного подключения очков"""
+
+    def __init__(self, ws, user_id, mode='chat', **params):
+        super().__init__(ws, **params)
+        self.user_id = user_id
+        self.mode = mode if mode in MODES else 'chat'
+        self.frame = None
+        self.frame_time = 0.0
+        self.detections = []
+        self.tracker = ObjectTracker.from_env()
+        self._pending_image = None
+        self._frame_task = None
+        self.stats = {'frames': 0, 'frames_dropped': 0, 'frames_failed': 0, 'utterances': 0}
+
+    async def run(self):
+        await self.ws.send_json({
+            'type': 'ready',
+            'mode': self.mode,
+            'authenticated': self.user is not None,
+            'stt_profile': self.profile.name,
+        })
+        try:
+            while True:
+                kind, payload = await self.ws.receive()
+                if kind == 'bytes':
+                    await self.on_binary(payload)
+                else:
+                    await self.on_control(payload)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.cancel_tasks()
+
+    def cancel_tasks(self):
+        super().cancel_tasks()
+        if self._frame_task is not None:
+            self._frame_task.cancel()
+
+    async def on_binary(self, data):
+        if not data:
+            return
+        kind = data[0]
+        if kind == FRAME_IMAGE:
+            self.on_image(data[1:])
+        elif kind == FRAME_AUDIO:
+            # memoryview: PCM оборачивается в numpy без копирования
+            await self.on_audio(pcm_to_array(memoryview(data)[1:], self.audio_format))
+        else:
+            await self.ws.send_json({'type': 'error', 'error': f'Unknown binary message type: {kind}'})
+
+    async def on_control(self, message):
+        kind = message.get('type')
+        if kind == 'mode':
+            self.mode = message.get('mode') if message.get('mode') in MODES else self.mode
+            await self.ws.send_json({'type': 'mode', 'mode': self.mode})
+        elif kind == 'ask':
+            text = (message.get('text') or '').strip()
+            if not text and self.current_frame() is not None:
+                text = "Что изображено?"
+            if text:
+                await self.reply(text)
+        elif kind == 'end':
+            self.finalize()
+        elif kind == 'reset':
+            self.transcriber.reset()
+        elif kind == 'ping':
+            await self.ws.send_json({'type': 'pong', 'stats': self.stats})
+
+    # --- кадры ---
+
+    def on_image(self, data):
+        self.stats['frames'] += 1
+        if self._pending_image is not None:
+            self.stats['frames_dropped'] += 1  # не успели обработать - важен только свежий кадр
+        self._pending_image = data
+        if self._frame_task is None or self._frame_task.done():
+            self._frame_task = asyncio.ensure_future(self._process_frames())
+
+    async def _process_frames(self):
+        while self._pending_image is not None:
+            data, self._pending_image = self._pending_image, None
+            try:
+                frame = await run_inference('preprocess', Frame.from_bytes, data, 640)
+            except Exception as e:
+                logger.error(f"Session frame decode error: {e}")
+                frame = None
+            if frame is None:
+                self.stats['frames_failed'] += 1
+                continue
+            self.frame = frame
+            self.frame_time = time.monotonic()
+            if self.mode == 'navigator':
+                try:
+                    await self.on_navigator_frame(frame)
+                except WebSocketDisconnect:
+                    return
+                except Exception as e:
+                    # Сбой детекции одного кадра не останавливает прием следующих
+                    logger.error(f"Session navigator error: {e}")
+                    await self.ws.send_json({'type': 'error', 'error': 'Detection failed'})
+
+    async def on_navigator_frame(self, frame):
+        if self.tracker.should_detect():
+            boxes = await run_inference('yolo', detect_boxes_local, frame)
+            events = self.tracker.update(boxes)
+        else:
+            events = self.tracker.predict()
+        objects = self.tracker.objects()
+        self.detections = ru_names(obj['class'] for obj in objects)
+        if events:
+            await self.ws.send_json({
+                'type': 'detections',
+                'events': events,
+                'objects': objects,
+                'message': navigator_message(events),
+            })
+
+    def current_frame(self):
+        if self.frame is None or time.monotonic() - self.frame_time > FRAME_MAX_AGE:
+            return None
+        return self.frame
+
+    # --- ответы ---
+
+    async def _reply(self, text, visual_description=None, ocr_text=None):
+        """Ответ с визуальным контекстом последнего кадра сессии"""
+        self.stats['utterances'] += 1
+        frame = self.current_frame()
+        if frame is not None and visual_description is None:
+            try:
+                if self.mode == 'navigator' and self.detections:
+                    visual_description = "Впереди: " + ", ".join(self.detections)
+                else:
+                    visual_description = await run_inference('blip', analyze_image_local, frame, self.user_id)
+                ocr_text = await maybe_read_text(frame, text)
+            except Exception as e:
+                # Отвечаем без картинки, а не молчим
+                logger.error(f"Session visual context error: {e}")
+        await super()._reply(text, visual_description, ocr_text)
+
+
+async def glasses_session_socket(scope, receive, send):
+    """ASGI-приложение для /ws/session/ (подключается в core/asgi.py)"""
+    opened = await accept_audio_socket(scope, receive, send)
+    if opened is None:
+        return
+    ws, params = opened
+    session = GlassesSession(
+        ws,
+        user_id=ws.query.get('user_id', 'anonymous'),
+        mode=ws.query.get('mode', 'chat'),
+        **params,
+    )
+    try:
+        await session.run()
+    finally:
+        await release_db_connections()
+        await ws.close()
@@ -0,0 +1,181 @@
+"""
+Кэш идентичности в памяти процесса: token -> User и telegram_id -> VisionUser.
+
+Раньше каждый запрос делал запрос к таблицам токенов и пользователей
+(TokenAuthentication) и VisionUser.objects.get_or_create. Для активных
+пользователей горячий путь теперь вообще не ходит в БД за идентичностью.
+
+Инвалидация: logout и обновление профиля (auth_views). Факты CAG пишутся в сам
+кэшированный VisionUser, сбрасывать его не нужно. Между процессами
+согласованность ограничена TTL, поэтому кэшированный User сохраняется только
+по update_fields (счетчики квоты меняет атомарный UPDATE, vision.quota).
+
+Настройки:
+    IDENTITY_CACHE_TTL=60     # секунд
+    IDENTITY_CACHE_SIZE=10000 # записей на каждый кэш (LRU)
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+
+class _TTLCache:
+    """LRU + TTL со счетчиками попаданий"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= now:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def pop_where(self, predicate):
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+            self._stats['invalidations'] += len(keys)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+        return stats
+
+
+class IdentityCache:
+    """
+    Использование:
+        user = await IdentityCache.auser_for_token(key)         # User или None
+        vision_user = await IdentityCache.avision_user(telegram_id)
+        IdentityCache.invalidate_user(user.pk)
+    """
+    _ttl = float(os.getenv('IDENTITY_CACHE_TTL', '60'))
+    _size = int(os.getenv('IDENTITY_CACHE_SIZE', '10000'))
+    _tokens = _TTLCache(_ttl, _size)        # token key -> (user, token)
+    _vision_users = _TTLCache(_ttl, _size)  # telegram_id -> VisionUser
+
+    # --- token -> User ---
+
+    @classmethod
+    def token(cls, key):
+        """(user, token) или None, если токена нет"""
+        cached = cls._tokens.get(key)
+        if cached is not None:
+            return cached
+        from rest_framework.authtoken.models import Token
+        try:
+            token = Token.objects.select_related('user').get(key=key)
+        except Token.DoesNotExist:
+            return None
+        cached = (token.user, token)
+        cls._tokens.set(key, cached)
+        return cached
+
+    @classmethod
+    async def auser_for_token(cls, key):
+        cached = cls._tokens.get(key)
+        if cached is None:
+            cached = await sync_to_async(cls.token)(key)
+        return cached[0] if cached else None
+
+    @classmethod
+    def invalidate_token(cls, key):
+        cls._tokens.pop(key)
+
+    @classmethod
+    def invalidate_user(cls, user_pk):
+        """Все токены пользователя (logout, изменение профиля)"""
+        cls._tokens.pop_where(lambda cached: cached[0].pk == user_pk)
+
+    # --- telegram_id -> VisionUser ---
+
+    @classmethod
+    def vision_user(cls, telegram_id):
+        vision_user = cls._vision_users.get(telegram_id)
+        if vision_user is not None:
+            return vision_user
+        from .models import VisionUser
+        vision_user, _ = VisionUser.objects.get_or_create(telegram_id=telegram_id)
+        cls._vision_users.set(telegram_id, vision_user)
+        return vision_user
+
+    @classmethod
+    async def avision_user(cls, telegram_id):
+        vision_user = cls._vision_users.get(telegram_id)
+        if vision_user is not None:
+            return vision_user
+        return await sync_to_async(cls.vision_user)(telegram_id)
+
+    @classmethod
+    def invalidate_vision_user(cls, telegram_id):
+        cls._vision_users.pop(telegram_id)
+
+    @classmethod
+    def stats(cls):
+        return {'tokens': cls._tokens.stats(), 'vision_users': cls._vision_users.stats()}
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без запросов к БД для недавно виденных токенов"""
+
+    def authenticate_credentials(self, key):
+        cached = IdentityCache.token(key)
+        if cached is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        user, token = cached
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return (user, token)
+
+
+async def aresolve_user(request):
+    """
+    Пользователь для обычных Django views (SmartAnalyzeView):
+    заголовок 'Authorization: Token <key>' через кэш, иначе сессия.
+    Возвращает User или None (анонимный запрос). Неизвестный токен или
+    неактивный пользователь - AuthenticationFailed, как в CachedTokenAuthentication,
+    а не тихий переход в анонимный режим.
+    """
+    auth = request.headers.get('Authorization', '').split()
+    if len(auth) == 2 and auth[0].lower() == 'token':
+        user = await IdentityCache.auser_for_token(auth[1])
+        if user is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return user
+    user = await request.auser()
+    return user if user.is_authenticated else None
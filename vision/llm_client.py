@@ -0,0 +1,240 @@
+"""
+Общий пул клиентов AsyncOpenAI (DeepSeek / OpenRouter).
+
+Раньше каждый запрос создавал новый AsyncOpenAI: новый пул соединений и новый
+TLS-handshake до api.deepseek.com. Теперь на каждую пару (base_url, ключ)
+в каждом event loop создается один клиент с keep-alive (и опционально HTTP/2),
+который переиспользуют все views. Клиенты закрываются на ASGI lifespan shutdown
+или вместе со своим event loop: под WSGI (async_to_sync) у каждого запроса
+свой loop, и keep-alive между запросами работает только под ASGI (uvicorn).
+
+Настройки:
+    LLM_HTTP2=True                 # нужен пакет h2, иначе HTTP/1.1
+    LLM_MAX_CONNECTIONS=20
+    LLM_MAX_KEEPALIVE=10
+    LLM_KEEPALIVE_EXPIRY=60        # секунд
+"""
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+
+import httpx
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+
+def resolve_llm_endpoint(api_key):
+    """Ключ OpenRouter (sk-or-v1...) -> OpenRouter, иначе DeepSeek. Возвращает (base_url, model_name)"""
+    if api_key.startswith("sk-or-v1"):
+        return OPENROUTER_BASE_URL, "deepseek/deepseek-chat"
+    return DEEPSEEK_BASE_URL, "deepseek-chat"
+
+
+def _http2_enabled():
+    if os.getenv('LLM_HTTP2', 'True') != 'True':
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class LLMClientPool:
+    """
+    Использование:
+        client, model_name = LLMClientPool.get(api_key)
+        await client.chat.completions.create(model=model_name, ...)
+    """
+    _clients = weakref.WeakKeyDictionary()  # loop -> {(base_url, key_hash): AsyncOpenAI}
+    _guards = weakref.WeakKeyDictionary()   # loop -> задача, закрывающая клиенты loop
+    _lock = threading.Lock()
+    _stats = {
+        'clients_created': 0,
+        'requests': 0,
+        'new_connections': 0,
+        'tls_handshakes': 0,
+        'http2': None,
+    }
+
+    @classmethod
+    def _count(cls, key):
+        with cls._lock:
+            cls._stats[key] += 1
+
+    @classmethod
+    async def _trace(cls, event_name, info):
+        # Трассировка httpcore: сколько соединений реально открыто
+        if event_name == 'connection.connect_tcp.complete':
+            cls._count('new_connections')
+        elif event_name == 'connection.start_tls.complete':
+            cls._count('tls_handshakes')
+
+    @classmethod
+    async def _on_request(cls, request):
+        cls._count('requests')
+        request.extensions['trace'] = cls._trace
+
+    @classmethod
+    def _create(cls, api_key, base_url):
+        http2 = _http2_enabled()
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('LLM_MAX_CONNECTIONS', '20')),
+                max_keepalive_connections=int(os.getenv('LLM_MAX_KEEPALIVE', '10')),
+                keepalive_expiry=float(os.getenv('LLM_KEEPALIVE_EXPIRY', '60')),
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            event_hooks={'request': [cls._on_request]},
+        )
+        with cls._lock:
+            cls._stats['clients_created'] += 1
+            cls._stats['http2'] = http2
+        logger.info(f"LLM client created for {base_url} (http2={http2})")
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+    @classmethod
+    def get(cls, api_key, base_url=None):
+        """Клиент для текущего event loop (создается лениво). Возвращает (client, model_name)"""
+        default_url, model_name = resolve_llm_endpoint(api_key)
+        base_url = base_url or default_url
+        key = (base_url, hashlib.sha256(api_key.encode()).hexdigest())
+
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            clients = cls._clients.setdefault(loop, {})
+            client = clients.get(key)
+        if client is None:
+            # Между проверкой и записью нет await, гонки внутри одного loop нет
+            client = cls._create(api_key, base_url)
+            with cls._lock:
+                clients[key] = client
+                watched = loop in cls._guards
+            if not watched:
+                cls._watch_loop(loop)
+        return client, model_name
+
+    @classmethod
+    def _watch_loop(cls, loop):
+        """
+        asyncio.run и async_to_sync перед закрытием loop отменяют оставшиеся
+        задачи. Отмена этой задачи закрывает клиенты loop - иначе их
+        соединения остаются открытыми после каждого запроса под WSGI.
+        """
+        async def close_on_cancel():
+            try:
+                await loop.create_future()
+            finally:
+                await cls.aclose_all()
+
+        task = loop.create_task(close_on_cancel())
+        with cls._lock:
+            cls._guards[loop] = task
+
+    @classmethod
+    async def aclose_all(cls):
+        """Закрывает клиенты текущего event loop (ASGI lifespan shutdown, закрытие loop)"""
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            clients = cls._clients.pop(loop, {})
+            guard = cls._guards.pop(loop, None)
+        if guard is not None and guard is not asyncio.current_task():
+            guard.cancel()
+        for client in clients.values():
+            try:
+                await client.close()
+            except Exception as e:
+                logger.error(f"Error closing LLM client: {e}")
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            stats = dict(cls._stats)
+            stats['open_clients'] = sum(len(c) for c in cls._clients.values())
+        requests = stats['requests']
+        stats['connection_reuse_ratio'] = (
+            round(1 - stats['new_connections'] / requests, 3) if requests else None
+        )
+        return stats
+
+
+def _cached_tokens(usage):
+    """Сколько токенов промпта пришло из кэша провайдера (DeepSeek или OpenAI-формат)"""
+    hit = getattr(usage, 'prompt_cache_hit_tokens', None)  # DeepSeek
+    if hit is not None:
+        return hit
+    details = getattr(usage, 'prompt_tokens_details', None)  # OpenAI / OpenRouter
+    if details is not None:
+        return getattr(details, 'cached_tokens', None) or 0
+    return 0
+
+
+class PromptCacheStats:
+    """
+    Учет контекстного кэша провайдера: cached tokens из поля usage,
+    доля попаданий и время до первого токена (TTFT) с попаданием и без.
+    """
+    _lock = threading.Lock()
+    _stats = {
+        'requests': 0,
+        'requests_without_usage': 0,
+        'prompt_tokens': 0,
+        'cached_tokens': 0,
+        'cache_hit_requests': 0,
+    }
+    _timings = {}  # ('ttft'|'latency', 'hit'|'miss') -> [sum_seconds, count]
+
+    @classmethod
+    def record(cls, usage, ttft=None, latency=None):
+        """Возвращает число закэшированных токенов для этого запроса"""
+        with cls._lock:
+            cls._stats['requests'] += 1
+            if usage is None:
+                cls._stats['requests_without_usage'] += 1
+                return None
+            prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+            cached = _cached_tokens(usage)
+            cls._stats['prompt_tokens'] += prompt_tokens
+            cls._stats['cached_tokens'] += cached
+            outcome = 'hit' if cached else 'miss'
+            if cached:
+                cls._stats['cache_hit_requests'] += 1
+            for kind, value in (('ttft', ttft), ('latency', latency)):
+                if value is not None:
+                    total = cls._timings.setdefault((kind, outcome), [0.0, 0])
+                    total[0] += value
+                    total[1] += 1
+        timing = ttft if ttft is not None else latency
+        logger.info(
+            f"LLM prompt cache: {cached}/{prompt_tokens} tokens cached"
+            + (f", {timing * 1000:.0f} ms" if timing is not None else "")
+        )
+        return cached
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            stats = dict(cls._stats)
+            timings = {f"{kind}_{outcome}_ms": round(total / count * 1000, 1)
+                       for (kind, outcome), (total, count) in cls._timings.items() if count}
+        stats['token_hit_rate'] = (
+            round(stats['cached_tokens'] / stats['prompt_tokens'], 3) if stats['prompt_tokens'] else None
+        )
+        stats.update(timings)
+        return stats
+
+
+def get_llm_client():
+    """Клиент и имя модели по OPENAI_API_KEY. Возвращает (None, None), если ключа нет."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None, None
+    return LLMClientPool.get(api_key)
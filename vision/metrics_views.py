@@ -0,0 +1,40 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+from rest_framework.permissions import IsAdminUser
+from .executors import InferenceExecutors
+from .model_registry import ModelRegistry
+from .batching import DetectionBatcher
+from .scene_cache import SceneCache
+from .llm_client import LLMClientPool, PromptCacheStats
+from .response_cache import ResponseCache
+from .unit_of_work import QueryCounter
+from .db_stats import ConnectionStats
+from .identity_cache import IdentityCache
+from .tracker import TrackerStore
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """
+    Внутренние метрики процесса (пулы инференса, модели в памяти, батчинг YOLO, кэши)
+    
+    GET /api/metrics/
+    Headers: Authorization: Token <token>  (только staff)
+    """
+    from .tts_system.manager import TTSManager, get_retention
+
+    return Response({
+        'executors': InferenceExecutors.stats(),
+        'models': ModelRegistry.stats(),
+        'yolo_batching': DetectionBatcher.default().stats(),
+        'scene_cache': SceneCache.all_stats(),
+        'llm_client': LLMClientPool.stats(),
+        'llm_prompt_cache': PromptCacheStats.stats(),
+        'llm_response_cache': ResponseCache.default().stats(),
+        'tts_cache': TTSManager().cache.stats(),
+        'tts_retention': get_retention().stats(),
+        'db_queries': QueryCounter.stats(),
+        'db_connections': ConnectionStats.stats(),
+        'identity_cache': IdentityCache.stats(),
+        'navigator_tracker': TrackerStore.default().stats(),
+    })
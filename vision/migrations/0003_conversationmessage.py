@@ -0,0 +1,65 @@
+import json
+from datetime import timedelta
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def copy_context_to_messages(apps, schema_editor):
+    """Переносит JSON-историю из VisionUser.context в строки ConversationMessage"""
+    VisionUser = apps.get_model('vision', 'VisionUser')
+    ConversationMessage = apps.get_model('vision', 'ConversationMessage')
+
+    batch = []
+    users = (VisionUser.objects
+             .exclude(context__isnull=True).exclude(context='')
+             .only('id', 'context', 'created_at'))
+    for vision_user in users.iterator(chunk_size=500):
+        try:
+            history = json.loads(vision_user.context)
+        except ValueError:
+            continue
+        if not isinstance(history, list):
+            continue
+        # Точного времени у старых сообщений нет: сохраняем порядок сдвигом на микросекунды
+        base = vision_user.created_at or django.utils.timezone.now()
+        for i, item in enumerate(history):
+            if not isinstance(item, dict) or 'content' not in item:
+                continue
+            batch.append(ConversationMessage(
+                vision_user_id=vision_user.id,
+                role=str(item.get('role', 'user'))[:20],
+                content=str(item['content']),
+                created_at=base + timedelta(microseconds=i),
+            ))
+        if len(batch) >= 1000:
+            ConversationMessage.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        ConversationMessage.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vision', '0002_visionuser_facts_alter_user_id_alter_visionuser_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(max_length=20)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('vision_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='vision.visionuser')),
+            ],
+            options={
+                'db_table': 'conversation_messages',
+                'indexes': [models.Index(fields=['vision_user', 'created_at'], name='conv_msg_user_created_idx')],
+            },
+        ),
+        migrations.RunPython(copy_context_to_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vision', '0003_conversationmessage'),
+    ]
+
+    operations = [
+        # auto_now убран: любой save() профиля сдвигал дату и "переносил" вчерашний счетчик на сегодня
+        migrations.AlterField(
+            model_name='user',
+            name='last_request_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,436 @@
+"""
+Единый реестр моделей процесса.
+
+Каждая модель (Whisper, BLIP, EasyOCR, YOLO) загружается лениво, ровно один
+раз на процесс, под собственной блокировкой — два одновременных первых
+запроса больше не грузят BLIP дважды. Для каждой модели запоминается прирост
+RSS при загрузке и время загрузки.
+
+Резидентные модели укладываются в бюджет памяти: при нехватке вытесняется
+давно не использованная (LRU), простаивающие выгружаются по таймауту,
+закрепленные (например YOLO для навигатора) не выгружаются никогда.
+Размер модели - измеренный прирост RSS, а если его не удалось получить -
+заявленная оценка (DECLARED_SIZES / register(size_bytes=...)).
+
+Модель берется в аренду на время вызова (ModelRegistry.lease): арендованная
+модель не вытесняется, а после выгрузки в процессе не остается ссылок на нее,
+и память действительно освобождается.
+"""
+import os
+import time
+import functools
+import contextlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _current_rss():
+    """Текущий RSS процесса в байтах (None, если платформа не позволяет узнать)"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return None
+
+
+def _device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+# --- Загрузчики моделей по умолчанию (тяжелые импорты внутри функций) ---
+
+def _load_whisper(size="tiny"):
+    from faster_whisper import WhisperModel
+    logger.info(f"Загрузка модели Whisper {size} (STT)...")
+    device = _device()
+    compute_type = "float16" if device == "cuda" else "int8"
+    try:
+        model = WhisperModel(size, device=device, compute_type=compute_type)
+        logger.info(f"Whisper ({size}) загружен на {device}")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки Whisper на {device}, повтор на CPU: {e}")
+        model = WhisperModel(size, device="cpu", compute_type="int8")
+    return model
+
+
+def _load_blip():
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    logger.info("Загрузка модели Vision (BLIP)...")
+    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+    device = _device()
+    model.to(device)
+    logger.info(f"Vision модель загружена на {device}")
+    return processor, model
+
+
+def _load_easyocr():
+    import easyocr
+    import torch
+    logger.info("Загрузка EasyOCR...")
+    # Инициализируем только русский и английский
+    reader = easyocr.Reader(['ru', 'en'], gpu=torch.cuda.is_available())
+    logger.info("EasyOCR загружен")
+    return reader
+
+
+def _load_yolo():
+    from ultralytics import YOLO
+    logger.info("Загрузка YOLO...")
+    model = YOLO("yolov8n.pt")  # Nano model for speed
+    logger.info("YOLO загружен")
+    return model
+
+
+_MB = 1024 * 1024
+
+# Оценка памяти модели, пока прирост RSS при загрузке не измерен
+DECLARED_SIZES = {
+    'whisper': 150 * _MB,
+    'whisper:base': 300 * _MB,
+    'whisper:small': 900 * _MB,
+    'blip': 1000 * _MB,
+    'ocr': 400 * _MB,
+    'yolo': 60 * _MB,
+}
+
+
+def _release_memory():
+    """Возвращает память после выгрузки модели"""
+    import gc
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class ModelRegistry:
+    """
+    Потокобезопасный реестр: model_id -> загрузчик / экземпляр.
+
+    Резидентность моделей ограничена бюджетом памяти на процесс:
+        MODEL_MEMORY_BUDGET_MB=3000   # 0 - без ограничения
+        MODEL_IDLE_TIMEOUT=900        # выгрузка после N секунд простоя, 0 - никогда
+        MODEL_PINNED=yolo             # модели, которые никогда не выгружаются
+        MODEL_DEFAULT_SIZE_MB=500     # оценка для моделей без измерения и заявленного размера
+
+    Использование:
+        with ModelRegistry.lease('yolo') as model:
+            ...                # ссылку на model за пределы блока не сохранять
+        ModelRegistry.stats()  # {'models': {'yolo': {'loaded': True, ...}}, ...}
+    """
+    _loaders = {
+        'whisper': _load_whisper,  # tiny - максимальная скорость
+        'whisper:base': functools.partial(_load_whisper, "base"),
+        'whisper:small': functools.partial(_load_whisper, "small"),
+        'blip': _load_blip,
+        'ocr': _load_easyocr,
+        'yolo': _load_yolo,
+    }
+    _models = OrderedDict()  # порядок = LRU (последний - самый свежий)
+    _info = {}
+    _last_used = {}
+    _known_sizes = {}  # RSS последней загрузки, переживает выгрузку
+    _declared_sizes = dict(DECLARED_SIZES)
+    _leases = {}  # model_id -> число открытых аренд
+    _counters = {}
+    _load_locks = {}
+    _lock = threading.Lock()
+
+    budget_bytes = int(float(os.getenv('MODEL_MEMORY_BUDGET_MB', '0')) * 1024 * 1024)
+    idle_timeout = float(os.getenv('MODEL_IDLE_TIMEOUT', '0'))
+    default_size = int(float(os.getenv('MODEL_DEFAULT_SIZE_MB', '500')) * _MB)
+    _pinned = {m.strip() for m in os.getenv('MODEL_PINNED', 'yolo').split(',') if m.strip()}
+    _sweeper = None
+
+    @classmethod
+    def register(cls, model_id, loader, size_bytes=None):
+        """Регистрирует (или заменяет) загрузчик модели; size_bytes - оценка памяти"""
+        with cls._lock:
+            cls._loaders[model_id] = loader
+            if size_bytes is not None:
+                cls._declared_sizes[model_id] = size_bytes
+
+    @classmethod
+    def pin(cls, model_id):
+        """Закрепляет модель: она не вытесняется ни по бюджету, ни по простою"""
+        with cls._lock:
+            cls._pinned.add(model_id)
+
+    @classmethod
+    def unpin(cls, model_id):
+        with cls._lock:
+            cls._pinned.discard(model_id)
+
+    @classmethod
+    def _count(cls, model_id, key, delta=1):
+        # Вызывается под cls._lock
+        counters = cls._counters.setdefault(model_id, {
+            'hits': 0, 'misses': 0, 'loads': 0, 'load_failures': 0,
+            'load_seconds_total': 0.0, 'evictions': 0, 'idle_unloads': 0,
+        })
+        counters[key] += delta
+
+    @classmethod
+    def _load_lock(cls, model_id):
+        with cls._lock:
+            lock = cls._load_locks.get(model_id)
+            if lock is None:
+                lock = cls._load_locks[model_id] = threading.Lock()
+            return lock
+
+    @classmethod
+    def _touch(cls, model_id):
+        # Вызывается под cls._lock
+        cls._models.move_to_end(model_id)
+        cls._last_used[model_id] = time.monotonic()
+
+    @classmethod
+    def get(cls, model_id):
+        """
+        Возвращает экземпляр модели, загружая его при первом обращении.
+        При ошибке загрузки возвращает None (следующий вызов попробует снова).
+        Для вызовов инференса используйте lease(): модель без аренды может
+        быть вытеснена, пока вызывающий код еще держит ссылку.
+        """
+        return cls._acquire(model_id, lease=False)
+
+    @classmethod
+    @contextlib.contextmanager
+    def lease(cls, model_id):
+        """
+        Модель на время блока with (None, если не загрузилась). Пока аренда
+        открыта, модель не вытесняется ни по бюджету, ни по простою.
+        """
+        model = cls._acquire(model_id, lease=True)
+        try:
+            yield model
+        finally:
+            if model is not None:
+                cls._release(model_id)
+
+    @classmethod
+    def _hit(cls, model_id, lease):
+        # Вызывается под cls._lock
+        cls._touch(model_id)
+        cls._count(model_id, 'hits')
+        if lease:
+            cls._leases[model_id] = cls._leases.get(model_id, 0) + 1
+
+    @classmethod
+    def _release(cls, model_id):
+        with cls._lock:
+            count = cls._leases.get(model_id, 0) - 1
+            if count > 0:
+                cls._leases[model_id] = count
+            else:
+                cls._leases.pop(model_id, None)
+            if model_id in cls._models:
+                cls._last_used[model_id] = time.monotonic()  # простой считается с конца вызова
+        # Вытеснение могло быть отложено, пока модель была в аренде
+        cls._enforce_budget()
+
+    @classmethod
+    def _acquire(cls, model_id, lease):
+        with cls._lock:
+            model = cls._models.get(model_id)
+            if model is not None:
+                cls._hit(model_id, lease)
+                return model
+
+        loader = cls._loaders.get(model_id)
+        if loader is None and model_id.startswith('whisper:'):
+            # Любой размер Whisper: 'whisper:medium', 'whisper:large-v3' ...
+            loader = functools.partial(_load_whisper, model_id.split(':', 1)[1])
+            cls.register(model_id, loader)
+        if loader is None:
+            raise KeyError(f"Unknown model id: {model_id}")
+
+        # Блокировка на конкретную модель: остальные модели грузятся независимо
+        with cls._load_lock(model_id):
+            with cls._lock:
+                model = cls._models.get(model_id)
+                if model is not None:
+                    cls._hit(model_id, lease)
+                    return model
+                cls._count(model_id, 'misses')
+
+            # Освобождаем место заранее: измеренный или заявленный размер модели
+            with cls._lock:
+                expected = cls._size(model_id)
+            cls._enforce_budget(extra_bytes=expected, keep=model_id)
+
+            rss_before = _current_rss()
+            started = time.perf_counter()
+            try:
+                model = loader()
+            except Exception as e:
+                logger.error(f"Ошибка загрузки модели '{model_id}': {e}")
+                with cls._lock:
+                    cls._count(model_id, 'load_failures')
+                return None
+            load_seconds = time.perf_counter() - started
+            rss_after = _current_rss()
+
+            # Прирост RSS - приблизительная оценка: параллельная загрузка
+            # другой модели тоже попадает в дельту.
+            rss_delta = None
+            if rss_before is not None and rss_after is not None:
+                rss_delta = max(0, rss_after - rss_before)
+
+            with cls._lock:
+                cls._models[model_id] = model
+                cls._touch(model_id)
+                if lease:
+                    cls._leases[model_id] = cls._leases.get(model_id, 0) + 1
+                cls._info[model_id] = {
+                    'rss_bytes': rss_delta,
+                    'load_seconds': round(load_seconds, 3),
+                    'loaded_at': time.time(),
+                }
+                if rss_delta:
+                    cls._known_sizes[model_id] = rss_delta
+                cls._count(model_id, 'loads')
+                cls._count(model_id, 'load_seconds_total', load_seconds)
+            logger.info(f"Model '{model_id}' loaded in {load_seconds:.2f}s (RSS +{rss_delta})")
+
+        # Оценка могла оказаться заниженной - добиваем бюджет после загрузки
+        cls._enforce_budget(keep=model_id)
+        cls._ensure_sweeper()
+        return model
+
+    @classmethod
+    def _size(cls, model_id):
+        # Вызывается под cls._lock
+        return (
+            cls._known_sizes.get(model_id)
+            or cls._declared_sizes.get(model_id)
+            or cls.default_size
+        )
+
+    @classmethod
+    def _resident_bytes(cls):
+        # Вызывается под cls._lock
+        return sum(cls._size(m) for m in cls._models)
+
+    @classmethod
+    def _enforce_budget(cls, extra_bytes=0, keep=None):
+        """Вытесняет давно не использованные модели, пока не уложимся в бюджет"""
+        if not cls.budget_bytes:
+            return
+        evicted = []
+        with cls._lock:
+            for model_id in list(cls._models):  # от самой старой к самой свежей
+                if cls._resident_bytes() + extra_bytes <= cls.budget_bytes:
+                    break
+                if model_id == keep or model_id in cls._pinned or model_id in cls._leases:
+                    continue
+                cls._drop(model_id)
+                cls._count(model_id, 'evictions')
+                evicted.append(model_id)
+        if evicted:
+            logger.info(f"Models evicted by memory budget: {', '.join(evicted)}")
+            _release_memory()
+
+    @classmethod
+    def _drop(cls, model_id):
+        # Вызывается под cls._lock. Ссылки, удерживаемые вызывающим кодом (get без аренды),
+        # остаются валидными, но не дают освободить память.
+        removed = cls._models.pop(model_id, None)
+        cls._info.pop(model_id, None)
+        cls._last_used.pop(model_id, None)
+        return removed is not None
+
+    @classmethod
+    def unload(cls, model_id):
+        """Выгружает модель вручную"""
+        with cls._lock:
+            removed = cls._drop(model_id)
+        if removed:
+            _release_memory()
+        return removed
+
+    @classmethod
+    def unload_idle(cls):
+        """Выгружает незакрепленные модели, простаивающие дольше idle_timeout"""
+        if not cls.idle_timeout:
+            return []
+        now = time.monotonic()
+        unloaded = []
+        with cls._lock:
+            for model_id, last_used in list(cls._last_used.items()):
+                if model_id in cls._pinned or model_id in cls._leases:
+                    continue
+                if now - last_used >= cls.idle_timeout:
+                    cls._drop(model_id)
+                    cls._count(model_id, 'idle_unloads')
+                    unloaded.append(model_id)
+        if unloaded:
+            logger.info(f"Idle models unloaded: {', '.join(unloaded)}")
+            _release_memory()
+        return unloaded
+
+    @classmethod
+    def _ensure_sweeper(cls):
+        """Фоновый поток выгрузки простаивающих моделей (запускается один раз)"""
+        if not cls.idle_timeout or cls._sweeper is not None:
+            return
+        with cls._lock:
+            if cls._sweeper is not None:
+                return
+            interval = max(1.0, min(cls.idle_timeout / 2, 60.0))
+
+            def sweep():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        cls.unload_idle()
+                    except Exception as e:
+                        logger.error(f"Idle model sweep failed: {e}")
+
+            cls._sweeper = threading.Thread(target=sweep, name="model-idle-sweeper", daemon=True)
+            cls._sweeper.start()
+
+    @classmethod
+    def is_loaded(cls, model_id):
+        return model_id in cls._models
+
+    @classmethod
+    def stats(cls):
+        """Состояние всех известных моделей, счетчики и RSS процесса"""
+        now = time.monotonic()
+        with cls._lock:
+            models = {}
+            for model_id in sorted(cls._loaders):
+                entry = {
+                    'loaded': model_id in cls._models,
+                    'pinned': model_id in cls._pinned,
+                    'leases': cls._leases.get(model_id, 0),
+                    'size_bytes': cls._size(model_id),
+                    **cls._info.get(model_id, {}),
+                    **cls._counters.get(model_id, {}),
+                }
+                if model_id in cls._last_used:
+                    entry['idle_seconds'] = round(now - cls._last_used[model_id], 1)
+                models[model_id] = entry
+            resident = cls._resident_bytes()
+        return {
+            'process_rss_bytes': _current_rss(),
+            'resident_model_bytes': resident,
+            'budget_bytes': cls.budget_bytes or None,
+            'idle_timeout': cls.idle_timeout or None,
+            'models': models,
+        }
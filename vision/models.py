@@ -1,5 +1,8 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
+from .unit_of_work import UnitOfWork
+from .quota import QuotaManager
 
 class User(AbstractUser):
     """Расширенная модель пользователя для WayFinder"""
@@ -22,7 +25,7 @@ class User(AbstractUser):
     
     # Лимиты
     daily_requests_count = models.IntegerField(default=0)
-    last_request_date = models.DateField(auto_now=True)
+    last_request_date = models.DateField(blank=True, null=True)  # Ставится явно в vision.quota
     
     # Настройки
     preferred_language = models.CharField(max_length=5, default='ru')
@@ -40,28 +43,16 @@ class User(AbstractUser):
         return self.username
     
     def can_make_request(self):
-        """Проверка лимитов запросов"""
-        from datetime import date
-        
-        # Сброс счетчика если новый день
-        if self.last_request_date != date.today():
-            self.daily_requests_count = 0
-            self.save()
-        
-        # Лимиты по типу подписки
-        limits = {
-            'free': 10,
-            'premium': 999999,  # Безлимит
-            'pro': 999999,
-        }
-        
-        return self.daily_requests_count < limits.get(self.subscription_type, 10)
+        """Проверка лимитов запросов (кэш процесса, см. vision.quota)"""
+        return QuotaManager.can_make_request(self)
+
+    async def acan_make_request(self):
+        """can_make_request() для async-представлений"""
+        return await QuotaManager.acan_make_request(self)
     
     def increment_request_count(self):
-        """Увеличить счетчик запросов"""
-        self.daily_requests_count += 1
-        self.total_requests += 1
-        self.save()
+        """Увеличить счетчик запросов (атомарный UPDATE)"""
+        QuotaManager.consume(self)
 
 class VisionUser(models.Model):
     """
@@ -69,7 +60,7 @@ class VisionUser(models.Model):
     """
     telegram_id = models.CharField(max_length=100, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    context = models.TextField(blank=True, null=True) # Хранение истории переписки (JSON или текст)
+    context = models.TextField(blank=True, null=True) # Legacy: история теперь в ConversationMessage
     
     # CAG System: Персональные факты и состояние пользователя
     facts = models.JSONField(default=dict, blank=True, null=True)
@@ -81,25 +72,43 @@ class VisionUser(models.Model):
         return f"VisionUser {self.telegram_id}"
 
     def add_message(self, role, content):
-        """Добавить сообщение в контекст"""
-        import json
-        try:
-            history = json.loads(self.context) if self.context else []
-        except:
-            history = []
+        """Добавить сообщение в историю (одна вставка строки, без перезаписи пользователя)"""
+        message = ConversationMessage(vision_user=self, role=role, content=content)
+        unit = UnitOfWork.current()
+        if unit is not None:
+            unit.add(message)
+        else:
+            message.save()
         
-        # Ограничиваем историю
-        if len(history) > 20: 
-            history = history[-20:]
-            
-        history.append({"role": role, "content": content})
-        self.context = json.dumps(history, ensure_ascii=False)
-        self.save()
-        
-    def get_context(self):
-        """Получить историю как список словарей"""
-        import json
-        try:
-            return json.loads(self.context) if self.context else []
-        except:
-            return []
+    def get_context(self, limit=None):
+        """Получить последние сообщения истории как список словарей (от старых к новым)"""
+        limit = limit or ConversationMessage.CONTEXT_LIMIT
+        rows = list(
+            ConversationMessage.objects
+            .filter(vision_user=self)
+            .order_by('-created_at', '-id')
+            .values('role', 'content')[:limit]
+        )
+        rows.reverse()
+        return rows
+
+class ConversationMessage(models.Model):
+    """
+    Реплика диалога. Append-only: новая реплика - одна вставка,
+    последние N реплик читаются по индексу (vision_user, created_at).
+    """
+    CONTEXT_LIMIT = 21  # Как раньше: 20 последних + новое сообщение
+
+    vision_user = models.ForeignKey(VisionUser, on_delete=models.CASCADE, related_name='messages')
+    role = models.CharField(max_length=20)
+    content = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'conversation_messages'
+        indexes = [
+            models.Index(fields=['vision_user', 'created_at'], name='conv_msg_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}"
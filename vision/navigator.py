@@ -0,0 +1,124 @@
+"""
+Словари и фразы режима навигатора (общие для HTTP-навигатора и сессии очков).
+"""
+
+
+# Маппинг классов на русский
+CLASS_NAMES_RU = {
+    'person': 'человек',
+    'bicycle': 'велосипед',
+    'car': 'автомобиль',
+    'motorcycle': 'мотоцикл',
+    'airplane': 'самолет',
+    'bus': 'автобус',
+    'train': 'поезд',
+    'truck': 'грузовик',
+    'boat': 'лодка',
+    'traffic light': 'светофор',
+    'fire hydrant': 'пожарный гидрант',
+    'stop sign': 'знак стоп',
+    'parking meter': 'парвокочный автомат',
+    'bench': 'скамейка',
+    'bird': 'птица',
+    'cat': 'кошка',
+    'dog': 'собака',
+    'horse': 'лошадь',
+    'sheep': 'овца',
+    'cow': 'корова',
+    'elephant': 'слон',
+    'bear': 'медведь',
+    'zebra': 'зебра',
+    'giraffe': 'жираф',
+    'backpack': 'рюкзак',
+    'umbrella': 'зонтик',
+    'handbag': 'сумка',
+    'tie': 'галстук',
+    'suitcase': 'чемодан',
+    'frisbee': 'фрисби',
+    'skis': 'лыжи',
+    'snowboard': 'сноуборд',
+    'sports ball': 'мяч',
+    'kite': 'воздушный змей',
+    'baseball bat': 'бейсбольная бита',
+    'baseball glove': 'бейсбольная перчатка',
+    'skateboard': 'скейтборд',
+    'surfboard': 'серфборд',
+    'tennis racket': 'теннисная ракетка',
+    'bottle': 'бутылка',
+    'wine glass': 'бокал вина',
+    'cup': 'чашка',
+    'fork': 'вилка',
+    'knife': 'нож',
+    'spoon': 'ложка',
+    'bowl': 'миска',
+    'banana': 'банан',
+    'apple': 'яблоко',
+    'sandwich': 'сэндвич',
+    'orange': 'апельсин',
+    'broccoli': 'брокколи',
+    'carrot': 'морковь',
+    'hot dog': 'хот-дог',
+    'pizza': 'пицца',
+    'donut': 'пончик',
+    'cake': 'торт',
+    'chair': 'стул',
+    'couch': 'диван',
+    'potted plant': 'растение в горшке',
+    'bed': 'кровать',
+    'dining table': 'обеденный стол',
+    'toilet': 'туалет',
+    'tv': 'телевизор',
+    'laptop': 'ноутбук',
+    'mouse': 'мышь',
+    'remote': 'пульт',
+    'keyboard': 'клавиатура',
+    'cell phone': 'телефон',
+    'microwave': 'микроволновка',
+    'oven': 'печь',
+    'toaster': 'тостер',
+    'sink': 'раковина',
+    'refrigerator': 'холодильник',
+    'book': 'книга',
+    'clock': 'часы',
+    'vase': 'ваза',
+    'scissors': 'ножницы',
+    'teddy bear': 'плюшевый мишка',
+    'hair drier': 'фен',
+    'toothbrush': 'зубная щетка'
+}
+
+def ru_names(class_names):
+    """Уникальные русские названия классов в порядке обнаружения"""
+    names = []
+    for class_name in class_names:
+        ru_name = CLASS_NAMES_RU.get(class_name, class_name)
+        if ru_name not in names:
+            names.append(ru_name)
+    return names
+
+
+POSITIONS_RU = {'left': 'слева', 'center': 'впереди', 'right': 'справа'}
+
+
+def navigator_message(events):
+    """Фраза для озвучки событий трекера: сначала приближение, затем новые и пропавшие"""
+    def names(kind, with_position=True):
+        result = []
+        for event in events:
+            if event['event'] != kind:
+                continue
+            name = CLASS_NAMES_RU.get(event['class'], event['class'])
+            if with_position:
+                name = f"{name} {POSITIONS_RU[event['position']]}"
+            if name not in result:
+                result.append(name)
+        return ", ".join(result)
+
+    parts = []
+    for kind, title, with_position in (('approaching', 'Приближается', True),
+                                       ('new', 'Новое', True),
+                                       ('gone', 'Исчезло', False)):
+        text = names(kind, with_position)
+        if text:
+            parts.append(f"{title}: {text}.")
+    return " ".join(parts)
@@ -0,0 +1,105 @@
+"""
+Общий конвейер ответа после распознавания: история, LLM (+CAG), счетчик, TTS.
+
+Используется SmartAnalyzeView (HTTP / SSE) и WebSocket-эндпоинтами, чтобы
+финальная расшифровка шла ровно по тому же пути, что и обычный запрос.
+"""
+from asgiref.sync import sync_to_async
+
+from .services import (
+    generate_ai_response_async, generate_ai_response_stream,
+    split_sentences, speak_sentences, text_to_speech_async, read_text_local,
+)
+from .executors import run_inference
+from .unit_of_work import UnitOfWork
+
+OCR_TRIGGERS = ('читай', 'прочти', 'текст', 'написано', 'цифры')
+
+
+def wants_ocr(text):
+    text = (text or '').lower()
+    return any(w in text for w in OCR_TRIGGERS)
+
+
+async def maybe_read_text(frame, text):
+    """OCR нужна только по запросу пользователя"""
+    if frame is None or not wants_ocr(text):
+        return None
+    return await run_inference('ocr', read_text_local, frame)
+
+
+def _record_turn(text_input, response_text, vision_user=None, user=None):
+    """История диалога и счетчик запросов (в активном UnitOfWork - отложенно)"""
+    if vision_user:
+        vision_user.add_message("user", text_input)
+        vision_user.add_message("assistant", response_text)
+    # Увеличиваем счетчик для аутентифицированных пользователей
+    if user:
+        user.increment_request_count()
+
+
+async def _save_turn(text_input, response_text, vision_user=None, user=None):
+    """
+    Запись хода диалога из async-кода: в UnitOfWork вызывающего (SmartAnalyzeView),
+    а без него (WebSocket, SSE после выхода из view) - своей транзакцией в потоке.
+    """
+    if UnitOfWork.current() is not None:
+        _record_turn(text_input, response_text, vision_user, user)
+        return
+
+    def persist():
+        with UnitOfWork():
+            _record_turn(text_input, response_text, vision_user, user)
+
+    await sync_to_async(persist)()
+
+
+async def chat_reply(text_input, vision_user=None, user=None, visual_description=None, ocr_text=None):
+    """
+    Полный ответ: (response_text, audio_bytes).
+    Записи в БД отложены, если вызывающий открыл UnitOfWork.
+    """
+    response_text = await generate_ai_response_async(
+        text_input,
+        visual_context=visual_description,
+        user_obj=vision_user if vision_user else None,
+        ocr_context=ocr_text
+    )
+    await _save_turn(text_input, response_text, vision_user, user)
+
+    speed = user.voice_speed if user else 1.0
+    audio_content = await text_to_speech_async(response_text, speed=speed)
+    return response_text, audio_content
+
+
+async def stream_chat_reply(text_input, vision_user=None, user=None, visual_description=None, ocr_text=None):
+    """
+    Потоковый ответ: асинхронный генератор (event, data).
+    ('text', {'seq', 'message'}) и ('audio', {'seq', 'part', 'audio'}) - чанки аудио
+    предложения seq по мере синтеза (склеиваются по порядку part),
+    в конце ('done', {'message', 'segments'}). История и счетчик пишутся одной
+    транзакцией после того, как клиент получил весь ответ.
+    """
+    speed = user.voice_speed if user else 1.0
+    fragments = generate_ai_response_stream(
+        text_input,
+        visual_context=visual_description,
+        user_obj=vision_user if vision_user else None,
+        ocr_context=ocr_text
+    )
+
+    sentences = []
+    part = 0
+    async for kind, data in speak_sentences(split_sentences(fragments), speed=speed):
+        if kind == 'text':
+            sentences.append(data)
+            part = 0
+            yield 'text', {'seq': len(sentences) - 1, 'message': data}
+        elif data:
+            yield 'audio', {'seq': len(sentences) - 1, 'part': part, 'audio': data}
+            part += 1
+
+    response_text = " ".join(sentences)
+    await _save_turn(text_input, response_text, vision_user, user)
+
+    yield 'done', {'message': response_text, 'segments': len(sentences)}
@@ -0,0 +1,180 @@
+"""
+Дневные лимиты запросов по тарифам.
+
+Единственный источник лимитов - PLAN_LIMITS. Счетчик меняется одним атомарным
+UPDATE (F()-выражения), без read-modify-write и полного save() строки пользователя,
+поэтому параллельные запросы не теряют инкременты. Смена дня ленивая: если
+last_request_date не сегодня, счетчик считается нулевым, а UPDATE сам
+начинает его с 1 - отдельной записи для сброса нет.
+
+Проверка лимита в пределах QUOTA_CACHE_TTL не ходит в БД (кэш процесса); после
+истечения счетчик перечитывается одним values()-запросом - объект пользователя
+из IdentityCache может быть старше, а другие процессы тоже тратят квоту.
+Инкремент - один условный UPDATE: строка, уже упершаяся в лимит (например,
+параллельными запросами в других процессах), не обновляется, и остаток в кэше
+обнуляется.
+
+Настройки:
+    QUOTA_CACHE_TTL=5   # секунд
+"""
+import os
+import time
+import threading
+
+import logging
+
+from asgiref.sync import sync_to_async
+from django.db.models import F, Q, Case, When, Value
+from django.utils import timezone
+
+from .unit_of_work import run_or_defer
+
+logger = logging.getLogger(__name__)
+
+PLAN_LIMITS = {
+    'free': 10,
+    'premium': 999999,  # Безлимит
+    'pro': 999999,
+}
+DEFAULT_PLAN = 'free'
+
+
+def plan_limit(subscription_type):
+    return PLAN_LIMITS.get(subscription_type, PLAN_LIMITS[DEFAULT_PLAN])
+
+
+def used_today(user, today=None):
+    """Использовано сегодня (с учетом ленивой смены дня)"""
+    today = today or timezone.localdate()
+    if user.last_request_date != today:
+        return 0
+    return user.daily_requests_count
+
+
+class QuotaManager:
+    """
+    Использование:
+        if not await QuotaManager.acan_make_request(user): ...  # 0 запросов к БД (1 после TTL)
+        QuotaManager.consume(user)                              # 1 условный UPDATE
+        QuotaManager.status(user)                         # для /api/auth/check-limits/
+    """
+    _cache = {}  # user_pk -> (day, used, expires)
+    _lock = threading.Lock()
+    _ttl = float(os.getenv('QUOTA_CACHE_TTL', '5'))
+
+    @classmethod
+    def _cached_used(cls, user, today):
+        with cls._lock:
+            entry = cls._cache.get(user.pk)
+        if entry is None or entry[0] != today or entry[2] < time.monotonic():
+            return None
+        return entry[1]
+
+    @classmethod
+    def _remember(cls, user, today, used):
+        with cls._lock:
+            cls._cache[user.pk] = (today, used, time.monotonic() + cls._ttl)
+
+    @classmethod
+    def _read_used(cls, user, today):
+        """Свежий счетчик из БД (одним values()); объект в памяти тоже обновляется"""
+        row = (user.__class__._default_manager.filter(pk=user.pk)
+               .values('daily_requests_count', 'last_request_date').first())
+        if row is not None:
+            user.daily_requests_count = row['daily_requests_count']
+            user.last_request_date = row['last_request_date']
+        return used_today(user, today)
+
+    @classmethod
+    def used(cls, user):
+        today = timezone.localdate()
+        cached = cls._cached_used(user, today)
+        if cached is not None:
+            return cached
+        used = cls._read_used(user, today)
+        cls._remember(user, today, used)
+        return used
+
+    @classmethod
+    async def aused(cls, user):
+        """used() для async-кода: в пределах TTL без перехода в поток"""
+        cached = cls._cached_used(user, timezone.localdate())
+        if cached is not None:
+            return cached
+        return await sync_to_async(cls.used)(user)
+
+    @classmethod
+    def remaining(cls, user):
+        return max(0, plan_limit(user.subscription_type) - cls.used(user))
+
+    @classmethod
+    def can_make_request(cls, user):
+        return cls.remaining(user) > 0
+
+    @classmethod
+    async def acan_make_request(cls, user):
+        return await cls.aused(user) < plan_limit(user.subscription_type)
+
+    @classmethod
+    def consume(cls, user):
+        """
+        +1 к дневному и общему счетчику одним UPDATE.
+        Внутри UnitOfWork выполняется при его сбросе (в той же транзакции).
+        UPDATE условный: если за сегодня лимит уже выбран, строка не меняется
+        (0 строк) и пользователь до конца TTL считается исчерпавшим квоту.
+        """
+        today = timezone.localdate()
+        limit = plan_limit(user.subscription_type)
+        used = used_today(user, today) + 1
+
+        # Объект в памяти обновляем сразу - его могут читать дальше в запросе
+        user.daily_requests_count = used
+        user.total_requests += 1
+        user.last_request_date = today
+        cls._remember(user, today, used)
+
+        pk = user.pk
+        manager = user.__class__._default_manager
+
+        def update():
+            # update() не трогает auto_now - даты ставим явно
+            updated = manager.filter(pk=pk).filter(
+                ~Q(last_request_date=today) | Q(daily_requests_count__lt=limit)
+            ).update(
+                daily_requests_count=Case(
+                    When(last_request_date=today, then=F('daily_requests_count') + 1),
+                    default=Value(1),
+                ),
+                total_requests=F('total_requests') + 1,
+                last_request_date=today,
+                updated_at=timezone.now(),
+            )
+            if not updated:
+                # Лимит выбран параллельными запросами (в т.ч. других процессов)
+                logger.warning(f"Quota exceeded for user {pk}: request not counted")
+                user.daily_requests_count = limit
+                user.total_requests -= 1
+                cls._remember(user, today, limit)
+
+        run_or_defer(update)
+
+    @classmethod
+    def status(cls, user):
+        limit = plan_limit(user.subscription_type)
+        used = cls.used(user)
+        return {
+            'can_make_request': used < limit,
+            'subscription_type': user.subscription_type,
+            'daily_limit': limit,
+            'requests_used': used,
+            'requests_remaining': max(0, limit - used),
+            'total_requests': user.total_requests,
+        }
+
+    @classmethod
+    def invalidate(cls, user_pk=None):
+        with cls._lock:
+            if user_pk is None:
+                cls._cache.clear()
+            else:
+                cls._cache.pop(user_pk, None)
@@ -0,0 +1,241 @@
+"""
+Кэш ответов LLM для повторяющихся вопросов над тем же визуальным контекстом.
+
+"Что изображено?" над закэшированной подписью BLIP или одинаковые запросы на
+чтение текста раньше каждый раз уходили в DeepSeek. Ключ кэша - нормализованный
+текст пользователя + visual_context + ocr_context + значимое состояние CAG,
+с разделением по пользователю. Личные и меняющие состояние реплики
+("меня зовут...", "я устал") не кэшируются.
+
+Два уровня:
+    - в памяти процесса (LRU + TTL);
+    - опционально SQLite-файл, общий для всех ASGI воркеров (LLM_CACHE_SQLITE_PATH).
+
+Настройки:
+    LLM_CACHE_ENABLED=True
+    LLM_CACHE_TTL=300
+    LLM_CACHE_SIZE=1000
+    LLM_CACHE_SQLITE_PATH=/var/cache/wayfinder/llm_cache.sqlite3
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Реплики, ответ на которые зависит от пользователя, времени или меняет состояние CAG.
+# Основы сравниваются с началом слова ("устал" -> "устала"), короткие слова - только
+# целиком: иначе "рад" совпадает с "радио", а "время" - с "временный".
+_PERSONAL_STEMS = (
+    'меня зовут', 'запомни', 'устал', 'спать', 'нет сил', 'круто', 'спасибо', 'привет',
+    'который час', 'сколько времени', 'сегодня', 'завтра', 'вчера',
+)
+_PERSONAL_WORDS = frozenset((
+    'мой', 'моя', 'мое', 'мои', 'меня', 'рад', 'рада', 'рады', 'старт', 'время',
+))
+
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """'  Что изображено?! ' -> 'что изображено'"""
+    text = (text or '').lower().replace('ё', 'е')
+    text = _PUNCTUATION.sub(' ', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def is_cacheable(text):
+    """False для личных/stateful реплик, которые нельзя отдавать из кэша"""
+    normalized = normalize_text(text)
+    if not normalized:
+        return False
+    if not _PERSONAL_WORDS.isdisjoint(normalized.split()):
+        return False
+    padded = f" {normalized}"
+    return not any(f" {stem}" in padded for stem in _PERSONAL_STEMS)
+
+
+class ResponseCache:
+    """
+    Использование:
+        key = ResponseCache.key(user_text, visual_context, ocr_context, facts, scope)
+        answer = await cache.aget(key)
+        await cache.aset(key, answer)
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, ttl=300.0, max_entries=1000, sqlite_path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+        self._memory = OrderedDict()  # key -> (answer, expires)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'stores': 0, 'skipped': 0}
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls(
+                        ttl=float(os.getenv('LLM_CACHE_TTL', '300')),
+                        max_entries=int(os.getenv('LLM_CACHE_SIZE', '1000')),
+                        sqlite_path=os.getenv('LLM_CACHE_SQLITE_PATH') or None,
+                    )
+        return cls._default
+
+    @staticmethod
+    def enabled():
+        return os.getenv('LLM_CACHE_ENABLED', 'True') == 'True'
+
+    @staticmethod
+    def key(user_text, visual_context=None, ocr_context=None, facts=None, scope=None, model_name=None):
+        facts = facts or {}
+        # Только то состояние CAG, что реально попадает в промпт
+        cag_state = {k: facts.get(k) for k in ('name', 'interests', 'mood')}
+        raw = json.dumps([
+            scope or '*',
+            model_name,
+            normalize_text(user_text),
+            visual_context or '',
+            ocr_context or '',
+            cag_state,
+        ], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def skip(self):
+        with self._lock:
+            self._stats['skipped'] += 1
+
+    # --- in-process tier ---
+
+    def _memory_get(self, key, now):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return entry[0]
+
+    def _memory_set(self, key, answer, expires):
+        with self._lock:
+            self._memory[key] = (answer, expires)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    # --- shared SQLite tier ---
+
+    def _connection(self):
+        # Вызывается под self._db_lock
+        if self._db is None:
+            self._db = sqlite3.connect(self.sqlite_path, timeout=1.0, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)')
+        return self._db
+
+    def _shared_get(self, key, now):
+        try:
+            with self._db_lock:
+                db = self._connection()
+                row = db.execute('SELECT answer, expires FROM llm_cache WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                if row[1] < now:
+                    db.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                    db.commit()
+                    return None
+                db.execute('UPDATE llm_cache SET accessed = ? WHERE key = ?', (now, key))
+                db.commit()
+                return row
+        except sqlite3.Error as e:
+            logger.warning(f"LLM cache (sqlite) read failed: {e}")
+            return None
+
+    def _shared_set(self, key, answer, expires, now):
+        try:
+            with self._db_lock:
+                db = self._connection()
+                db.execute(
+                    'INSERT OR REPLACE INTO llm_cache (key, answer, expires, accessed) VALUES (?, ?, ?, ?)',
+                    (key, answer, expires, now),
+                )
+                # LRU-граница общего уровня
+                db.execute(
+                    'DELETE FROM llm_cache WHERE expires < ? OR key IN ('
+                    'SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (now, self.max_entries),
+                )
+                db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"LLM cache (sqlite) write failed: {e}")
+
+    # --- public API ---
+
+    def get(self, key):
+        now = time.time()
+        answer = self._memory_get(key, now)
+        if answer is not None:
+            with self._lock:
+                self._stats['memory_hits'] += 1
+            return answer
+
+        if self.sqlite_path:
+            row = self._shared_get(key, now)
+            if row is not None:
+                self._memory_set(key, row[0], row[1])
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                return row[0]
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, key, answer):
+        now = time.time()
+        expires = now + self.ttl
+        self._memory_set(key, answer, expires)
+        if self.sqlite_path:
+            self._shared_set(key, answer, expires, now)
+        with self._lock:
+            self._stats['stores'] += 1
+
+    async def aget(self, key):
+        if not self.sqlite_path:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key, answer):
+        if not self.sqlite_path:
+            return self.set(key, answer)
+        return await asyncio.to_thread(self.set, key, answer)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+        stats['shared_tier'] = bool(self.sqlite_path)
+        lookups = stats['memory_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = (
+            round((stats['memory_hits'] + stats['shared_hits']) / lookups, 3) if lookups else None
+        )
+        return stats
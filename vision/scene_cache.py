@@ -0,0 +1,172 @@
+"""
+Кэш сцен по перцептивному хэшу кадра.
+
+Очки присылают почти одинаковые кадры много раз в минуту. Для каждого кадра
+считается dHash (64 бита), и если в кэше есть кадр с расстоянием Хэмминга
+не больше порога, возвращается готовая подпись BLIP / результат YOLO.
+Одинаковые кадры, пришедшие одновременно, обслуживаются одним инференсом.
+
+Настройки:
+    SCENE_CACHE_THRESHOLD=5   # макс. расстояние Хэмминга (0 - только точное совпадение)
+    SCENE_CACHE_TTL=60        # секунд
+    SCENE_CACHE_SIZE=512      # записей на кэш (LRU)
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_SCOPE = '*'
+
+
+class SceneCache:
+    """
+    LRU-кэш результатов инференса с ключом (scope, dhash).
+
+    Запись ищется сначала среди кадров пользователя, затем в глобальной области.
+
+    Использование:
+        caption = SceneCache.captions().get_or_compute(frame, compute, user_id)
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, name, threshold=5, ttl=60.0, max_entries=512):
+        self.name = name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (scope, hash) -> (value, created, compute_seconds)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'saved_seconds': 0.0}
+
+    @classmethod
+    def named(cls, name):
+        cache = cls._instances.get(name)
+        if cache is None:
+            with cls._instances_lock:
+                cache = cls._instances.get(name)
+                if cache is None:
+                    cache = cls._instances[name] = cls(
+                        name,
+                        threshold=int(os.getenv('SCENE_CACHE_THRESHOLD', '5')),
+                        ttl=float(os.getenv('SCENE_CACHE_TTL', '60')),
+                        max_entries=int(os.getenv('SCENE_CACHE_SIZE', '512')),
+                    )
+        return cache
+
+    @classmethod
+    def captions(cls):
+        return cls.named('blip')
+
+    @classmethod
+    def detections(cls):
+        return cls.named('yolo')
+
+    def _lookup(self, scope, frame_hash, now):
+        # Вызывается под self._lock
+        exact = self._entries.get((scope, frame_hash))
+        if exact is not None and now - exact[1] <= self.ttl:
+            self._entries.move_to_end((scope, frame_hash))
+            return exact
+
+        best_key, best_distance = None, None
+        expired = []
+        for key, entry in self._entries.items():
+            if key[0] != scope:
+                continue
+            if now - entry[1] > self.ttl:
+                expired.append(key)
+                continue
+            distance = (key[1] ^ frame_hash).bit_count()
+            if distance <= self.threshold and (best_distance is None or distance < best_distance):
+                best_key, best_distance = key, distance
+        for key in expired:
+            del self._entries[key]
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key]
+
+    def _store(self, scopes, frame_hash, value, compute_seconds):
+        now = time.monotonic()
+        with self._lock:
+            for scope in scopes:
+                self._entries[(scope, frame_hash)] = (value, now, compute_seconds)
+                self._entries.move_to_end((scope, frame_hash))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, frame, compute, user_id=None):
+        """
+        Возвращает закэшированный результат для похожего кадра или вызывает
+        compute(). Исключения compute() не кэшируются и пробрасываются всем
+        ожидающим.
+        """
+        frame_hash = frame.dhash
+        scopes = [GLOBAL_SCOPE] if not user_id else [str(user_id), GLOBAL_SCOPE]
+        now = time.monotonic()
+
+        with self._lock:
+            for scope in scopes:
+                entry = self._lookup(scope, frame_hash, now)
+                if entry is not None:
+                    self._stats['hits'] += 1
+                    self._stats['saved_seconds'] += entry[2]
+                    return entry[0]
+
+            inflight = self._inflight.get(frame_hash)
+            if inflight is None:
+                owner = True
+                inflight = self._inflight[frame_hash] = Future()
+                self._stats['misses'] += 1
+            else:
+                owner = False
+                self._stats['coalesced'] += 1
+
+        if not owner:
+            return inflight.result()
+
+        started = time.perf_counter()
+        try:
+            value = compute()
+        except BaseException as e:
+            # В т.ч. отмена/KeyboardInterrupt: ожидающие не должны зависнуть на Future
+            with self._lock:
+                self._inflight.pop(frame_hash, None)
+            if isinstance(e, Exception):
+                inflight.set_exception(e)
+            else:
+                inflight.set_exception(RuntimeError(f"Scene computation interrupted: {e!r}"))
+            raise
+        compute_seconds = time.perf_counter() - started
+
+        self._store(scopes, frame_hash, value, compute_seconds)
+        with self._lock:
+            self._inflight.pop(frame_hash, None)
+        inflight.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_ratio'] = round((stats['hits'] + stats['coalesced']) / lookups, 3) if lookups else None
+        stats['saved_seconds'] = round(stats['saved_seconds'], 2)
+        return stats
+
+    @classmethod
+    def all_stats(cls):
+        with cls._instances_lock:
+            caches = dict(cls._instances)
+        return {name: cache.stats() for name, cache in caches.items()}
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from rest_framework.authtoken.models import Token
+from .quota import QuotaManager
 
 User = get_user_model()
 
@@ -48,6 +49,15 @@ class UserProfileSerializer(serializers.ModelSerializer):
                            'daily_requests_count', 'total_requests', 'created_at']
     
     def get_requests_remaining(self, obj):
-        limits = {'free': 10, 'premium': 999999, 'pro': 999999}
-        limit = limits.get(obj.subscription_type, 10)
-        return max(0, limit - obj.daily_requests_count)
+        return QuotaManager.remaining(obj)
+
+    def update(self, instance, validated_data):
+        """
+        Пишем только изменяемые поля: request.user может быть экземпляром из
+        IdentityCache со старыми счетчиками, и полный save() затер бы инкременты
+        квоты, сделанные атомарным UPDATE (vision.quota) в других процессах.
+        """
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
@@ -1,180 +1,189 @@
 import os
+import time
 import asyncio
-import base64
 import torch
-from faster_whisper import WhisperModel
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
-from io import BytesIO
-from openai import AsyncOpenAI
-import edge_tts
 import logging
-import easyocr
-import numpy as np
-from ultralytics import YOLO
-from asgiref.sync import sync_to_async
 from asgiref.sync import sync_to_async
+from .model_registry import ModelRegistry
+from .batching import DetectionBatcher
+from .frames import Frame
+from .scene_cache import SceneCache
+from .llm_client import get_llm_client, PromptCacheStats
+from .response_cache import ResponseCache, is_cacheable
+from .unit_of_work import UnitOfWork
+from .stt_profiles import Transcript, resolve_stt_profile, VAD_MIN_SILENCE_MS
 
 logger = logging.getLogger(__name__)
 
 class LocalBrain:
-    _stt_model = None
-    _vision_model = None
-    _vision_processor = None
-    _ocr_reader = None
-    _yolo_model = None
-    
+    """
+    Доступ к локальным моделям. Сами экземпляры живут в общем ModelRegistry,
+    поэтому /api/detect/ и режим навигатора используют одну и ту же YOLO.
+    Модели выдаются в аренду на время вызова:
+        with LocalBrain.yolo_model() as model:
+            ...
+    """
+
     @classmethod
-    def get_stt_model(cls):
-        if cls._stt_model is None:
-            print("⏳ Загрузка модели Whisper (STT)...")
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            compute_type = "float16" if device == "cuda" else "int8"
-            
-            try:
-                # Используем tiny модель для скорости (max speed)
-                cls._stt_model = WhisperModel("tiny", device=device, compute_type=compute_type)
-                print(f"✅ Whisper (tiny) загружен на {device}")
-            except Exception as e:
-                print(f"❌ Ошибка загрузки Whisper: {e}")
-                cls._stt_model = WhisperModel("tiny", device="cpu", compute_type="int8")
-        return cls._stt_model
+    def stt_model(cls):
+        return ModelRegistry.lease('whisper')
 
     @classmethod
-    def get_vision_model(cls):
-        if cls._vision_model is None:
-            print("⏳ Загрузка модели Vision (BLIP)...")
-            try:
-                cls._vision_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-                cls._vision_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-                
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-                cls._vision_model.to(device)
-                print(f"✅ Vision модель загружена на {device}")
-            except Exception as e:
-                print(f"❌ Ошибка загрузки Vision: {e}")
-        return cls._vision_processor, cls._vision_model
+    def vision_model(cls):
+        """(processor, model) или None"""
+        return ModelRegistry.lease('blip')
 
     @classmethod
-    def get_ocr_reader(cls):
-        if cls._ocr_reader is None:
-             print("⏳ Загрузка EasyOCR...")
-             # Инициализируем только русский и английский
-             cls._ocr_reader = easyocr.Reader(['ru', 'en'], gpu=torch.cuda.is_available())
-             print("✅ EasyOCR загружен")
-        return cls._ocr_reader
+    def ocr_reader(cls):
+        return ModelRegistry.lease('ocr')
 
     @classmethod
-    def get_yolo_model(cls):
-        if cls._yolo_model is None:
-            print("⏳ Загрузка YOLO...")
-            try:
-                cls._yolo_model = YOLO("yolov8n.pt") # Nano model for speed
-                print("✅ YOLO загружен")
-            except Exception as e:
-                 print(f"❌ Ошибка загрузки YOLO: {e}")
-        return cls._yolo_model
-
-def speech_to_text(audio_file):
-    model = LocalBrain.get_stt_model()
-    if not model:
-        return None
-    try:
-        segments, info = model.transcribe(audio_file, beam_size=5)
-        text = " ".join([segment.text for segment in segments])
-        return text.strip()
-    except Exception as e:
-        logger.error(f"STT Error: {e}")
-        return None
+    def yolo_model(cls):
+        return ModelRegistry.lease('yolo')
 
-def analyze_image_local(image_bytes):
-    processor, model = LocalBrain.get_vision_model()
-    if not model:
-        return "Ошибка загрузки зрения."
-    try:
-        image = Image.open(BytesIO(image_bytes)).convert('RGB')
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        inputs = processor(images=image, return_tensors="pt").to(device)
-        out = model.generate(**inputs, max_new_tokens=50)
-        description = processor.decode(out[0], skip_special_tokens=True)
-        return description
-    except Exception as e:
-        logger.error(f"Vision Error: {e}")
-        return "Не удалось распознать изображение."
+def transcribe_audio(audio_file, profile=None, language=None):
+    """
+    Распознает речь по профилю (см. stt_profiles). Возвращает Transcript или None.
+    audio_file - файл-контейнер или float32 numpy 16 кГц моно (см. audio_input).
+    language=None - автоопределение языка.
+    """
+    profile = profile or resolve_stt_profile()
+    with ModelRegistry.lease(profile.model_id) as model:
+        if not model:
+            return None
+        try:
+            started = time.perf_counter()
+            segments, info = model.transcribe(
+                audio_file,
+                beam_size=profile.beam_size,
+                language=language,
+                vad_filter=profile.vad,  # Silero VAD: тишина в начале/конце записи не декодируется
+                vad_parameters={"min_silence_duration_ms": VAD_MIN_SILENCE_MS} if profile.vad else None,
+                condition_on_previous_text=False,  # короткие реплики, контекст не нужен
+            )
+            # segments - генератор: распознавание идет при итерации
+            text = " ".join([segment.text for segment in segments]).strip()
+            elapsed = time.perf_counter() - started
+        except Exception as e:
+            logger.error(f"STT Error: {e}")
+            return None
 
-def read_text_local(image_bytes):
-    reader = LocalBrain.get_ocr_reader()
-    try:
-        result = reader.readtext(image_bytes, detail=0)
-        text = " ".join(result)
-        return text if text else None
-    except Exception as e:
-        logger.error(f"OCR Error: {e}")
-        return None
+    audio_seconds = info.duration or 0.0
+    speech_seconds = getattr(info, 'duration_after_vad', None) or audio_seconds
+    transcript = Transcript(
+        text=text,
+        profile=profile.name,
+        language=info.language,
+        audio_seconds=audio_seconds,
+        speech_seconds=speech_seconds,
+        elapsed=elapsed,
+        rtf=elapsed / audio_seconds if audio_seconds else None,
+    )
+    logger.info(
+        f"STT [{profile.name}] {audio_seconds:.1f}s audio ({speech_seconds:.1f}s speech) "
+        f"in {elapsed:.2f}s, RTF={transcript.rtf or 0:.2f}"
+    )
+    return transcript
+
+def speech_to_text(audio_file, profile=None, language=None):
+    transcript = transcribe_audio(audio_file, profile, language)
+    return transcript.text if transcript else None
+
+def _caption_frame(processor, model, frame):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # BLIP processor принимает RGB numpy напрямую, без PIL и повторного декодирования
+    inputs = processor(images=frame.rgb, return_tensors="pt").to(device)
+    out = model.generate(**inputs, max_new_tokens=50)
+    return processor.decode(out[0], skip_special_tokens=True)
+
+def analyze_image_local(image, user_id=None):
+    """image - Frame (или байты изображения)"""
+    with LocalBrain.vision_model() as loaded:
+        if not loaded:
+            return "Ошибка загрузки зрения."
+        processor, model = loaded
+        try:
+            frame = Frame.ensure(image)
+            if frame is None:
+                return "Не удалось распознать изображение."
+            # Почти одинаковый кадр -> готовая подпись без BLIP generate
+            return SceneCache.captions().get_or_compute(
+                frame, lambda: _caption_frame(processor, model, frame), user_id
+            )
+        except Exception as e:
+            logger.error(f"Vision Error: {e}")
+            return "Не удалось распознать изображение."
+
+def read_text_local(image):
+    """image - Frame (или байты изображения)"""
+    with LocalBrain.ocr_reader() as reader:
+        if not reader:
+            return None
+        try:
+            frame = Frame.ensure(image)
+            if frame is None:
+                return None
+            # EasyOCR принимает BGR numpy, декодирование не повторяется
+            result = reader.readtext(frame.image, detail=0)
+            text = " ".join(result)
+            return text if text else None
+        except Exception as e:
+            logger.error(f"OCR Error: {e}")
+            return None
+
+def detect_frame_classes(frame):
+    # Preprocessing (resize + CLAHE) вычисляется кадром один раз,
+    # детекция с оптимальными параметрами через общий батчер (модель арендует он)
+    result = DetectionBatcher.default().predict(frame.clahe)
+    if result is None:
+        raise RuntimeError("YOLO model is not available")
+    detected = []
+    for c in result.boxes.cls:
+        name = result.names[int(c)]
+        if name not in detected:
+            detected.append(name)
+    return detected
+
+def detect_frame_boxes(frame):
+    """
+    Детекции кадра с рамками: [(class_name, confidence, (x1, y1, x2, y2)), ...].
+    Координаты нормированы на размер кадра (0..1), чтобы не зависеть от max_dim.
+    """
+    result = DetectionBatcher.default().predict(frame.clahe)
+    if result is None:
+        raise RuntimeError("YOLO model is not available")
+    h, w = frame.clahe.shape[:2]
+    boxes = result.boxes
+    detections = []
+    for c, conf, xyxy in zip(boxes.cls.tolist(), boxes.conf.tolist(), boxes.xyxy.tolist()):
+        x1, y1, x2, y2 = xyxy
+        detections.append((result.names[int(c)], float(conf), (x1 / w, y1 / h, x2 / w, y2 / h)))
+    return detections
 
-def detect_objects_local(image_bytes):
-    model = LocalBrain.get_yolo_model()
-    if not model: return []
+def detect_boxes_local(image):
+    """
+    Детекции кадра с рамками и уверенностью для трекера навигатора.
+    SceneCache здесь намеренно не используется: он отдает результат похожего
+    (не этого) кадра, в том числе чужого, и трекер получил бы застывшие рамки -
+    скорость обнуляется, "приближается" и "пропал" не срабатывают. Кадры
+    навигатора и так прореживаются трекером (NAV_DETECT_EVERY).
+    """
     try:
-        import cv2 # Local import to avoid top-level fail if missing
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
+        frame = Frame.ensure(image, max_dim=1280)
+        if frame is None:
             return []
-        
-        # Preprocessing для улучшения распознавания
-        # 1. Resize если изображение слишком большое
-        max_dimension = 1280
-        h, w = img.shape[:2]
-        if max(h, w) > max_dimension:
-            scale = max_dimension / max(h, w)
-            img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
-        
-        # 2. Улучшение контраста (CLAHE)
-        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        l = clahe.apply(l)
-        img = cv2.cvtColor(cv2.merge([l, a, b]), cv2.COLOR_LAB2BGR)
-        
-        # Детекция с оптимальными параметрами
-        results = model.predict(img, conf=0.3, iou=0.45, verbose=False)
-        detected = []
-        for r in results:
-            for c in r.boxes.cls:
-                detected.append(model.names[int(c)])
-        return list(set(detected))
+        return detect_frame_boxes(frame)
     except Exception as e:
-        print(f"YOLO Error: {e}")
+        logger.error(f"YOLO Error: {e}")
         return []
 
-from .cag import CAGSystem
+from .cag import CAGSystem, time_context
 from .tts_engine import TTSBrain
 
 # Lazy Init Kani (можно перенести в apps.py для автозагрузки)
 # TTSBrain.init_kani() 
 
-async def generate_ai_response_async(user_text, visual_context=None, user_obj=None, ocr_context=None):
-    """
-    Генерирует ответ используя DeepSeek/OpenRouter API + CAG System.
-    """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return "Ошибка: Не найден API ключ (OPENAI_API_KEY)."
-
-    # 1. CAG: Обновляем состояние и память
-    cag = None
-    if user_obj:
-        cag = CAGSystem(user_obj)
-        # Оборачиваем синхронный вызов DB в async
-        await sync_to_async(cag.update_state)(user_text)
-
-    # 2. CAG: Строим умный промпт для незрячих пользователей
-    if cag:
-        system_prompt = cag.build_system_prompt(visual_context)
-    else:
-        system_prompt = """Ты WayFinder — персональный голосовой ИИ-ассистент для незрячих людей.
+WAYFINDER_SYSTEM_PROMPT = """Ты WayFinder — персональный голосовой ИИ-ассистент для незрячих людей.
 
 ТВОЯ РОЛЬ:
 - Ты видишь мир глазами пользователя через камеру и описываешь окружение
@@ -198,40 +207,249 @@ async def generate_ai_response_async(user_text, visual_context=None, user_obj=No
 
 ВАЖНО: Ты активируешься только когда пользователь говорит "WayFinder" + вопрос. Отвечай только на то, что спросили."""
 
+def _fallback_dynamic_context(visual_context=None):
+    prompt = "\n\nКОНТЕКСТ:\n" + time_context()
+    if visual_context:
+        prompt += f"Ты видишь: {visual_context}\n"
+    return prompt
+
+async def _prepare_llm_request(user_text, visual_context=None, user_obj=None, ocr_context=None):
+    """
+    Общая подготовка запроса к LLM: CAG, системный промпт, клиент.
+    Возвращает (client, model_name, messages).
+    """
+
+    # 1. CAG: Обновляем состояние и память
+    cag = None
+    if user_obj:
+        cag = CAGSystem(user_obj)
+        if UnitOfWork.current() is not None:
+            # Внутри unit of work запись отложена до конца запроса - БД не трогаем
+            cag.update_state(user_text)
+        else:
+            # Оборачиваем синхронный вызов DB в async
+            await sync_to_async(cag.update_state)(user_text)
+
+    # 2. CAG: Строим умный промпт для незрячих пользователей
+    if cag:
+        system_prompt = cag.build_system_prompt(visual_context)
+    else:
+        # Тот же принцип: статический префикс + изменчивый хвост
+        system_prompt = WAYFINDER_SYSTEM_PROMPT + _fallback_dynamic_context(visual_context)
+
     # OCR Context add
     user_prompt = user_text
     if ocr_context:
         user_prompt += f"\n\n(Текст на изображении: {ocr_context})"
 
-    # 3. LLM Call
-    base_url = "https://api.deepseek.com"
-    model_name = "deepseek-chat"
-    if api_key.startswith("sk-or-v1"):
-        base_url = "https://openrouter.ai/api/v1"
-        model_name = "deepseek/deepseek-chat"
-
-    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    # 3. LLM Client (общий на процесс, с keep-alive)
+    client, model_name = get_llm_client()
     
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
+    return client, model_name, messages
+
+def _response_cache_key(user_text, visual_context, user_obj, ocr_context, model_name):
+    """
+    Ключ кэша ответов или None, если реплику нельзя отдавать из кэша
+    (личная/меняющая состояние CAG или кэш выключен).
+    """
+    if not ResponseCache.enabled():
+        return None
+    if not is_cacheable(user_text):
+        ResponseCache.default().skip()
+        return None
+    return ResponseCache.key(
+        user_text, visual_context, ocr_context,
+        facts=user_obj.facts if user_obj else None,
+        scope=user_obj.telegram_id if user_obj else None,
+        model_name=model_name,
+    )
+
+async def generate_ai_response_async(user_text, visual_context=None, user_obj=None, ocr_context=None):
+    """
+    Генерирует ответ используя DeepSeek/OpenRouter API + CAG System.
+    """
+    if not os.getenv("OPENAI_API_KEY"):
+        return "Ошибка: Не найден API ключ (OPENAI_API_KEY)."
+
+    client, model_name, messages = await _prepare_llm_request(user_text, visual_context, user_obj, ocr_context)
+
+    cache_key = _response_cache_key(user_text, visual_context, user_obj, ocr_context, model_name)
+    if cache_key:
+        cached = await ResponseCache.default().aget(cache_key)
+        if cached is not None:
+            return cached
 
     try:
+        started = time.perf_counter()
         response = await client.chat.completions.create(
             model=model_name,
             messages=messages,
             max_tokens=300,
             temperature=0.7  # Более естественные ответы
         )
+        PromptCacheStats.record(response.usage, latency=time.perf_counter() - started)
         answer = response.choices[0].message.content
+        if cache_key and answer:
+            await ResponseCache.default().aset(cache_key, answer)
         return answer
     except Exception as e:
         logger.error(f"DeepSeek API Error: {e}")
         return f"Извините, произошла ошибка связи. Попробуйте еще раз."
 
-async def text_to_speech_async(text):
-    return await TTSBrain.speak(text)
+async def generate_ai_response_stream(user_text, visual_context=None, user_obj=None, ocr_context=None):
+    """
+    То же, что generate_ai_response_async, но отдает текст по мере генерации
+    (асинхронный генератор фрагментов).
+    """
+    if not os.getenv("OPENAI_API_KEY"):
+        yield "Ошибка: Не найден API ключ (OPENAI_API_KEY)."
+        return
+
+    client, model_name, messages = await _prepare_llm_request(user_text, visual_context, user_obj, ocr_context)
+
+    cache_key = _response_cache_key(user_text, visual_context, user_obj, ocr_context, model_name)
+    if cache_key:
+        cached = await ResponseCache.default().aget(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    produced = False
+    parts = []
+    started = time.perf_counter()
+    first_token = None
+    usage = None
+    try:
+        stream = await client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            max_tokens=300,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}  # usage (в т.ч. cached tokens) в последнем чанке
+        )
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                produced = True
+                parts.append(delta)
+                yield delta
+        PromptCacheStats.record(usage, ttft=first_token)
+        # В кэш попадает только полностью полученный ответ
+        if cache_key and parts:
+            await ResponseCache.default().aset(cache_key, "".join(parts))
+    except Exception as e:
+        logger.error(f"DeepSeek API Error (stream): {e}")
+        if not produced:
+            yield "Извините, произошла ошибка связи. Попробуйте еще раз."
+
+class SentenceSplitter:
+    """
+    Режет поток текста на законченные предложения для озвучки.
+    Слишком короткие куски ("Да.", "т.е.") приклеиваются к следующему предложению.
+    """
+    _ENDINGS = ".!?…\n"
+
+    def __init__(self, min_length=20):
+        self.min_length = min_length
+        self._buffer = ""
+
+    def feed(self, text):
+        """Добавляет фрагмент, возвращает список готовых предложений"""
+        self._buffer += text
+        sentences = []
+        start = 0
+        for i, char in enumerate(self._buffer):
+            if char not in self._ENDINGS:
+                continue
+            # Граница - знак конца, за которым пробел (или перевод строки сам по себе)
+            if char != "\n" and (i + 1 >= len(self._buffer) or not self._buffer[i + 1].isspace()):
+                continue
+            candidate = self._buffer[start:i + 1].strip()
+            if len(candidate) >= self.min_length:
+                sentences.append(candidate)
+                start = i + 1
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self):
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return [rest] if rest else []
+
+async def split_sentences(fragments, min_length=20):
+    """Асинхронный генератор предложений из потока фрагментов текста"""
+    splitter = SentenceSplitter(min_length=min_length)
+    async for fragment in fragments:
+        for sentence in splitter.feed(fragment):
+            yield sentence
+    for sentence in splitter.flush():
+        yield sentence
+
+async def speak_sentences(sentences, speed=1.0):
+    """
+    Конвейер LLM -> TTS: каждое готовое предложение сразу уходит в потоковый синтез,
+    пока LLM продолжает генерацию. Отдает строго по порядку ('text', sentence), затем
+    ('audio', chunk) для чанков этого предложения по мере синтеза (первый звук не ждет
+    конца фразы). Следующие предложения синтезируются заранее и ждут в буфере.
+    """
+    queue = asyncio.Queue()
+    pending = []
+
+    async def synthesize(sentence, chunks):
+        try:
+            async for chunk in text_to_speech_stream(sentence, speed=speed):
+                await chunks.put(chunk)
+        finally:
+            await chunks.put(None)
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                chunks = asyncio.Queue()
+                task = asyncio.ensure_future(synthesize(sentence, chunks))
+                pending.append(task)
+                await queue.put((sentence, chunks, task))
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            sentence, chunks, task = item
+            yield 'text', sentence
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                yield 'audio', chunk
+            await task
+        await producer  # пробрасываем ошибки генерации
+    finally:
+        # Клиент отключился: незавершенный синтез не должен занимать пул tts
+        for task in [producer] + pending:
+            if not task.done():
+                task.cancel()
+
+async def text_to_speech_async(text, speed=1.0):
+    return await TTSBrain.speak(text, speed=speed)
+
+def text_to_speech_stream(text, speed=1.0):
+    """Асинхронный генератор чанков аудио (для потоковых ответов)"""
+    return TTSBrain.stream(text, speed=speed)
 
 def get_ai_response_sync(text, visual_context=None):
     return asyncio.run(generate_ai_response_async(text, visual_context))
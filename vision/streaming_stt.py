@@ -0,0 +1,374 @@
+"""
+Потоковое распознавание речи по WebSocket: ws://<host>/ws/stt/
+
+Раньше запись целиком загружалась multipart-ом и только потом распознавалась,
+поэтому задержка STT всегда прибавлялась ко времени записи. Теперь клиент шлет
+аудио по мере записи, сервер каждые STT_STREAM_STEP_MS декодирует скользящее
+окно и отдает промежуточную расшифровку. Конец фразы определяется по тишине
+(STT_STREAM_ENDPOINT_MS); если последняя промежуточная расшифровка уже покрыла
+всю речь, она сразу становится финальной, иначе декодируется только остаток.
+Финальный текст идет в тот же конвейер, что и SmartAnalyzeView (pipeline.py).
+
+Протокол:
+    подключение: /ws/stt/?user_id=...&token=...&format=pcm_s16le&stt_profile=fast&stream=1
+    клиент -> сервер: бинарные сообщения - PCM 16 кГц моно (format: pcm_s16le | pcm_f32le)
+                      {"type": "end"}    - закончить фразу сейчас (кнопка отпущена)
+                      {"type": "reset"}  - сбросить накопленное аудио
+    сервер -> клиент: {"type": "partial", "text": ...}
+                      {"type": "final", "text": ..., "stt": {...}}
+                      {"type": "reply", "message": ..., "content_type": ...} + бинарное аудио
+                      при stream=1: {"type": "text", "seq", "message"}, {"type": "audio", "seq", "part",
+                      "content_type"} + бинарный чанк аудио, ..., {"type": "done", "message"}
+                      {"type": "error", "error": ...}
+
+Настройки:
+    STT_STREAM_STEP_MS=500          # новая порция аудио для промежуточной расшифровки
+    STT_STREAM_WINDOW=10            # секунд, дольше - начало фиксируется и отрезается
+    STT_STREAM_ENDPOINT_MS=300      # тишина после речи = конец фразы
+    STT_STREAM_SILENCE_RMS=0.01     # порог энергии речи
+    STT_STREAM_MAX_UTTERANCE=30     # секунд, принудительное завершение фразы
+"""
+import os
+import time
+import asyncio
+import logging
+
+import numpy as np
+
+from .audio_input import WHISPER_SAMPLE_RATE, PCM_DTYPES, normalize_format, pcm_to_array
+from .executors import run_inference
+from .model_registry import ModelRegistry
+from .identity_cache import IdentityCache
+from .stt_profiles import resolve_stt_profile, stt_language
+from .unit_of_work import UnitOfWork
+from .websocket import WebSocket, WebSocketDisconnect, release_db_connections
+
+logger = logging.getLogger(__name__)
+
+STEP_MS = int(os.getenv('STT_STREAM_STEP_MS', '500'))
+WINDOW_SECONDS = float(os.getenv('STT_STREAM_WINDOW', '10'))
+ENDPOINT_MS = int(os.getenv('STT_STREAM_ENDPOINT_MS', '300'))
+SILENCE_RMS = float(os.getenv('STT_STREAM_SILENCE_RMS', '0.01'))
+MAX_UTTERANCE_SECONDS = float(os.getenv('STT_STREAM_MAX_UTTERANCE', '30'))
+
+_FRAME = WHISPER_SAMPLE_RATE * 20 // 1000      # 20 мс - шаг детектора речи
+_PREROLL = WHISPER_SAMPLE_RATE * 300 // 1000   # до начала речи держим только 300 мс
+_TAIL_PAD = WHISPER_SAMPLE_RATE * 150 // 1000  # тишины после речи оставляем 150 мс
+_COMMIT_MARGIN = 1.0                           # секунд: конец окна не фиксируем
+
+
+def decode_window(audio, profile, language):
+    """Декодирует окно аудио. Возвращает [(start, end, text)] или None без модели."""
+    with ModelRegistry.lease(profile.model_id) as model:
+        if model is None:
+            return None
+        segments, _ = model.transcribe(
+            audio,
+            beam_size=profile.beam_size,
+            language=language,
+            vad_filter=False,  # тишину по краям уже обрезал детектор речи
+            condition_on_previous_text=False,
+        )
+        return [(segment.start, segment.end, segment.text.strip()) for segment in segments]
+
+
+class StreamingTranscriber:
+    """
+    Состояние одной фразы: накопленное аудио, зафиксированный текст,
+    последняя промежуточная расшифровка и детектор конца речи.
+    Все методы вызываются из event loop; декодирование - снаружи (decode_window).
+    """
+
+    def __init__(self, step_ms=STEP_MS, window_seconds=WINDOW_SECONDS, endpoint_ms=ENDPOINT_MS,
+                 silence_rms=SILENCE_RMS, max_seconds=MAX_UTTERANCE_SECONDS):
+        self.step = WHISPER_SAMPLE_RATE * step_ms // 1000
+        self.window_seconds = window_seconds
+        self.endpoint = WHISPER_SAMPLE_RATE * endpoint_ms // 1000
+        self.silence_rms = silence_rms
+        self.max_samples = int(WHISPER_SAMPLE_RATE * max_seconds)
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        self.generation += 1
+        self._audio = np.zeros(0, dtype=np.float32)
+        self._pending = np.zeros(0, dtype=np.float32)  # хвост < 20 мс для детектора
+        self._committed = []
+        self._partial = ''
+        self.decoded_samples = 0
+        self.speech = False
+        self._silence = 0
+        self.received_samples = 0
+
+    @property
+    def text(self):
+        return ' '.join(t for t in self._committed + [self._partial] if t).strip()
+
+    def append(self, samples):
+        """Добавляет аудио. True, если фраза закончилась (тишина после речи или лимит длины)."""
+        self.received_samples += len(samples)
+        self._audio = np.concatenate((self._audio, samples))
+
+        frames = np.concatenate((self._pending, samples))
+        usable = len(frames) - len(frames) % _FRAME
+        if usable:
+            energy = np.sqrt(np.mean(np.square(frames[:usable].reshape(-1, _FRAME)), axis=1))
+            for rms in energy:
+                if rms >= self.silence_rms:
+                    self.speech = True
+                    self._silence = 0
+                else:
+                    self._silence += _FRAME
+        self._pending = frames[usable:]
+
+        if not self.speech:
+            # До начала речи декодировать нечего
+            self._audio = self._audio[-_PREROLL:]
+            return False
+        return self._silence >= self.endpoint or len(self._audio) >= self.max_samples
+
+    def needs_partial(self):
+        return self.speech and len(self._audio) - self.decoded_samples >= self.step
+
+    def snapshot(self):
+        """(аудио для декодирования, число сэмплов) - массив не изменяется, только заменяется"""
+        return self._audio, len(self._audio)
+
+    def apply_partial(self, segments, decoded_samples):
+        """Принимает результат декодирования окна; фиксирует начало, если окно слишком длинное"""
+        self.decoded_samples = decoded_samples
+        duration = decoded_samples / WHISPER_SAMPLE_RATE
+        if duration > self.window_seconds:
+            cut_seconds = 0.0
+            while segments and segments[0][1] <= duration - _COMMIT_MARGIN:
+                start, end, text = segments.pop(0)
+                self._committed.append(text)
+                cut_seconds = end
+            if cut_seconds:
+                cut = int(cut_seconds * WHISPER_SAMPLE_RATE)
+                self._audio = self._audio[cut:]
+                self.decoded_samples -= cut
+        self._partial = ' '.join(text for _, _, text in segments)
+        return self.text
+
+    def final_audio(self):
+        """Аудио фразы без хвостовой тишины: (массив, число сэмплов)"""
+        end = len(self._audio) - max(0, self._silence - _TAIL_PAD)
+        return self._audio[:end], end
+
+    def apply_final(self, segments):
+        self._partial = ' '.join(text for _, _, text in segments)
+        return self.text
+
+
+class STTSocket:
+    """Одно WebSocket-подключение: поток аудио -> partial/final -> ответ ассистента"""
+
+    def __init__(self, ws, user, vision_user, audio_format, profile, language, stream=False):
+        self.ws = ws
+        self.user = user
+        self.vision_user = vision_user
+        self.audio_format = audio_format
+        self.profile = profile
+        self.language = language
+        self.stream = stream
+        self.transcriber = StreamingTranscriber()
+        self._partial_task = None
+        self._final_task = None
+        self._reply_task = None
+
+    async def run(self):
+        try:
+            while True:
+                kind, payload = await self.ws.receive()
+                if kind == 'bytes':
+                    await self.on_audio(pcm_to_array(payload, self.audio_format))
+                elif payload.get('type') == 'end':
+                    self.finalize()
+                elif payload.get('type') == 'reset':
+                    self.transcriber.reset()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.cancel_tasks()
+
+    def cancel_tasks(self):
+        for task in (self._partial_task, self._final_task, self._reply_task):
+            if task is not None:
+                task.cancel()
+
+    async def on_audio(self, samples):
+        if self.transcriber.append(samples):
+            self.finalize()
+        elif (self.transcriber.needs_partial() and not self._busy(self._partial_task)
+              and not self._busy(self._final_task)):
+            # Одно декодирование за раз: пока оно (или финал прошлой фразы) идет, аудио просто копится
+            self._partial_task = asyncio.ensure_future(self._decode_partial())
+
+    @staticmethod
+    def _busy(task):
+        return task is not None and not task.done()
+
+    async def _decode_partial(self):
+        transcriber = self.transcriber
+        generation = transcriber.generation
+        audio, samples = transcriber.snapshot()
+        try:
+            segments = await run_inference('whisper', decode_window, audio, self.profile, self.language)
+        except Exception as e:
+            logger.error(f"Streaming STT partial error: {e}")
+            return
+        if segments is None or generation != transcriber.generation:
+            return  # фраза сброшена
+        text = transcriber.apply_partial(segments, samples)
+        await self.ws.send_json({'type': 'partial', 'text': text})
+
+    def finalize(self):
+        """
+        Завершает текущую фразу в фоне и возвращает задачу. Фраза отсоединяется
+        сразу: новое аудио копится в новом StreamingTranscriber, и цикл приема
+        не ждет финального декодирования. Финалы отправляются по порядку фраз.
+        """
+        transcriber, self.transcriber = self.transcriber, StreamingTranscriber()
+        partial_task, self._partial_task = self._partial_task, None
+        self._final_task = asyncio.ensure_future(
+            self._finalize(transcriber, partial_task, self._final_task))
+        return self._final_task
+
+    async def _finalize(self, transcriber, partial_task, previous):
+        started = time.perf_counter()
+        try:
+            if self._busy(previous):
+                await asyncio.wait([previous])
+            if self._busy(partial_task):
+                await asyncio.shield(partial_task)
+            await self._send_final(transcriber, started)
+        except WebSocketDisconnect:
+            pass
+
+    async def _send_final(self, transcriber, started):
+        audio, end = transcriber.final_audio()
+        reused = transcriber.speech and transcriber.decoded_samples >= end
+        if not transcriber.speech:
+            text = ''
+        elif reused:
+            # Промежуточная расшифровка уже покрыла всю речь - декодировать нечего
+            text = transcriber.text
+        else:
+            try:
+                segments = await run_inference('whisper', decode_window, audio, self.profile, self.language)
+            except Exception as e:
+                # Ошибка одной фразы не должна рвать соединение
+                logger.error(f"Streaming STT final error: {e}")
+                await self.ws.send_json({'type': 'error', 'error': 'Transcription failed'})
+                return
+            text = transcriber.apply_final(segments or [])
+
+        received_seconds = transcriber.received_samples / WHISPER_SAMPLE_RATE
+        await self.ws.send_json({'type': 'final', 'text': text, 'stt': {
+            'profile': self.profile.name,
+            'language': self.language,
+            'audio_seconds': round(received_seconds, 2),
+            'finalize_ms': round((time.perf_counter() - started) * 1000, 1),
+            'reused_partial': reused,
+        }})
+        if text:
+            await self.reply(text)
+
+    async def reply(self, text, visual_description=None, ocr_text=None):
+        """
+        Ответ строится в фоне: прием аудио (и кадров в сессии очков) не
+        останавливается, пока работают LLM и TTS.
+        """
+        if self._reply_task is not None and not self._reply_task.done():
+            await self.ws.send_json({'type': 'error', 'error': 'Previous reply is still in progress'})
+            return
+        self._reply_task = asyncio.ensure_future(self._reply(text, visual_description, ocr_text))
+
+    async def _reply(self, text, visual_description=None, ocr_text=None):
+        """Финальная расшифровка -> тот же конвейер, что у SmartAnalyzeView"""
+        from .pipeline import chat_reply, stream_chat_reply
+        from .tts_engine import TTSBrain
+
+        if self.user and not await self.user.acan_make_request():
+            await self.ws.send_json({'type': 'error', 'error': 'Daily limit reached',
+                                     'subscription_type': self.user.subscription_type})
+            return
+
+        content_type = TTSBrain.content_type()
+        try:
+            if self.stream:
+                events = stream_chat_reply(text, self.vision_user, self.user, visual_description, ocr_text)
+                async for event, data in events:
+                    if event == 'audio':
+                        await self.ws.send_json(
+                            {'type': 'audio', 'seq': data['seq'], 'part': data['part'], 'content_type': content_type},
+                            data['audio']
+                        )
+                    else:
+                        await self.ws.send_json(dict(data, type=event))
+            else:
+                async with UnitOfWork():
+                    response_text, audio = await chat_reply(
+                        text, self.vision_user, self.user, visual_description, ocr_text
+                    )
+                await self.ws.send_json({'type': 'reply', 'message': response_text,
+                                         'content_type': content_type if audio else None}, audio or None)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error(f"Streaming STT reply error: {e}")
+            await self.ws.send_json({'type': 'error', 'error': 'Reply failed'})
+        finally:
+            await release_db_connections()
+
+
+async def accept_audio_socket(scope, receive, send):
+    """
+    Общий вход для аудио-WebSocket: accept, формат аудио, токен, VisionUser, профиль STT.
+    Возвращает (ws, параметры сессии) или None (ошибка уже отправлена клиенту).
+    """
+    ws = WebSocket(scope, receive, send)
+    try:
+        await ws.accept()
+    except WebSocketDisconnect:
+        return None
+
+    try:
+        audio_format = normalize_format(ws.query.get('format', 'pcm_s16le'))
+        if audio_format not in PCM_DTYPES:
+            raise ValueError("Streaming STT accepts pcm_s16le or pcm_f32le")
+    except ValueError as e:
+        await ws.send_json({'type': 'error', 'error': str(e)})
+        await ws.close(1003)
+        return None
+
+    user = await ws.authenticate()
+    if ws.token() and user is None:
+        await ws.send_json({'type': 'error', 'error': 'Invalid token'})
+        await ws.close(4401)
+        return None
+
+    user_id = ws.query.get('user_id', 'anonymous')
+    vision_user = await IdentityCache.avision_user(user_id)
+    return ws, {
+        'user': user,
+        'vision_user': vision_user,
+        'audio_format': audio_format,
+        'profile': resolve_stt_profile(ws.query.get('stt_profile'), user),
+        'language': stt_language(user),
+        'stream': ws.query.get('stream') in ('1', 'true'),
+    }
+
+
+async def stt_socket(scope, receive, send):
+    """ASGI-приложение для /ws/stt/ (подключается в core/asgi.py)"""
+    opened = await accept_audio_socket(scope, receive, send)
+    if opened is None:
+        return
+    ws, params = opened
+    try:
+        await STTSocket(ws, **params).run()
+    finally:
+        await release_db_connections()
+        await ws.close()
@@ -0,0 +1,90 @@
+"""
+Профили распознавания речи: компромисс задержка / точность.
+
+    fast      - Whisper tiny, greedy (beam 1), VAD-обрезка тишины
+    balanced  - Whisper base, beam 3, VAD
+    accurate  - Whisper small, beam 5, VAD
+
+Язык закрепляется по User.preferred_language (без автоопределения по первым
+30 секундам); для анонимных запросов - STT_DEFAULT_LANGUAGE, если задан,
+иначе Whisper определяет язык сам. Профиль выбирается на запрос (поле stt_profile) или по тарифу;
+запрошенный профиль не может быть точнее (дороже) профиля тарифа.
+
+Настройки:
+    STT_PROFILE=fast                # профиль по умолчанию (анонимные запросы)
+    STT_DEFAULT_LANGUAGE=ru         # язык без пользователя; не задан - автоопределение
+    STT_VAD_MIN_SILENCE_MS=500
+"""
+import os
+from typing import NamedTuple, Optional
+
+
+class STTProfile(NamedTuple):
+    name: str
+    model_id: str       # id в ModelRegistry
+    beam_size: int
+    vad: bool
+
+
+class Transcript(NamedTuple):
+    text: str
+    profile: str
+    language: Optional[str]
+    audio_seconds: float    # длительность записи
+    speech_seconds: float   # после обрезки тишины VAD
+    elapsed: float          # время распознавания
+    rtf: Optional[float]    # real-time factor: elapsed / audio_seconds
+
+    def as_dict(self):
+        """Метаданные для ответа API (без текста)"""
+        return {
+            'profile': self.profile,
+            'language': self.language,
+            'audio_seconds': round(self.audio_seconds, 2),
+            'speech_seconds': round(self.speech_seconds, 2),
+            'elapsed': round(self.elapsed, 3),
+            'rtf': round(self.rtf, 3) if self.rtf is not None else None,
+        }
+
+
+STT_PROFILES = {
+    'fast': STTProfile('fast', 'whisper', beam_size=1, vad=True),
+    'balanced': STTProfile('balanced', 'whisper:base', beam_size=3, vad=True),
+    'accurate': STTProfile('accurate', 'whisper:small', beam_size=5, vad=True),
+}
+
+# Профиль по тарифу (subscription_type)
+PLAN_STT_PROFILES = {
+    'free': 'fast',
+    'premium': 'balanced',
+    'pro': 'accurate',
+}
+
+# Порядок профилей по стоимости: запрос выше тарифа понижается до тарифного
+PROFILE_ORDER = ('fast', 'balanced', 'accurate')
+
+VAD_MIN_SILENCE_MS = int(os.getenv('STT_VAD_MIN_SILENCE_MS', '500'))
+
+
+def resolve_stt_profile(requested=None, user=None):
+    """
+    Профиль тарифа (без пользователя - STT_PROFILE) или явно запрошенный,
+    если он не дороже тарифного.
+    """
+    plan_profile = None
+    if user is not None:
+        plan_profile = PLAN_STT_PROFILES.get(getattr(user, 'subscription_type', None))
+    if plan_profile is None:
+        plan_profile = os.getenv('STT_PROFILE', 'fast')
+        if plan_profile not in STT_PROFILES:
+            plan_profile = 'fast'
+    if requested in STT_PROFILES and PROFILE_ORDER.index(requested) <= PROFILE_ORDER.index(plan_profile):
+        return STT_PROFILES[requested]
+    return STT_PROFILES[plan_profile]
+
+
+def stt_language(user=None):
+    """Код языка для Whisper ('ru', 'en', ...) или None для автоопределения"""
+    language = getattr(user, 'preferred_language', None) or os.getenv('STT_DEFAULT_LANGUAGE', '')
+    language = language.strip().split('-')[0].lower()
+    return language if language and language != 'auto' else None
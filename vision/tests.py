@@ -1,3 +1,1547 @@
-from django.test import TestCase
+import os
+import sys
+import functools
+import json
+import pickle
+import runpy
+import time
+import struct
+import asyncio
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import cv2
+import django
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core.asgi import application
+
+from .tracker import ObjectTracker, TrackerStore
+from .streaming_stt import StreamingTranscriber, STTSocket
+from .stt_profiles import STT_PROFILES, resolve_stt_profile, stt_language
+from .services import SentenceSplitter, speak_sentences, LocalBrain, WAYFINDER_SYSTEM_PROMPT, _prepare_llm_request
+from .models import User, ConversationMessage, VisionUser
+from .cag import STATIC_SYSTEM_PROMPT
+from .quota import QuotaManager, plan_limit
+from .identity_cache import IdentityCache
+from .unit_of_work import QueryCounter
+from .db_stats import ConnectionStats
+from .executors import InferenceExecutors, run_inference
+from .frames import Frame, jpeg_header, decode_image
+from .scene_cache import SceneCache
+from .apps import VisionConfig
+from .tts_system.retention import AudioRetention
+from .tts_system.cache import TTSCache
+from .tts_system.manager import TTSManager
+from .llm_client import LLMClientPool, _cached_tokens
+from .model_registry import ModelRegistry
+from .batching import DetectionBatcher
+from .yolo import YOLOModel
+from .audio_input import AudioFormatError, decode_declared_audio
+from .response_cache import ResponseCache, is_cacheable
+
+
+def _box(cx, cy, half):
+    return (cx - half, cy - half, cx + half, cy + half)
+
+
+class ObjectTrackerTests(SimpleTestCase):
+    def make(self, **kwargs):
+        params = dict(detect_every=1, min_hits=2, max_misses=3, approach_ratio=1.3)
+        params.update(kwargs)
+        return ObjectTracker(**params)
+
+    def events(self, tracker, detections, now):
+        return [(e['event'], e['class'], e['id']) for e in tracker.update(detections, now=now)]
+
+    def test_new_object_announced_after_min_hits_with_stable_id(self):
+        tracker = self.make()
+        car = [('car', 0.9, _box(0.5, 0.5, 0.05))]
+        self.assertEqual(self.events(tracker, car, 0.1), [])
+        self.assertEqual(self.events(tracker, car, 0.2), [('new', 'car', 1)])
+        # Та же сцена больше не объявляется
+        self.assertEqual(self.events(tracker, car, 0.3), [])
+        self.assertEqual([o['id'] for o in tracker.objects()], [1])
+
+    def test_fast_approach_below_iou_threshold_is_approaching_not_new(self):
+        tracker = self.make()
+        for now in (0.1, 0.2):
+            tracker.update([('car', 0.9, _box(0.5, 0.5, 0.05))], now=now)
+        # Площадь x4: IoU = 0.25 < NAV_TRACK_IOU, совпадают центры
+        self.assertEqual(self.events(tracker, [('car', 0.9, _box(0.5, 0.5, 0.1))], 0.3),
+                         [('approaching', 'car', 1)])
+
+    def test_gone_after_exactly_max_misses(self):
+        tracker = self.make(max_misses=3)
+        for now in (0.1, 0.2):
+            tracker.update([('person', 0.9, _box(0.2, 0.5, 0.1))], now=now)
+        self.assertEqual(self.events(tracker, [], 0.3), [])
+        self.assertEqual(self.events(tracker, [], 0.4), [])
+        self.assertEqual(self.events(tracker, [], 0.5), [('gone', 'person', 1)])
+        self.assertEqual(tracker.objects(), [])
+
+    def test_low_confidence_extends_but_never_creates_tracks(self):
+        tracker = self.make()
+        tracker.update([('dog', 0.3, _box(0.5, 0.5, 0.1))], now=0.1)
+        tracker.update([('dog', 0.3, _box(0.5, 0.5, 0.1))], now=0.2)
+        self.assertEqual(tracker.tracks, [])
+
+        for now in (0.3, 0.4):
+            tracker.update([('dog', 0.9, _box(0.5, 0.5, 0.1))], now=now)
+        for now in (0.5, 0.6, 0.7, 0.8):
+            self.assertEqual(self.events(tracker, [('dog', 0.3, _box(0.5, 0.5, 0.1))], now), [])
+        self.assertEqual(len(tracker.objects()), 1)
+
+    def test_detects_every_nth_frame_and_predicts_in_between(self):
+        tracker = self.make(detect_every=3)
+        plan = []
+        for i in range(6):
+            if tracker.should_detect():
+                plan.append('D')
+                tracker.update([], now=i * 0.1)
+            else:
+                plan.append('P')
+                self.assertEqual(tracker.predict(now=i * 0.1), [])
+        self.assertEqual(plan, ['D', 'P', 'P', 'D', 'P', 'P'])
+
+    def test_prediction_follows_velocity(self):
+        tracker = self.make(detect_every=2)
+        tracker.update([('car', 0.9, _box(0.3, 0.5, 0.05))], now=0.0)
+        tracker.update([('car', 0.9, _box(0.33, 0.5, 0.05))], now=1.0)
+        tracker.predict(now=1.5)
+        self.assertEqual(len(tracker.tracks), 1)
+        x1, _, x2, _ = tracker.tracks[0].box
+        self.assertGreater((x1 + x2) / 2, 0.33)
+
+
+class TrackerStoreTests(SimpleTestCase):
+    def test_trackers_are_per_key_and_expire(self):
+        store = TrackerStore(ttl=60.0)
+        first = store.get('user:1')
+        self.assertIs(store.get('user:1'), first)
+        self.assertIsNot(store.get('user:2'), first)
+
+        first.last_used -= 120
+        self.assertIsNot(store.get('user:1'), first)
+
+
+def _tone(seconds, amplitude=0.1):
+    return np.full(int(16000 * seconds), amplitude, dtype=np.float32)
+
+
+def _silence(seconds):
+    return np.zeros(int(16000 * seconds), dtype=np.float32)
+
+
+class StreamingTranscriberTests(SimpleTestCase):
+    def make(self, **kwargs):
+        params = dict(step_ms=500, window_seconds=10, endpoint_ms=300, silence_rms=0.01, max_seconds=30)
+        params.update(kwargs)
+        return StreamingTranscriber(**params)
+
+    def test_silence_before_speech_is_not_kept(self):
+        transcriber = self.make()
+        self.assertFalse(transcriber.append(_silence(2)))
+        self.assertFalse(transcriber.speech)
+        self.assertLessEqual(len(transcriber.snapshot()[0]), 16000 * 0.3)
+        self.assertFalse(transcriber.needs_partial())
+
+    def test_endpoint_after_silence_following_speech(self):
+        transcriber = self.make()
+        self.assertFalse(transcriber.append(_tone(0.6)))
+        self.assertTrue(transcriber.needs_partial())
+        self.assertFalse(transcriber.append(_silence(0.2)))
+        self.assertTrue(transcriber.append(_silence(0.1)))
+
+    def test_max_utterance_forces_endpoint(self):
+        transcriber = self.make(max_seconds=1)
+        self.assertFalse(transcriber.append(_tone(0.5)))
+        self.assertTrue(transcriber.append(_tone(0.6)))
+
+    def test_final_audio_drops_trailing_silence(self):
+        transcriber = self.make()
+        transcriber.append(_tone(1.0))
+        transcriber.append(_silence(0.3))
+        audio, end = transcriber.final_audio()
+        self.assertEqual(end, int(16000 * 1.15))
+
+    def test_long_window_commits_finished_segments(self):
+        transcriber = self.make(window_seconds=2)
+        transcriber.append(_tone(3.0))
+        text = transcriber.apply_partial([(0.0, 1.0, 'раз'), (1.0, 2.5, 'два')], 16000 * 3)
+        self.assertEqual(text, 'раз два')
+        self.assertEqual(len(transcriber.snapshot()[0]), 16000 * 2)
+        self.assertEqual(transcriber.decoded_samples, 16000 * 2)
+        self.assertEqual(transcriber.apply_final([(0.0, 1.5, 'три')]), 'раз три')
+
+
+class _FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_json(self, data, payload=None):
+        self.sent.append(data)
+
+
+class STTSocketTests(SimpleTestCase):
+    def test_final_decode_error_sends_error_frame_and_keeps_session(self):
+        ws = _FakeSocket()
+        socket = STTSocket(ws, None, None, 'pcm_s16le', STT_PROFILES['fast'], 'ru')
+        socket.transcriber.append(_tone(1.0))
+
+        async def finish():
+            await socket.finalize()
+
+        failing = mock.AsyncMock(side_effect=RuntimeError('whisper crashed'))
+        with mock.patch('vision.streaming_stt.run_inference', failing):
+            asyncio.run(finish())
+
+        self.assertEqual(ws.sent, [{'type': 'error', 'error': 'Transcription failed'}])
+        self.assertFalse(socket.transcriber.speech)
+
+    async def test_receive_loop_keeps_accepting_audio_while_final_decodes(self):
+        ws = _FakeSocket()
+        socket = STTSocket(ws, None, None, 'pcm_s16le', STT_PROFILES['fast'], 'ru')
+        socket.transcriber.append(_tone(1.0))
+        decoding = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_decode(pool, func, audio, profile, language):
+            decoding.set()
+            await release.wait()
+            return [(0.0, 1.0, 'первая фраза')]
+
+        with mock.patch('vision.streaming_stt.run_inference', slow_decode), \
+                mock.patch.object(STTSocket, 'reply', mock.AsyncMock()) as reply:
+            final = socket.finalize()
+            await decoding.wait()
+
+            # Финал еще декодируется, а новое аудио уже принимается в следующую фразу
+            await socket.on_audio(_tone(0.6))
+            self.assertTrue(socket.transcriber.speech)
+            self.assertEqual(socket.transcriber.received_samples, int(16000 * 0.6))
+            self.assertIsNone(socket._partial_task)  # partial ждет окончания финала
+            self.assertEqual(ws.sent, [])
+
+            release.set()
+            await final
+
+        self.assertEqual(ws.sent[0]['type'], 'final')
+        self.assertEqual(ws.sent[0]['text'], 'первая фраза')
+        self.assertEqual(ws.sent[0]['stt']['audio_seconds'], 1.0)
+        reply.assert_awaited_once_with('первая фраза')
+
+
+@mock.patch('vision.streaming_stt.release_db_connections', new_callable=mock.AsyncMock)
+@mock.patch('vision.glasses_session.release_db_connections', new_callable=mock.AsyncMock)
+class GlassesSessionSocketTests(TestCase):
+    """/ws/session/ через ASGI-приложение целиком (core.asgi), без сети"""
+
+    def setUp(self):
+        self.addCleanup(IdentityCache.invalidate_vision_user, 'tg-session')
+
+    async def connect(self, query='user_id=tg-session&mode=chat'):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'websocket', 'path': '/ws/session/', 'query_string': query.encode(), 'headers': [],
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'websocket.accept'})
+        return communicator
+
+    async def receive_json(self, communicator):
+        message = await communicator.receive_output(5)
+        self.assertEqual(message['type'], 'websocket.send')
+        return json.loads(message['text'])
+
+    async def disconnect(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(5)
+
+    async def test_frame_then_question_round_trip(self, *mocks):
+        ok, jpeg = cv2.imencode('.jpg', np.full((48, 64, 3), 128, dtype=np.uint8))
+        self.assertTrue(ok)
+        decoded = asyncio.Event()
+
+        async def tracking_run_inference(pool, func, *args):
+            result = await run_inference(pool, func, *args)
+            if pool == 'preprocess':
+                decoded.set()  # кадр сохраняется в сессии сразу после возврата, без await
+            return result
+
+        chat_reply = mock.AsyncMock(return_value=('Впереди дверь.', b'mp3'))
+        with mock.patch('vision.glasses_session.run_inference', tracking_run_inference), \
+                mock.patch('vision.glasses_session.analyze_image_local', return_value='серая стена'), \
+                mock.patch('vision.glasses_session.maybe_read_text', new_callable=mock.AsyncMock, return_value=None), \
+                mock.patch('vision.tts_engine.TTSBrain.content_type', return_value='audio/mpeg'), \
+                mock.patch('vision.pipeline.chat_reply', chat_reply):
+            communicator = await self.connect()
+            ready = await self.receive_json(communicator)
+            self.assertEqual((ready['type'], ready['mode'], ready['authenticated']), ('ready', 'chat', False))
+
+            await communicator.send_input({'type': 'websocket.receive', 'bytes': b'\x01' + jpeg.tobytes()})
+            await asyncio.wait_for(decoded.wait(), 5)
+            await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps({'type': 'ask', 'text': 'Что впереди?'})})
+
+            reply = await self.receive_json(communicator)
+            audio = await communicator.receive_output(5)
+            await self.disconnect(communicator)
+
+        self.assertEqual(reply, {'type': 'reply', 'message': 'Впереди дверь.', 'content_type': 'audio/mpeg'})
+        self.assertEqual(audio, {'type': 'websocket.send', 'bytes': b'mp3'})
+        text, vision_user, user, visual_description, ocr_text = chat_reply.await_args.args
+        self.assertEqual((text, vision_user.telegram_id, user, visual_description), ('Что впереди?', 'tg-session', None, 'серая стена'))
+
+    async def test_bad_input_reports_error_and_keeps_session(self, *mocks):
+        communicator = await self.connect()
+        await self.receive_json(communicator)  # ready
+
+        await communicator.send_input({'type': 'websocket.receive', 'bytes': b'\x07junk'})
+        self.assertEqual(await self.receive_json(communicator),
+                         {'type': 'error', 'error': 'Unknown binary message type: 7'})
+
+        # Сессия после ошибки жива
+        await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps({'type': 'ping'})})
+        pong = await self.receive_json(communicator)
+        self.assertEqual(pong['type'], 'pong')
+        await self.disconnect(communicator)
+
+    async def test_unsupported_audio_format_closes_connection(self, *mocks):
+        communicator = await self.connect('user_id=tg-session&format=mp3')
+        error = await self.receive_json(communicator)
+        self.assertEqual(error['type'], 'error')
+        self.assertEqual(await communicator.receive_output(5), {'type': 'websocket.close', 'code': 1003})
+        await communicator.wait(5)
+
+
+class SentenceSplitterTests(SimpleTestCase):
+    def test_splits_on_sentence_end_followed_by_space(self):
+        splitter = SentenceSplitter(min_length=5)
+        self.assertEqual(splitter.feed("Впереди скамейка. Справа"), ["Впереди скамейка."])
+        self.assertEqual(splitter.feed(" дверь! Иди"), ["Справа дверь!"])
+        self.assertEqual(splitter.flush(), ["Иди"])
+
+    def test_short_fragments_and_abbreviations_stick_to_next_sentence(self):
+        splitter = SentenceSplitter(min_length=20)
+        self.assertEqual(splitter.feed("Да. Это дверь, т.е. вход в магазин. "),
+                         ["Да. Это дверь, т.е. вход в магазин."])
+
+    def test_no_boundary_without_trailing_space(self):
+        splitter = SentenceSplitter(min_length=1)
+        self.assertEqual(splitter.feed("Цена 3.5"), [])
+        self.assertEqual(splitter.flush(), ["Цена 3.5"])
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+async def _collect(agen):
+    return [item async for item in agen]
+
+
+class SpeakSentencesTests(SimpleTestCase):
+    def test_chunks_follow_their_sentence_in_order(self):
+        def fake_stream(text, speed=1.0):
+            return _aiter([f"{text}:1".encode(), f"{text}:2".encode()])
+
+        with mock.patch('vision.services.text_to_speech_stream', fake_stream):
+            events = asyncio.run(_collect(speak_sentences(_aiter(["a", "b"]))))
+
+        self.assertEqual(events, [
+            ('text', 'a'), ('audio', b'a:1'), ('audio', b'a:2'),
+            ('text', 'b'), ('audio', b'b:1'), ('audio', b'b:2'),
+        ])
+
+    def test_pending_synthesis_is_cancelled_when_consumer_stops(self):
+        cancelled = []
+
+        async def slow_stream(text, speed=1.0):
+            try:
+                await asyncio.sleep(10)
+                yield b''
+            except asyncio.CancelledError:
+                cancelled.append(text)
+                raise
+
+        async def consume_first_sentence():
+            events = speak_sentences(_aiter(["a", "b"]))
+            self.assertEqual(await events.__anext__(), ('text', 'a'))
+            await asyncio.sleep(0)
+            await events.aclose()
+            await asyncio.sleep(0)
+
+        with mock.patch('vision.services.text_to_speech_stream', slow_stream):
+            asyncio.run(consume_first_sentence())
+
+        self.assertEqual(sorted(cancelled), ['a', 'b'])
+
+
+class QuotaManagerTests(TestCase):
+    def setUp(self):
+        QuotaManager.invalidate()
+        self.user = User.objects.create_user(username='quota', password='x', subscription_type='free')
+        self.addCleanup(QuotaManager.invalidate)
+
+    def fresh(self):
+        return User.objects.get(pk=self.user.pk)
+
+    def test_consume_increments_with_single_update(self):
+        with self.assertNumQueries(1):
+            QuotaManager.consume(self.user)
+        user = self.fresh()
+        self.assertEqual(user.daily_requests_count, 1)
+        self.assertEqual(user.total_requests, 1)
+        self.assertEqual(user.last_request_date, timezone.localdate())
+
+    def test_day_follows_configured_time_zone(self):
+        # 20:00 UTC 1 января - в Бишкеке (UTC+6) уже 2 января
+        utc_evening = datetime(2026, 1, 1, 20, 0, tzinfo=dt_timezone.utc)
+        User.objects.filter(pk=self.user.pk).update(daily_requests_count=7, last_request_date=date(2026, 1, 1))
+        with timezone.override('Asia/Bishkek'), mock.patch('django.utils.timezone.now', return_value=utc_evening):
+            QuotaManager.consume(self.fresh())
+        user = self.fresh()
+        self.assertEqual(user.last_request_date, date(2026, 1, 2))
+        self.assertEqual(user.daily_requests_count, 1)
+
+    def test_day_rollover_restarts_counter(self):
+        User.objects.filter(pk=self.user.pk).update(
+            daily_requests_count=7, last_request_date=timezone.localdate() - timedelta(days=1))
+        QuotaManager.consume(self.fresh())
+        self.assertEqual(self.fresh().daily_requests_count, 1)
+
+    def test_update_refuses_rows_at_limit(self):
+        limit = plan_limit('free')
+        # Лимит выбран другим процессом; объект в памяти об этом не знает
+        User.objects.filter(pk=self.user.pk).update(daily_requests_count=limit, last_request_date=timezone.localdate())
+        QuotaManager.consume(self.user)
+        self.assertEqual(self.fresh().daily_requests_count, limit)
+        self.assertFalse(QuotaManager.can_make_request(self.user))
+
+    def test_expired_cache_rereads_counter_from_db(self):
+        self.assertTrue(QuotaManager.can_make_request(self.user))
+        User.objects.filter(pk=self.user.pk).update(
+            daily_requests_count=plan_limit('free'), last_request_date=timezone.localdate())
+        # В пределах TTL - кэш, без запросов
+        with self.assertNumQueries(0):
+            self.assertTrue(QuotaManager.can_make_request(self.user))
+        QuotaManager.invalidate(self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertFalse(QuotaManager.can_make_request(self.user))
+
+
+class ProfileUpdateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='profile', password='x')
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.addCleanup(IdentityCache.invalidate_user, self.user.pk)
+
+    def test_put_keeps_counters_written_by_other_workers(self):
+        # Первый запрос кладет пользователя в IdentityCache
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 200)
+        # Счетчики меняются атомарным UPDATE в другом процессе; кэшированный объект устарел
+        User.objects.filter(pk=self.user.pk).update(daily_requests_count=5, total_requests=42)
+
+        response = self.client.put('/api/auth/profile/', {'voice_speed': 1.5}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(user.voice_speed, 1.5)
+        self.assertEqual(user.daily_requests_count, 5)
+        self.assertEqual(user.total_requests, 42)
+
+
+def _fake_llm_client(answer):
+    response = SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(content=answer))])
+    create = mock.AsyncMock(return_value=response)
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+@mock.patch.dict('os.environ', {'OPENAI_API_KEY': 'test'})
+@mock.patch('vision.services.ResponseCache.enabled', return_value=False)
+@mock.patch('vision.pipeline.text_to_speech_async', new_callable=mock.AsyncMock, return_value=b'mp3')
+@mock.patch('vision.services.get_llm_client', return_value=(_fake_llm_client("Впереди дверь."), 'test-model'))
+class SmartAnalyzeQueryCountTests(TestCase):
+    def setUp(self):
+        QuotaManager.invalidate()
+        self.user = User.objects.create_user(username='glasses', password='x')
+        self.token = Token.objects.create(user=self.user).key
+        self.addCleanup(QuotaManager.invalidate)
+        self.addCleanup(IdentityCache.invalidate_user, self.user.pk)
+        self.addCleanup(IdentityCache.invalidate_vision_user, 'tg-query-count')
+
+    def post(self, text):
+        return self.client.post(
+            '/api/smart-analyze/',
+            {'text': text, 'user_id': 'tg-query-count'},
+            HTTP_AUTHORIZATION=f'Token {self.token}',
+        )
+
+    def test_warm_request_writes_everything_in_one_flush(self, *mocks):
+        # Первый запрос прогревает кэши идентичности и квоты, создает VisionUser
+        self.assertEqual(self.post("Привет").status_code, 200)
+
+        before = QueryCounter.stats()['smart_analyze']['queries']
+        # SAVEPOINT + bulk INSERT двух реплик + UPDATE счетчика квоты + RELEASE SAVEPOINT:
+        # токен, пользователь, VisionUser и остаток квоты берутся из кэшей процесса
+        with self.assertNumQueries(4):
+            response = self.post("Что впереди?")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['message'], "Впереди дверь.")
+        self.assertEqual(QueryCounter.stats()['smart_analyze']['queries'] - before, 4)
+
+        self.assertEqual(ConversationMessage.objects.filter(vision_user__telegram_id='tg-query-count').count(), 4)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(user.daily_requests_count, 2)
+        self.assertEqual(user.total_requests, 2)
+
+    def test_unknown_or_inactive_token_is_rejected(self, *mocks):
+        response = self.client.post('/api/smart-analyze/', {'text': 'Привет', 'user_id': 'tg-query-count'},
+                                    HTTP_AUTHORIZATION='Token not-a-real-token')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['error'], 'Invalid token.')
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        IdentityCache.invalidate_user(self.user.pk)
+        response = self.post('Привет')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['error'], 'User inactive or deleted.')
+
+        # Запрос не выполнялся анонимно: ни истории, ни обращения к LLM
+        self.assertFalse(ConversationMessage.objects.filter(vision_user__telegram_id='tg-query-count').exists())
+        self.assertEqual(User.objects.get(pk=self.user.pk).total_requests, 0)
+
+
+def _fake_streaming_llm_client(*fragments):
+    async def create(**kwargs):
+        async def stream():
+            for fragment in fragments:
+                yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=fragment))])
+        return stream()
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+async def _fake_tts_stream(text, speed=1.0):
+    yield b'mp3'
+
+
+@mock.patch.dict('os.environ', {'OPENAI_API_KEY': 'test'})
+@mock.patch('vision.services.ResponseCache.enabled', return_value=False)
+@mock.patch('vision.services.text_to_speech_stream', side_effect=_fake_tts_stream)
+@mock.patch('vision.services.get_llm_client', return_value=(
+    _fake_streaming_llm_client("Впереди дверь, ", "до нее три шага."), 'test-model'))
+class SmartAnalyzeStreamTests(TestCase):
+    def setUp(self):
+        QuotaManager.invalidate()
+        self.user = User.objects.create_user(username='glasses-sse', password='x')
+        self.token = Token.objects.create(user=self.user).key
+        self.addCleanup(QuotaManager.invalidate)
+        self.addCleanup(IdentityCache.invalidate_user, self.user.pk)
+        self.addCleanup(IdentityCache.invalidate_vision_user, 'tg-sse')
+
+    async def test_stream_saves_history_and_counter_after_body(self, *mocks):
+        response = await self.async_client.post(
+            '/api/smart-analyze/',
+            {'text': 'Что впереди?', 'user_id': 'tg-sse', 'stream': '1'},
+            headers={'Authorization': f'Token {self.token}'},
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode('utf-8')
+
+        events = [block.split('\n', 1) for block in body.strip().split('\n\n')]
+        self.assertEqual([event for event, _ in events], ['event: text', 'event: audio', 'event: done'])
+        done = json.loads(events[-1][1][len('data: '):])
+        self.assertEqual(done['message'], 'Впереди дверь, до нее три шага.')
+
+        messages = await sync_to_async(lambda: list(
+            ConversationMessage.objects.filter(vision_user__telegram_id='tg-sse')
+            .order_by('created_at', 'id').values_list('role', 'content')))
+        self.assertEqual(messages, [('user', 'Что впереди?'), ('assistant', 'Впереди дверь, до нее три шага.')])
+        user = await User.objects.aget(pk=self.user.pk)
+        self.assertEqual((user.daily_requests_count, user.total_requests), (1, 1))
+
+
+class SmartAnalyzeTaskCleanupTests(TestCase):
+    def tearDown(self):
+        IdentityCache.invalidate_vision_user('tg-cleanup')
+
+    async def test_stt_cancelled_when_preprocessing_fails(self):
+        stt_started = asyncio.Event()
+        stt_cancelled = asyncio.Event()
+
+        async def fake_run_inference(pool_name, func, *args):
+            if pool_name == 'whisper':
+                stt_started.set()
+                try:
+                    await asyncio.sleep(30)
+                except asyncio.CancelledError:
+                    stt_cancelled.set()
+                    raise
+            await stt_started.wait()  # STT уже выполняется, когда кадр не декодировался
+            raise ValueError('corrupt image')
+
+        audio = np.zeros(16000, dtype=np.float32)
+        with mock.patch('vision.views.read_audio_input', return_value=audio), \
+                mock.patch('vision.views.run_inference', side_effect=fake_run_inference):
+            with self.assertRaises(ValueError):
+                await self.async_client.post('/api/smart-analyze/', {
+                    'user_id': 'tg-cleanup',
+                    'image': SimpleUploadedFile('frame.jpg', b'not a jpeg', content_type='image/jpeg'),
+                })
+        self.assertTrue(stt_cancelled.is_set())
+
+
+class InferencePoolConfigTests(SimpleTestCase):
+    def test_process_kind_only_for_picklable_pools(self):
+        env = {'INFERENCE_POOL_OCR_KIND': 'process', 'INFERENCE_POOL_YOLO_KIND': 'process',
+               'INFERENCE_POOL_TTS_KIND': 'process', 'INFERENCE_POOL_BLIP_KIND': 'bogus'}
+        with mock.patch.dict('os.environ', env):
+            self.assertEqual(InferenceExecutors._pool_config('ocr'), (1, 'process'))
+            self.assertEqual(InferenceExecutors._pool_config('yolo'), (8, 'thread'))
+            self.assertEqual(InferenceExecutors._pool_config('tts'), (1, 'thread'))
+            self.assertEqual(InferenceExecutors._pool_config('blip'), (1, 'thread'))
+
+
+def _exif_app1(orientation, endian='<'):
+    mark = b'II' if endian == '<' else b'MM'
+    tiff = (mark + struct.pack(endian + 'HI', 42, 8) + struct.pack(endian + 'H', 1)
+            + struct.pack(endian + 'HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack(endian + 'I', 0))
+    payload = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def _with_exif(jpeg, orientation, endian='<'):
+    return jpeg[:2] + _exif_app1(orientation, endian) + jpeg[2:]
+
+
+class JpegHeaderTests(SimpleTestCase):
+    def test_reads_size_and_orientation_without_decoding(self):
+        sof = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, 480, 640, 3) + b'\x00' * 3
+        data = b'\xff\xd8' + _exif_app1(6) + sof + b'\xff\xda'
+        self.assertEqual(jpeg_header(data), (640, 480, 6))
+        self.assertEqual(jpeg_header(b'\xff\xd8' + _exif_app1(3, '>') + sof), (640, 480, 3))
+
+    def test_not_a_jpeg(self):
+        self.assertIsNone(jpeg_header(b'\x89PNG\r\n\x1a\n' + b'\x00' * 32))
+        self.assertIsNone(jpeg_header(b'\xff\xd8\xff\xda\x00\x02'))
+
+
+class DecodeImageTests(SimpleTestCase):
+    def jpeg(self, width, height):
+        ok, encoded = cv2.imencode('.jpg', np.full((height, width, 3), 128, dtype=np.uint8))
+        self.assertTrue(ok)
+        return encoded.tobytes()
+
+    def test_large_jpeg_decoded_at_reduced_scale(self):
+        img = decode_image(self.jpeg(1600, 800), max_dim=400)
+        # 1/4 DCT-уменьшение: большая сторона ровно max_dim, без полного декодирования
+        self.assertEqual(img.shape[:2], (200, 400))
+
+    def test_exif_orientation_applied(self):
+        img = decode_image(_with_exif(self.jpeg(400, 200), 6), max_dim=100)
+        self.assertEqual(img.shape[:2], (100, 50))
+
+    def test_frame_resizes_to_max_dim(self):
+        frame = Frame.from_bytes(self.jpeg(1000, 500), max_dim=300)
+        self.assertEqual(max(frame.image.shape[:2]), 300)
+        self.assertIsNone(Frame.from_bytes(b'not an image', max_dim=300))
+
+
+class FrameTests(SimpleTestCase):
+    def make(self):
+        bgr = np.zeros((120, 160, 3), dtype=np.uint8)
+        bgr[:, :80] = (255, 0, 0)  # левая половина синяя (BGR)
+        return Frame(bgr, max_dim=80)
+
+    def test_pickle_round_trip_drops_lock_and_keeps_views(self):
+        frame = self.make()
+        rgb = frame.rgb
+        self.assertNotIn('_lock', frame.__getstate__())
+
+        # Так кадр уходит в process-пул (preprocess/ocr)
+        restored = pickle.loads(pickle.dumps(frame))
+
+        np.testing.assert_array_equal(restored.bgr, frame.bgr)
+        self.assertEqual(restored.max_dim, 80)
+        np.testing.assert_array_equal(restored._views['rgb'], rgb)
+        self.assertIsInstance(restored._lock, type(threading.RLock()))
+        self.assertEqual(restored.gray.shape, (60, 80))
+
+    def test_views_computed_once(self):
+        frame = self.make()
+        with mock.patch('vision.frames.cv2.cvtColor', wraps=cv2.cvtColor) as cvt_color, \
+                mock.patch('vision.frames.cv2.resize', wraps=cv2.resize) as resize:
+            rgb, gray = frame.rgb, frame.gray
+            self.assertIs(frame.rgb, rgb)
+            self.assertIs(frame.gray, gray)
+            self.assertIs(frame.image, frame.image)
+
+        self.assertEqual(cvt_color.call_count, 2)
+        self.assertEqual(resize.call_count, 1)  # уменьшение до max_dim общее для всех представлений
+        self.assertEqual(tuple(rgb[0, 0]), (0, 0, 255))
+        self.assertEqual(rgb.shape, (60, 80, 3))
+
+    def test_concurrent_access_computes_view_once(self):
+        frame = self.make()
+        start = threading.Barrier(8)
+
+        def read():
+            start.wait()
+            return frame.clahe
+
+        with mock.patch('vision.frames.cv2.createCLAHE', wraps=cv2.createCLAHE) as create_clahe:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(lambda _: read(), range(8)))
+
+        self.assertEqual(create_clahe.call_count, 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+class SceneCacheTests(SimpleTestCase):
+    def frame(self, dhash):
+        return SimpleNamespace(dhash=dhash)
+
+    def test_similar_frames_share_one_inference(self):
+        cache = SceneCache('test', threshold=2)
+        compute = mock.Mock(return_value='скамейка')
+        self.assertEqual(cache.get_or_compute(self.frame(0b1010), compute, 'u1'), 'скамейка')
+        # Расстояние Хэмминга 2 - тот же кадр
+        self.assertEqual(cache.get_or_compute(self.frame(0b0110), compute, 'u1'), 'скамейка')
+        self.assertEqual(compute.call_count, 1)
+        # Расстояние 3 - уже другой кадр
+        cache.get_or_compute(self.frame(0b0101), compute, 'u1')
+        self.assertEqual(compute.call_count, 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expired_entries_are_recomputed(self):
+        cache = SceneCache('test', threshold=0, ttl=-1)
+        compute = mock.Mock(return_value='дверь')
+        cache.get_or_compute(self.frame(1), compute)
+        cache.get_or_compute(self.frame(1), compute)
+        self.assertEqual(compute.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        cache = SceneCache('test')
+        compute = mock.Mock(side_effect=[RuntimeError('yolo'), 'ok'])
+        with self.assertRaises(RuntimeError):
+            cache.get_or_compute(self.frame(7), compute)
+        self.assertEqual(cache.get_or_compute(self.frame(7), compute), 'ok')
+
+    def test_cancelled_leader_fails_waiters(self):
+        cache = SceneCache('test')
+        leader_started = threading.Event()
+        waiter_done = threading.Event()
+        waiter_result = []
+
+        def cancelled_compute():
+            leader_started.set()
+            time.sleep(0.1)  # ведомый успевает встать в ожидание
+            raise asyncio.CancelledError()
+
+        def waiter():
+            leader_started.wait(1)
+            try:
+                waiter_result.append(cache.get_or_compute(self.frame(9), lambda: 'not the leader'))
+            except Exception as e:
+                waiter_result.append(e)
+            waiter_done.set()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        with self.assertRaises(asyncio.CancelledError):
+            cache.get_or_compute(self.frame(9), cancelled_compute)
+        self.assertTrue(waiter_done.wait(1))
+        thread.join()
+        self.assertIsInstance(waiter_result[0], RuntimeError)
+
+    def test_lru_bound(self):
+        cache = SceneCache('test', threshold=0, max_entries=2)
+        for dhash in (1, 2, 4):
+            cache.get_or_compute(self.frame(dhash), lambda: dhash)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+
+class ServerProcessDetectionTests(SimpleTestCase):
+    def check(self, argv, env=None):
+        with mock.patch('sys.argv', argv), mock.patch.dict('os.environ', env or {}, clear=False):
+            return VisionConfig._is_server_process()
+
+    def test_only_real_servers_start_background_jobs(self):
+        with mock.patch.dict('os.environ', {'VISION_BACKGROUND_JOBS': '', 'RUN_MAIN': ''}):
+            self.assertTrue(self.check(['/venv/bin/uvicorn', 'core.asgi:application']))
+            self.assertTrue(self.check(['/venv/lib/python3.11/site-packages/uvicorn/__main__.py']))
+            self.assertTrue(self.check(['gunicorn', 'core.wsgi']))
+            self.assertTrue(self.check(['manage.py', 'runserver', '--noreload']))
+            self.assertFalse(self.check(['manage.py', 'runserver']))  # процесс-наблюдатель автоперезагрузки
+            self.assertFalse(self.check(['manage.py', 'test']))
+            self.assertFalse(self.check(['/venv/bin/pytest']))
+            self.assertFalse(self.check(['bot.py']))
+            self.assertFalse(self.check(['-c']))
+            self.assertFalse(self.check(['/venv/bin/celery', 'worker']))
+
+    def test_env_flag_overrides(self):
+        self.assertTrue(self.check(['bot.py'], {'VISION_BACKGROUND_JOBS': 'True'}))
+        self.assertFalse(self.check(['/venv/bin/uvicorn'], {'VISION_BACKGROUND_JOBS': 'False'}))
+
+
+class AudioRetentionTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, size, age):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_removes_oldest_over_limits_and_reports_bytes(self):
+        self.write('old.wav', 100, age=500)
+        self.write('mid.wav', 100, age=400)
+        self.write('new.wav', 100, age=300)
+        os.mkdir(os.path.join(self.tmp.name, 'cache'))
+        self.write(os.path.join('cache', 'cached.mp3'), 100, age=1000)
+
+        stats = AudioRetention([self.tmp.name], max_files=2, grace=10).sweep()
+
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(stats['reclaimed_bytes'], 100)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['cache', 'mid.wav', 'new.wav'])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'cache', 'cached.mp3')))
+
+    def test_grace_period_protects_fresh_files(self):
+        self.write('a.wav', 100, age=5)
+        self.write('b.wav', 100, age=1)
+        stats = AudioRetention([self.tmp.name], max_bytes=50, grace=60).sweep()
+        self.assertEqual(stats['deleted'], 0)
+        self.assertEqual(stats['remaining_bytes'], 200)
+
+    def test_sweep_resyncs_tts_cache_accounting(self):
+        cache = TTSCache(self.tmp.name, '/media/tts/cache/', max_disk_bytes=10_000, max_memory_bytes=10_000)
+        for text in ('первая', 'вторая'):
+            cache.put(TTSCache.key(text, 'voice', 1.0, 'edge'), b'\0' * 100)
+        self.assertEqual(cache.stats()['disk_bytes'], 200)
+        mtime = time.time() - 1000
+        for name in os.listdir(self.tmp.name):
+            os.utime(os.path.join(self.tmp.name, name), (mtime, mtime))
+
+        sweeps = []
+        def on_sweep(result):
+            sweeps.append(result)
+            cache.resync()
+
+        AudioRetention([self.tmp.name], max_age=500, grace=10, on_sweep=on_sweep).sweep()
+
+        self.assertEqual(len(sweeps), 1)
+        self.assertEqual(sweeps[0]['deleted'], 2)
+        self.assertEqual(cache.stats()['disk_bytes'], 0)
+
+        # Проход без удалений колбэк не вызывает
+        AudioRetention([self.tmp.name], max_age=500, grace=10, on_sweep=on_sweep).sweep()
+        self.assertEqual(len(sweeps), 1)
+
+
+class TTSCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_cache(self, disk=10_000, memory=10_000):
+        return TTSCache(self.tmp.name, '/media/tts/cache/', max_disk_bytes=disk, max_memory_bytes=memory)
+
+    def test_key_is_stable_and_covers_all_parameters(self):
+        key = TTSCache.key('Путь свободен', 'ru-RU-DmitryNeural', 1.0, 'edge')
+        self.assertEqual(key, TTSCache.key(' Путь свободен ', 'ru-RU-DmitryNeural', 1.0, 'edge'))
+        self.assertTrue(key.endswith('.mp3'))
+        self.assertTrue(TTSCache.key('Путь свободен', 'ru-RU-DmitryNeural', 1.0, 'kani').endswith('.wav'))
+        variants = {
+            TTSCache.key('Путь свободен', 'ru-RU-SvetlanaNeural', 1.0, 'edge'),
+            TTSCache.key('Путь свободен', 'ru-RU-DmitryNeural', 1.2, 'edge'),
+            TTSCache.key('Путь свободен', 'ru-RU-DmitryNeural', 1.0, 'kani'),
+            TTSCache.key('Путь открыт', 'ru-RU-DmitryNeural', 1.0, 'edge'),
+        }
+        self.assertEqual(len(variants), 4)
+        self.assertNotIn(key, variants)
+
+    def test_memory_tier_evicts_least_recently_used_by_bytes(self):
+        cache = self.make_cache(memory=250)
+        cache.put('a', b'a' * 100, persist=False)
+        cache.put('b', b'b' * 100, persist=False)
+        cache.get('a')  # 'a' становится самым свежим
+        cache.put('c', b'c' * 100, persist=False)
+
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'c' * 100)
+        self.assertEqual(cache.stats()['memory_bytes'], 200)
+
+        # Аудио больше всего горячего слоя в память не кладется
+        cache.put('big', b'x' * 300, persist=False)
+        self.assertEqual(cache.stats()['memory_entries'], 2)
+
+    def test_memory_only_put_writes_no_file(self):
+        cache = self.make_cache()
+        cache.put('mem.mp3', b'audio', persist=False)
+        cache.put('disk.mp3', b'audio', persist=True)
+
+        self.assertFalse(os.path.exists(cache.path('mem.mp3')))
+        with open(cache.path('disk.mp3'), 'rb') as f:
+            self.assertEqual(f.read(), b'audio')
+
+        cold = self.make_cache()
+        self.assertIsNone(cold.get('mem.mp3'))
+        self.assertEqual(cold.get('disk.mp3'), b'audio')
+        self.assertEqual(cold.get('disk.mp3'), b'audio')
+        stats = cold.stats()
+        self.assertEqual((stats['misses'], stats['disk_hits'], stats['memory_hits']), (1, 1, 1))
+
+    def test_disk_tier_evicts_least_recently_used_files(self):
+        cache = self.make_cache(disk=250)
+        cache.put('old.mp3', b'o' * 100)
+        cache.put('new.mp3', b'n' * 100)
+        mtime = time.time() - 100
+        os.utime(cache.path('old.mp3'), (mtime, mtime))
+
+        cache.put('newest.mp3', b'z' * 100)
+
+        self.assertFalse(os.path.exists(cache.path('old.mp3')))
+        self.assertTrue(os.path.exists(cache.path('new.mp3')))
+        self.assertEqual(cache.stats()['disk_bytes'], 200)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    async def test_aget_reads_disk_off_event_loop(self):
+        self.make_cache().put('k.mp3', b'audio')
+        cache = self.make_cache()
+        offloaded = []
+        real_to_thread = asyncio.to_thread
+
+        async def to_thread(func, *args):
+            offloaded.append(func.__name__)
+            return await real_to_thread(func, *args)
+
+        with mock.patch('vision.tts_system.cache.asyncio.to_thread', to_thread):
+            self.assertEqual(await cache.aget('k.mp3'), b'audio')
+            self.assertEqual(await cache.aget('k.mp3'), b'audio')  # уже из памяти
+
+        self.assertEqual(offloaded, ['_disk_get'])
+
+
+class _FakeCommunicate:
+    """edge_tts.Communicate: отдает аудио двумя чанками вперемешку со служебными событиями"""
+    calls = []
+
+    def __init__(self, text, voice, rate=None):
+        self.calls.append((text, voice, rate))
+
+    async def stream(self):
+        yield {'type': 'audio', 'data': b'ID3-'}
+        yield {'type': 'WordBoundary', 'offset': 0}
+        yield {'type': 'audio', 'data': b'mp3'}
+
+
+class TTSManagerTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        # Отдельный экземпляр в обход синглтона: свой кэш во временной папке, без модели
+        self.manager = object.__new__(TTSManager)
+        self.manager.cache = TTSCache(self.tmp.name, '/media/tts/cache/',
+                                      max_disk_bytes=10_000, max_memory_bytes=10_000)
+        self.manager._model = None
+        _FakeCommunicate.calls = []
+        patcher = mock.patch('edge_tts.Communicate', _FakeCommunicate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_synthesize_and_stream_stay_in_memory(self):
+        self.assertEqual(await self.manager.synthesize('Путь свободен'), b'ID3-mp3')
+        self.assertEqual(await self.manager.synthesize('Путь свободен'), b'ID3-mp3')
+        self.assertEqual([c async for c in self.manager.stream('Путь свободен')], [b'ID3-mp3'])
+        self.assertEqual(len(_FakeCommunicate.calls), 1)
+
+        chunks = [c async for c in self.manager.stream('Впереди дверь', speed=1.2)]
+        self.assertEqual(chunks, [b'ID3-', b'mp3'])
+        self.assertEqual(_FakeCommunicate.calls[-1], ('Впереди дверь', 'ru-RU-DmitryNeural', '+20%'))
+        self.assertEqual(await self.manager.synthesize('Впереди дверь', speed=1.2), b'ID3-mp3')
+
+        self.assertEqual(len(_FakeCommunicate.calls), 2)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    async def test_generate_speech_writes_file_once(self):
+        url = await self.manager.generate_speech('Путь свободен')
+        self.assertEqual(await self.manager.generate_speech('Путь свободен'), url)
+
+        name = url.rsplit('/', 1)[-1]
+        self.assertTrue(url.startswith('/media/tts/cache/') and name.endswith('.mp3'))
+        self.assertEqual(os.listdir(self.tmp.name), [name])
+        with open(os.path.join(self.tmp.name, name), 'rb') as f:
+            self.assertEqual(f.read(), b'ID3-mp3')
+        self.assertEqual(len(_FakeCommunicate.calls), 1)
+
+    async def test_kani_failure_falls_back_to_edge_key(self):
+        self.manager._model = mock.Mock(generate=mock.Mock(side_effect=RuntimeError('CUDA OOM')))
+        voice = 'ru-RU-DmitryNeural'
+
+        self.assertEqual(await self.manager.synthesize('Путь свободен'), b'ID3-mp3')
+        self.assertEqual(await self.manager.synthesize('Путь свободен'), b'ID3-mp3')
+
+        # Повтор при сбое Kani отдается из кэша под ключом edge, а не синтезируется снова
+        self.assertEqual(len(_FakeCommunicate.calls), 1)
+        self.assertEqual(self.manager.cache.get(TTSCache.key('Путь свободен', voice, 1.0, 'edge')), b'ID3-mp3')
+        self.assertIsNone(self.manager.cache.get(TTSCache.key('Путь свободен', voice, 1.0, 'kani')))
+
+        url = await self.manager.generate_speech('Путь свободен')
+        self.assertTrue(url.endswith('.mp3'))
+        self.assertEqual(len(_FakeCommunicate.calls), 1)
+
+
+@mock.patch('vision.cag.save_fields')
+@mock.patch('vision.services.get_llm_client', return_value=(None, 'test-model'))
+class PromptPrefixTests(SimpleTestCase):
+    async def system_prompt(self, text, user=None, visual_context=None):
+        _, _, messages = await _prepare_llm_request(text, visual_context, user)
+        return messages[0]['content']
+
+    async def test_prefix_byte_identical_across_users_and_turns(self, *mocks):
+        anna = VisionUser(telegram_id='tg-anna')
+        boris = VisionUser(telegram_id='tg-boris', facts={'name': 'Борис', 'interests': ['шахматы'],
+                                                         'mood': 'happy', 'energy': 'high'})
+        prompts = []
+        for hour in (10, 23):
+            with mock.patch('vision.cag.datetime', mock.Mock(now=mock.Mock(return_value=datetime(2026, 1, 1, hour)))):
+                prompts += [
+                    await self.system_prompt('Привет, меня зовут Анна', anna, 'дверь'),
+                    await self.system_prompt('Я устала', anna),
+                    await self.system_prompt('Что впереди?', boris, 'лестница, перила'),
+                ]
+
+        self.assertEqual(len(set(prompts)), len(prompts))  # хвост действительно меняется
+        prefix = STATIC_SYSTEM_PROMPT.encode('utf-8')
+        common = os.path.commonprefix([prompt.encode('utf-8') for prompt in prompts])
+        self.assertEqual(common[:len(prefix)], prefix)
+        self.assertEqual(anna.facts['name'], 'Анна')
+
+    async def test_anonymous_prompts_share_static_prefix(self, *mocks):
+        first = await self.system_prompt('Что впереди?', visual_context='дверь')
+        second = await self.system_prompt('Прочитай вывеску')
+        self.assertTrue(first.startswith(WAYFINDER_SYSTEM_PROMPT))
+        self.assertTrue(second.startswith(WAYFINDER_SYSTEM_PROMPT))
+
+
+class CachedTokensTests(SimpleTestCase):
+    def test_deepseek_usage(self):
+        usage = SimpleNamespace(prompt_tokens=1100, prompt_cache_hit_tokens=1024, prompt_cache_miss_tokens=76)
+        self.assertEqual(_cached_tokens(usage), 1024)
+        # Промах DeepSeek - это 0, а не повод искать поле OpenAI
+        miss = SimpleNamespace(prompt_tokens=1100, prompt_cache_hit_tokens=0,
+                               prompt_tokens_details=SimpleNamespace(cached_tokens=512))
+        self.assertEqual(_cached_tokens(miss), 0)
+
+    def test_openai_usage(self):
+        usage = SimpleNamespace(prompt_tokens=2048, prompt_tokens_details=SimpleNamespace(cached_tokens=1536))
+        self.assertEqual(_cached_tokens(usage), 1536)
+        self.assertEqual(_cached_tokens(SimpleNamespace(
+            prompt_tokens=10, prompt_tokens_details=SimpleNamespace(cached_tokens=None))), 0)
+        self.assertEqual(_cached_tokens(SimpleNamespace(prompt_tokens=10, prompt_tokens_details=None)), 0)
+        self.assertEqual(_cached_tokens(SimpleNamespace(prompt_tokens=10)), 0)
+
+
+class DatabaseSettingsTests(SimpleTestCase):
+    """core/settings.py исполняется заново с заданным окружением"""
+
+    def databases(self, **env):
+        env.setdefault('DB_CONN_MAX_AGE', '60')
+        env.setdefault('DB_POOL', 'False')
+        with mock.patch.dict('os.environ', env):
+            namespace = runpy.run_path(os.path.join(settings.BASE_DIR, 'core', 'settings.py'))
+        return namespace['DATABASES']['default']
+
+    @skipUnless(django.VERSION >= (5, 1), 'OPTIONS["pool"] появился в Django 5.1')
+    def test_pool_built_only_for_postgres(self):
+        db = self.databases(DATABASE_URL='postgres://vision:x@db:5432/vision', DB_POOL='True',
+                            DB_POOL_MIN_SIZE='4', DB_POOL_MAX_SIZE='16', DB_POOL_TIMEOUT='2.5')
+        self.assertEqual(db['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual(db['OPTIONS']['pool'], {'min_size': 4, 'max_size': 16, 'timeout': 2.5})
+        # Пул несовместим с постоянными соединениями
+        self.assertEqual(db['CONN_MAX_AGE'], 0)
+
+    def test_sqlite_left_unchanged_by_db_pool(self):
+        db = self.databases(DATABASE_URL='sqlite:////tmp/vision-test.sqlite3', DB_POOL='True')
+        self.assertEqual(db['ENGINE'], 'django.db.backends.sqlite3')
+        self.assertNotIn('pool', db.get('OPTIONS', {}))
+        self.assertEqual(db['CONN_MAX_AGE'], 60)
+
+    def test_postgres_without_db_pool_keeps_persistent_connections(self):
+        db = self.databases(DATABASE_URL='postgres://vision:x@db:5432/vision')
+        self.assertNotIn('pool', db.get('OPTIONS', {}))
+        self.assertEqual(db['CONN_MAX_AGE'], 60)
+
+
+class _FakePool:
+    def get_stats(self):
+        return {'pool_size': 4, 'connections_num': 5, 'pool_available': 1, 'requests_waiting': 2,
+                'requests_num': 8, 'requests_wait_ms': 20, 'requests_errors': 1}
+
+
+class ConnectionStatsTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(ConnectionStats, _stats={}, _threads={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counts_connections_and_threads_per_alias(self):
+        connection = SimpleNamespace(alias='default')
+        both_running = threading.Barrier(2)  # иначе второй поток может получить ident первого
+
+        def open_connections():
+            for _ in range(3):
+                ConnectionStats.on_connection_created(connection=connection)
+            both_running.wait()
+
+        threads = [threading.Thread(target=open_connections) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = ConnectionStats.stats()['default']
+        self.assertEqual(stats['opened'], 6)
+        self.assertEqual(stats['threads'], 2)
+        self.assertIsNotNone(stats['last_opened'])
+        self.assertEqual(stats['engine'], settings.DATABASES['default']['ENGINE'])
+        self.assertIsNone(stats['pool'])  # тесты идут без пула
+
+    def test_pool_stats_read_from_psycopg_pool(self):
+        pooled = SimpleNamespace(settings_dict={'OPTIONS': {'pool': {'max_size': 4}}}, pool=_FakePool())
+        unpooled = SimpleNamespace(settings_dict={}, pool=_FakePool())
+        with mock.patch('vision.db_stats.connections', {'pooled': pooled, 'plain': unpooled}):
+            self.assertEqual(ConnectionStats._pool_stats('pooled'), {
+                'size': 4, 'connections_opened': 5, 'available': 1, 'waiting': 2,
+                'requests': 8, 'wait_ms_total': 20, 'wait_ms_avg': 2.5, 'timeouts': 1,
+            })
+            self.assertIsNone(ConnectionStats._pool_stats('plain'))
+
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Минимальный OpenAI-совместимый /chat/completions с keep-alive"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        body = json.dumps({
+            'id': 'chatcmpl-test',
+            'object': 'chat.completion',
+            'created': 0,
+            'model': request['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': 'Впереди дверь.'}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 3, 'total_tokens': 13},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LLMClientPoolTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeOpenAIHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}/v1'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    async def ask(self, times):
+        client, model_name = LLMClientPool.get('sk-test', base_url=self.base_url)
+        answers = []
+        for _ in range(times):
+            response = await client.chat.completions.create(
+                model=model_name, messages=[{'role': 'user', 'content': 'Что впереди?'}])
+            answers.append(response.choices[0].message.content)
+        return answers, client
+
+    def test_requests_in_one_loop_share_connection(self):
+        before = LLMClientPool.stats()
+        answers, _ = asyncio.run(self.ask(3))
+        after = LLMClientPool.stats()
+
+        self.assertEqual(answers, ['Впереди дверь.'] * 3)
+        self.assertEqual(after['clients_created'] - before['clients_created'], 1)
+        self.assertEqual(after['requests'] - before['requests'], 3)
+        self.assertEqual(after['new_connections'] - before['new_connections'], 1)
+
+    def test_clients_closed_with_request_loop(self):
+        # WSGI: async view выполняется через async_to_sync в отдельном loop
+        answers, client = async_to_sync(self.ask)(1)
+        self.assertEqual(answers, ['Впереди дверь.'])
+        self.assertTrue(client.is_closed())
+        self.assertEqual(LLMClientPool.stats()['open_clients'], 0)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def test_is_cacheable_matches_short_markers_as_whole_words(self):
+        self.assertTrue(is_cacheable('Что изображено?'))
+        self.assertTrue(is_cacheable('Включи радио'))
+        self.assertTrue(is_cacheable('Это временный знак?'))
+        self.assertFalse(is_cacheable('Я рад тебя слышать'))
+        self.assertFalse(is_cacheable('Сколько сейчас время?'))
+        self.assertFalse(is_cacheable('Где моё кресло?'))
+        self.assertFalse(is_cacheable('Я очень устала'))
+        self.assertFalse(is_cacheable('Меня зовут Саша'))
+        self.assertFalse(is_cacheable('  ?! '))
+
+    def test_key_normalizes_text_and_separates_scope_and_context(self):
+        key = ResponseCache.key('Что изображено?', 'стол', scope='user:1')
+        self.assertEqual(key, ResponseCache.key('  что   ИЗОБРАЖЕНО ', 'стол', scope='user:1'))
+        self.assertNotEqual(key, ResponseCache.key('Что изображено?', 'стол', scope='user:2'))
+        self.assertNotEqual(key, ResponseCache.key('Что изображено?', 'дверь', scope='user:1'))
+        self.assertNotEqual(key, ResponseCache.key('Что изображено?', 'стол', facts={'mood': 'tired'}, scope='user:1'))
+
+    def test_memory_tier_expires_and_evicts_lru(self):
+        cache = ResponseCache(ttl=60, max_entries=2)
+        with mock.patch('vision.response_cache.time.time', return_value=1000.0):
+            cache.set('a', 'A')
+            cache.set('b', 'B')
+            self.assertEqual(cache.get('a'), 'A')
+            cache.set('c', 'C')  # вытесняет 'b' - к нему обращались давнее
+            self.assertIsNone(cache.get('b'))
+        with mock.patch('vision.response_cache.time.time', return_value=1061.0):
+            self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['memory_hits'], stats['misses'], stats['stores']), (1, 2, 3))
+
+    def test_sqlite_tier_is_shared_between_instances(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'llm_cache.sqlite3')
+            writer = ResponseCache(ttl=60, sqlite_path=path)
+            reader = ResponseCache(ttl=60, sqlite_path=path)
+            asyncio.run(writer.aset('k', 'Впереди дверь.'))
+            self.assertEqual(asyncio.run(reader.aget('k')), 'Впереди дверь.')
+            self.assertEqual(reader.stats()['shared_hits'], 1)
+            writer._db.close()
+            reader._db.close()
+
+
+class ConversationMessageMigrationTests(TransactionTestCase):
+    """0003: JSON-история из VisionUser.context переносится в строки ConversationMessage"""
+    migrate_from = [('vision', '0002_visionuser_facts_alter_user_id_alter_visionuser_id')]
+    migrate_to = [('vision', '0003_conversationmessage')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        VisionUser = executor.loader.project_state(self.migrate_from).apps.get_model('vision', 'VisionUser')
+        VisionUser.objects.create(telegram_id='tg-history', context=json.dumps([
+            {'role': 'user', 'content': 'Что впереди?'},
+            {'role': 'assistant', 'content': 'Впереди дверь.'},
+            'not a message',
+            {'role': 'user'},
+            {'content': 'Без роли'},
+        ], ensure_ascii=False))
+        VisionUser.objects.create(telegram_id='tg-broken', context='{not json')
+        VisionUser.objects.create(telegram_id='tg-object', context=json.dumps({'role': 'user', 'content': 'x'}))
+        VisionUser.objects.create(telegram_id='tg-empty', context='')
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        self.apps = executor.loader.project_state(self.migrate_to).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_history_copied_in_order(self):
+        ConversationMessage = self.apps.get_model('vision', 'ConversationMessage')
+        messages = ConversationMessage.objects.order_by('created_at')
+        self.assertEqual(
+            [(m.vision_user.telegram_id, m.role, m.content) for m in messages],
+            [('tg-history', 'user', 'Что впереди?'),
+             ('tg-history', 'assistant', 'Впереди дверь.'),
+             ('tg-history', 'user', 'Без роли')],
+        )
+
+
+class STTProfileTests(SimpleTestCase):
+    def test_requested_profile_clamped_to_plan(self):
+        free = SimpleNamespace(subscription_type='free')
+        premium = SimpleNamespace(subscription_type='premium')
+        pro = SimpleNamespace(subscription_type='pro')
+        self.assertEqual(resolve_stt_profile('accurate', free).name, 'fast')
+        self.assertEqual(resolve_stt_profile('accurate', premium).name, 'balanced')
+        self.assertEqual(resolve_stt_profile('accurate', pro).name, 'accurate')
+        self.assertEqual(resolve_stt_profile('fast', pro).name, 'fast')
+        self.assertEqual(resolve_stt_profile('unknown', premium).name, 'balanced')
+
+    def test_anonymous_limited_to_default_profile(self):
+        with mock.patch.dict('os.environ', {'STT_PROFILE': 'balanced'}):
+            self.assertEqual(resolve_stt_profile('accurate').name, 'balanced')
+            self.assertEqual(resolve_stt_profile('fast').name, 'fast')
+            self.assertEqual(resolve_stt_profile().name, 'balanced')
+
+    def test_language_auto_detected_unless_configured(self):
+        with mock.patch.dict('os.environ'):
+            os.environ.pop('STT_DEFAULT_LANGUAGE', None)
+            self.assertIsNone(stt_language())
+            self.assertIsNone(stt_language(SimpleNamespace(preferred_language='')))
+            self.assertEqual(stt_language(SimpleNamespace(preferred_language='en-US')), 'en')
+            self.assertIsNone(stt_language(SimpleNamespace(preferred_language='auto')))
+        with mock.patch.dict('os.environ', {'STT_DEFAULT_LANGUAGE': 'ru'}):
+            self.assertEqual(stt_language(), 'ru')
+            self.assertEqual(stt_language(SimpleNamespace(preferred_language='kk')), 'kk')
+
+
+class _FakeOpusError(Exception):
+    pass
+
+
+class _FakeOpusDecoder:
+    def __init__(self, sample_rate, channels):
+        pass
+
+    def decode(self, packet, frame_size):
+        if packet == b'bad':
+            raise _FakeOpusError('corrupted stream')
+        return struct.pack('<2h', 16384, -16384)
+
+
+class OpusInputTests(SimpleTestCase):
+    def setUp(self):
+        opuslib = SimpleNamespace(Decoder=_FakeOpusDecoder, OpusError=_FakeOpusError)
+        patcher = mock.patch.dict(sys.modules, {'opuslib': opuslib})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def packets(self, *payloads):
+        return b''.join(struct.pack('>H', len(p)) + p for p in payloads)
+
+    def test_decodes_length_prefixed_packets(self):
+        audio = decode_declared_audio(self.packets(b'ok', b'ok'), 'opus')
+        self.assertEqual(audio.tolist(), [0.5, -0.5, 0.5, -0.5])
+
+    def test_malformed_input_is_format_error(self):
+        with self.assertRaises(AudioFormatError):
+            decode_declared_audio(self.packets(b'ok', b'bad'), 'opus')
+        with self.assertRaises(AudioFormatError):
+            decode_declared_audio(self.packets(b'ok')[:-1], 'opus')
+
+
+def _isolated_registry(**overrides):
+    """Пустое состояние ModelRegistry на время теста (загрузчики - копия)"""
+    state = dict(
+        _loaders=dict(ModelRegistry._loaders), _models=OrderedDict(), _info={}, _last_used={},
+        _known_sizes={}, _declared_sizes={}, _leases={}, _counters={}, _load_locks={}, _pinned=set(),
+        budget_bytes=0, idle_timeout=0,
+    )
+    state.update(overrides)
+    return mock.patch.multiple(ModelRegistry, **state)
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def setUp(self):
+        patcher = _isolated_registry()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_yolo_module_and_local_brain_share_one_instance(self):
+        loader = mock.Mock(side_effect=lambda: object())
+        ModelRegistry.register('yolo', loader)
+        with YOLOModel.lease() as from_yolo_module, LocalBrain.yolo_model() as from_local_brain:
+            self.assertIs(from_yolo_module, from_local_brain)
+        self.assertIs(YOLOModel.get_instance(), from_local_brain)
+        loader.assert_called_once()
+
+    def test_concurrent_first_requests_load_once(self):
+        started = threading.Event()
+
+        def slow_loader():
+            started.wait(1)
+            return object()
+
+        loader = mock.Mock(side_effect=slow_loader)
+        ModelRegistry.register('blip', loader)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(ModelRegistry.get('blip'))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        started.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(model) for model in results}), 1)
+        loader.assert_called_once()
+
+
+class _FakeModel:
+    def __init__(self, name):
+        self.name = name
+
+
+@mock.patch('vision.model_registry._release_memory')
+@mock.patch('vision.model_registry._current_rss', return_value=None)  # RSS недоступен
+class ModelRegistryMemoryTests(SimpleTestCase):
+    MB = 1024 * 1024
+
+    def setUp(self):
+        patcher = _isolated_registry(budget_bytes=250 * self.MB, idle_timeout=60, _sweeper=object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for model_id in ('a', 'b', 'c'):
+            ModelRegistry.register(model_id, functools.partial(_FakeModel, model_id), size_bytes=100 * self.MB)
+
+    def loaded(self):
+        return [m for m in ('a', 'b', 'c') if ModelRegistry.is_loaded(m)]
+
+    def test_declared_sizes_enforce_budget_in_lru_order(self, *mocks):
+        ModelRegistry.get('a')
+        ModelRegistry.get('b')
+        ModelRegistry.get('a')  # 'b' теперь самая давно использованная
+        ModelRegistry.get('c')
+        self.assertEqual(self.loaded(), ['a', 'c'])
+        self.assertEqual(ModelRegistry.stats()['models']['b']['evictions'], 1)
+        self.assertEqual(ModelRegistry.stats()['resident_model_bytes'], 200 * self.MB)
+
+    def test_pinned_model_is_never_evicted(self, *mocks):
+        ModelRegistry.pin('a')
+        ModelRegistry.get('a')
+        ModelRegistry.get('b')
+        ModelRegistry.get('c')
+        self.assertEqual(self.loaded(), ['a', 'c'])
+
+    def test_leased_model_survives_until_released(self, *mocks):
+        with ModelRegistry.lease('a') as model:
+            ModelRegistry.get('b')
+            ModelRegistry.get('c')
+            self.assertEqual(self.loaded(), ['a', 'c'])
+            self.assertEqual(model.name, 'a')
+            self.assertEqual(ModelRegistry.stats()['models']['a']['leases'], 1)
+        self.assertEqual(ModelRegistry.stats()['models']['a']['leases'], 0)
+
+    def test_eviction_deferred_by_lease_happens_on_release(self, *mocks):
+        ModelRegistry.budget_bytes = 150 * self.MB
+        with ModelRegistry.lease('a'):
+            with ModelRegistry.lease('b'):
+                self.assertEqual(self.loaded(), ['a', 'b'])  # обе в работе - вытеснять нечего
+            self.assertEqual(self.loaded(), ['a'])
+
+    def test_idle_unload_skips_pinned_and_leased(self, *mocks):
+        ModelRegistry.pin('a')
+        ModelRegistry.budget_bytes = 0
+        for model_id in ('a', 'b', 'c'):
+            ModelRegistry.get(model_id)
+        with mock.patch('vision.model_registry.time.monotonic', return_value=time.monotonic() + 120):
+            with ModelRegistry.lease('c'):
+                self.assertEqual(ModelRegistry.unload_idle(), ['b'])
+        self.assertEqual(self.loaded(), ['a', 'c'])
+
+    def test_unknown_size_falls_back_to_default(self, *mocks):
+        ModelRegistry.register('d', functools.partial(_FakeModel, 'd'))
+        ModelRegistry.get('d')
+        self.assertEqual(ModelRegistry.stats()['models']['d']['size_bytes'], ModelRegistry.default_size)
+
+
+class _StubDetector:
+    """Вместо YOLO: запоминает размеры батчей, 'bad' в батче - ошибка"""
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.kwargs = []
+
+    def predict(self, images, **kwargs):
+        if not isinstance(images, list):
+            images = [images]
+        self.batch_sizes.append(len(images))
+        self.kwargs.append(kwargs)
+        if 'bad' in images:
+            raise RuntimeError('predict failed')
+        return [f'result:{image}' for image in images]
+
+
+class DetectionBatcherTests(SimpleTestCase):
+    def setUp(self):
+        patcher = _isolated_registry()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.model = _StubDetector()
+        ModelRegistry.register('stub-yolo', lambda: self.model)
+
+    def submit_concurrently(self, batcher, images):
+        barrier = threading.Barrier(len(images))
+        results = {}
+
+        def worker(image):
+            barrier.wait()
+            try:
+                results[image] = batcher.predict(image)
+            except Exception as e:
+                results[image] = e
+
+        threads = [threading.Thread(target=worker, args=(image,)) for image in images]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_full_batches_flush_at_max_batch_and_fan_out_results(self):
+        batcher = DetectionBatcher('stub-yolo', window_ms=2000, max_batch=4, conf=0.3)
+        images = [f'frame{i}' for i in range(8)]
+        results = self.submit_concurrently(batcher, images)
+
+        self.assertEqual(results, {image: f'result:{image}' for image in images})
+        self.assertEqual(self.model.batch_sizes, [4, 4])
+        self.assertEqual(self.model.kwargs, [{'conf': 0.3}] * 2)
+        stats = batcher.stats()
+        self.assertEqual((stats['requests'], stats['batches']), (8, 2))
+        self.assertEqual(stats['batch_size_histogram'], {4: 2})
+        self.assertEqual(stats['avg_batch_size'], 4.0)
+        self.assertIsNotNone(stats['queue_delay_ms']['p95'])
+
+    def test_partial_batch_flushes_when_window_expires(self):
+        batcher = DetectionBatcher('stub-yolo', window_ms=200, max_batch=8)
+        started = time.perf_counter()
+        results = self.submit_concurrently(batcher, ['a', 'b', 'c'])
+        self.assertEqual(results, {'a': 'result:a', 'b': 'result:b', 'c': 'result:c'})
+        self.assertEqual(self.model.batch_sizes, [3])
+        self.assertLess(time.perf_counter() - started, 2.0)
+
+    def test_batch_error_reaches_every_waiter(self):
+        batcher = DetectionBatcher('stub-yolo', window_ms=2000, max_batch=2)
+        results = self.submit_concurrently(batcher, ['bad', 'ok'])
+        self.assertIsInstance(results['bad'], RuntimeError)
+        self.assertIs(results['ok'], results['bad'])
+        self.assertEqual(self.model.batch_sizes, [2])
+
+    def test_zero_window_calls_model_directly(self):
+        batcher = DetectionBatcher('stub-yolo', window_ms=0)
+        self.assertEqual(batcher.predict('x'), 'result:x')
+        self.assertEqual(self.model.batch_sizes, [1])
+        self.assertEqual(batcher.stats()['batch_size_histogram'], {1: 1})
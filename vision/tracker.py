@@ -0,0 +1,327 @@
+"""
+Трекер объектов для режима навигатора (IoU, в духе ByteTrack).
+
+Раньше навигатор на каждый кадр отдавал весь список классов, и клиент снова
+и снова озвучивал одну и ту же сцену. Трекер присваивает рамкам YOLO
+стабильные ID и сообщает только изменения:
+    new          - объект появился (подтвержден NAV_TRACK_MIN_HITS детекциями)
+    approaching  - рамка выросла в NAV_APPROACH_RATIO раз с прошлого объявления
+    gone         - объявленный объект пропал на NAV_TRACK_MAX_MISSES детекций
+
+Детекция запускается на каждом NAV_DETECT_EVERY-м кадре; между ними рамки
+сдвигаются по постоянной скорости (предсказание без инференса).
+
+Сопоставление в два прохода, как в ByteTrack: сначала уверенные детекции
+(>= NAV_TRACK_HIGH_CONF), затем оставшиеся слабые - только для продления
+существующих треков (новые треки из слабых детекций не создаются).
+Уверенные детекции, не прошедшие порог IoU, дополнительно сопоставляются
+по расстоянию между центрами: при быстром приближении рамка растет в разы,
+IoU падает ниже порога, но объект остается на месте - это "приближается",
+а не "пропал" + "новый".
+
+Настройки:
+    NAV_DETECT_EVERY=3         # детекция на каждом N-м кадре (1 - на каждом)
+    NAV_TRACK_IOU=0.3          # минимальный IoU для сопоставления
+    NAV_TRACK_CENTER_DIST=0.5  # макс. сдвиг центра (доля большей стороны рамок) без IoU
+    NAV_TRACK_HIGH_CONF=0.5    # порог уверенных детекций
+    NAV_TRACK_MIN_HITS=2       # детекций до объявления нового объекта
+    NAV_TRACK_MAX_MISSES=3     # пропущенных детекций до "пропал"
+    NAV_APPROACH_RATIO=1.3     # рост площади рамки для "приближается"
+    NAV_TRACKER_TTL=120        # секунд: трекер неактивного пользователя удаляется
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+def iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    if inter <= 0:
+        return 0.0
+    union = box_area(a) + box_area(b) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def box_area(box):
+    return max(0.0, box[2] - box[0]) * max(0.0, box[3] - box[1])
+
+
+def center_similarity(a, b, max_distance):
+    """
+    1 - (расстояние между центрами / большая сторона рамок); 0, если центры
+    дальше max_distance таких сторон. Не зависит от изменения размера рамки.
+    """
+    dx = (a[0] + a[2] - b[0] - b[2]) / 2
+    dy = (a[1] + a[3] - b[1] - b[3]) / 2
+    scale = max(a[2] - a[0], a[3] - a[1], b[2] - b[0], b[3] - b[1])
+    if scale <= 0:
+        return 0.0
+    distance = (dx * dx + dy * dy) ** 0.5 / scale
+    return 1.0 - distance if distance <= max_distance else 0.0
+
+
+def box_position(box):
+    """Положение по горизонтали: left / center / right"""
+    cx = (box[0] + box[2]) / 2
+    if cx < 1 / 3:
+        return 'left'
+    if cx > 2 / 3:
+        return 'right'
+    return 'center'
+
+
+class Track:
+    __slots__ = ('id', 'class_name', 'box', 'confidence', 'velocity', 'hits', 'misses',
+                 'announced', 'ref_area', 'seen_at', 'predicted_at')
+
+    def __init__(self, track_id, class_name, box, confidence, now):
+        self.id = track_id
+        self.class_name = class_name
+        self.box = tuple(box)
+        self.confidence = confidence
+        self.velocity = (0.0, 0.0, 0.0, 0.0)  # изменение координат рамки в секунду
+        self.hits = 1
+        self.misses = 0
+        self.announced = False
+        self.ref_area = box_area(box)  # площадь при последнем объявлении
+        self.seen_at = now
+        self.predicted_at = now
+
+    def predict(self, now):
+        dt = now - self.predicted_at
+        if dt > 0:
+            self.box = tuple(min(1.0, max(0.0, c + v * dt)) for c, v in zip(self.box, self.velocity))
+            self.predicted_at = now
+
+    def observe(self, box, confidence, now):
+        dt = now - self.seen_at
+        if dt > 0:
+            # Скорость считается от предсказанной рамки: при точном предсказании не меняется
+            measured = tuple(v + (n - p) / dt for v, n, p in zip(self.velocity, box, self.box))
+            self.velocity = tuple(0.5 * v + 0.5 * m for v, m in zip(self.velocity, measured))
+        self.box = tuple(box)
+        self.confidence = confidence
+        self.hits += 1
+        self.misses = 0
+        self.seen_at = self.predicted_at = now
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'class': self.class_name,
+            'position': box_position(self.box),
+            'box': [round(c, 4) for c in self.box],
+            'confidence': round(self.confidence, 3),
+        }
+
+
+class ObjectTracker:
+    """
+    Трекер одного пользователя / одной сессии очков.
+
+    Использование:
+        tracker = ObjectTracker.from_env()
+        if tracker.should_detect():
+            events = tracker.update(detect_boxes_local(frame))
+        else:
+            events = tracker.predict()
+    """
+    _totals = {'detections': 0, 'predictions': 0, 'events': 0}
+    _totals_lock = threading.Lock()
+
+    def __init__(self, detect_every=3, iou_threshold=0.3, high_conf=0.5,
+                 min_hits=2, max_misses=3, approach_ratio=1.3, center_distance=0.5):
+        self.detect_every = max(1, detect_every)
+        self.iou_threshold = iou_threshold
+        self.center_distance = center_distance
+        self.high_conf = high_conf
+        self.min_hits = max(1, min_hits)
+        self.max_misses = max_misses
+        self.approach_ratio = approach_ratio
+        self.tracks = []
+        self.last_used = time.monotonic()
+        self._next_id = 1
+        self._skipped = self.detect_every  # первый кадр всегда с детекцией
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            detect_every=int(os.getenv('NAV_DETECT_EVERY', '3')),
+            iou_threshold=float(os.getenv('NAV_TRACK_IOU', '0.3')),
+            high_conf=float(os.getenv('NAV_TRACK_HIGH_CONF', '0.5')),
+            min_hits=int(os.getenv('NAV_TRACK_MIN_HITS', '2')),
+            max_misses=int(os.getenv('NAV_TRACK_MAX_MISSES', '3')),
+            approach_ratio=float(os.getenv('NAV_APPROACH_RATIO', '1.3')),
+            center_distance=float(os.getenv('NAV_TRACK_CENTER_DIST', '0.5')),
+        )
+
+    @classmethod
+    def _count(cls, key, n=1):
+        with cls._totals_lock:
+            cls._totals[key] += n
+
+    @classmethod
+    def totals(cls):
+        with cls._totals_lock:
+            return dict(cls._totals)
+
+    def should_detect(self):
+        """Нужен ли инференс на этом кадре (иначе - predict())"""
+        return self._skipped >= self.detect_every - 1
+
+    def predict(self, now=None):
+        """Кадр без детекции: рамки сдвигаются по скорости, событий нет"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.last_used = now
+            self._skipped += 1
+            for track in self.tracks:
+                track.predict(now)
+        self._count('predictions')
+        return []
+
+    def _by_iou(self, a, b):
+        overlap = iou(a, b)
+        return overlap if overlap >= self.iou_threshold else 0.0
+
+    def _by_center(self, a, b):
+        return center_similarity(a, b, self.center_distance)
+
+    def _match(self, tracks, detections, similarity):
+        """
+        Жадное сопоставление внутри класса по similarity(track_box, box) > 0:
+        (пары, свободные треки, свободные детекции)
+        """
+        candidates = []
+        for ti, track in enumerate(tracks):
+            for di, (class_name, _, box) in enumerate(detections):
+                if class_name != track.class_name:
+                    continue
+                score = similarity(track.box, box)
+                if score > 0:
+                    candidates.append((score, ti, di))
+        candidates.sort(reverse=True)
+
+        pairs, used_tracks, used_dets = [], set(), set()
+        for _, ti, di in candidates:
+            if ti in used_tracks or di in used_dets:
+                continue
+            used_tracks.add(ti)
+            used_dets.add(di)
+            pairs.append((tracks[ti], detections[di]))
+        free_tracks = [t for i, t in enumerate(tracks) if i not in used_tracks]
+        free_dets = [d for i, d in enumerate(detections) if i not in used_dets]
+        return pairs, free_tracks, free_dets
+
+    def update(self, detections, now=None):
+        """
+        detections - [(class_name, confidence, (x1, y1, x2, y2)), ...] с нормированными
+        координатами. Возвращает события [{'event': 'new'|'approaching'|'gone', ...}].
+        """
+        now = time.monotonic() if now is None else now
+        events = []
+        with self._lock:
+            self.last_used = now
+            self._skipped = 0
+            for track in self.tracks:
+                track.predict(now)
+
+            high = [d for d in detections if d[1] >= self.high_conf]
+            low = [d for d in detections if d[1] < self.high_conf]
+            pairs, free_tracks, new_dets = self._match(self.tracks, high, self._by_iou)
+            center_pairs, free_tracks, new_dets = self._match(free_tracks, new_dets, self._by_center)
+            low_pairs, free_tracks, _ = self._match(free_tracks, low, self._by_iou)
+            pairs += center_pairs + low_pairs
+
+            for track, (_, confidence, box) in pairs:
+                track.observe(box, confidence, now)
+                if not track.announced:
+                    continue
+                area = box_area(track.box)
+                if track.ref_area > 0 and area >= track.ref_area * self.approach_ratio:
+                    track.ref_area = area
+                    events.append(self._event('approaching', track))
+                elif area < track.ref_area:
+                    track.ref_area = area  # отдалился - следующее приближение считаем от нового размера
+
+            for track in free_tracks:
+                track.misses += 1
+                track.velocity = tuple(v * 0.5 for v in track.velocity)  # без наблюдений не "уплывает"
+            for track in [t for t in free_tracks if t.misses >= self.max_misses]:
+                self.tracks.remove(track)
+                if track.announced:
+                    events.append(self._event('gone', track))
+
+            for class_name, confidence, box in new_dets:
+                self.tracks.append(Track(self._next_id, class_name, box, confidence, now))
+                self._next_id += 1
+
+            for track in self.tracks:
+                if not track.announced and track.misses == 0 and track.hits >= self.min_hits:
+                    track.announced = True
+                    track.ref_area = box_area(track.box)
+                    events.append(self._event('new', track))
+
+        self._count('detections')
+        self._count('events', len(events))
+        return events
+
+    def _event(self, kind, track):
+        event = track.as_dict()
+        event['event'] = kind
+        return event
+
+    def objects(self):
+        """Подтвержденные (объявленные) объекты сцены"""
+        with self._lock:
+            return [t.as_dict() for t in self.tracks if t.announced]
+
+
+class TrackerStore:
+    """
+    Трекеры HTTP-навигатора по user_id (LRU + удаление неактивных).
+    Сессия очков по WebSocket держит свой трекер сама.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, ttl=120.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._trackers = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls(ttl=float(os.getenv('NAV_TRACKER_TTL', '120')))
+        return cls._default
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tracker = self._trackers.get(key)
+            if tracker is not None and now - tracker.last_used > self.ttl:
+                tracker = None  # сцена устарела - начинаем заново, иначе все объекты "пропадут" разом
+            if tracker is None:
+                tracker = self._trackers[key] = ObjectTracker.from_env()
+            tracker.last_used = now
+            self._trackers.move_to_end(key)
+            # В начале словаря - давно не использованные
+            while self._trackers:
+                oldest = next(iter(self._trackers.values()))
+                if len(self._trackers) <= self.max_entries and now - oldest.last_used <= self.ttl:
+                    break
+                self._trackers.popitem(last=False)
+            return tracker
+
+    def stats(self):
+        with self._lock:
+            sessions = len(self._trackers)
+        return {'sessions': sessions, **ObjectTracker.totals()}
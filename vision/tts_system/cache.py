@@ -0,0 +1,186 @@
+"""
+Контентно-адресуемый кэш синтезированной речи.
+
+Ключ - хэш (текст, голос, скорость, бэкенд) с расширением аудио этого бэкенда,
+то есть сразу имя файла. Горячий слой живет в памяти;
+на диск (media/tts/cache, LRU по времени доступа с ограничением размера)
+попадают только аудио, на которые выдана ссылка, и заранее озвученные фразы.
+Попадание в кэш полностью пропускает синтез (и сетевой запрос EdgeTTS).
+"""
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .config import TTSConfig
+
+logger = logging.getLogger(__name__)
+
+
+class TTSCache:
+    """
+    Использование:
+        key = TTSCache.key(text, voice, speed, backend)
+        audio = cache.get(key)         # bytes или None
+        audio = await cache.aget(key)  # то же из async кода (диск читается вне event loop)
+        cache.put(key, audio, persist=False)  # только память
+        cache.url(key)                 # /media/tts/cache/<hash>.mp3 (EdgeTTS) или .wav (KaniTTS)
+    """
+
+    def __init__(self, directory, url_prefix, max_disk_bytes, max_memory_bytes):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # считается при первой записи, дальше ведется инкрементально
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text, voice, speed, backend):
+        raw = f"{backend}\x1f{voice}\x1f{speed:.2f}\x1f{text.strip()}"
+        digest = hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+        return f"{digest}{TTSConfig.AUDIO_EXTENSIONS[backend]}"
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def url(self, key):
+        return f"{self.url_prefix}{key}"
+
+    def _remember(self, key, audio):
+        # Вызывается под self._lock
+        if len(audio) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _memory_get(self, key):
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+            return audio
+
+    def _disk_get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)  # отметка доступа для LRU на диске
+        except OSError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._remember(key, audio)
+        return audio
+
+    def get(self, key):
+        """Аудио из памяти или с диска (с поднятием в горячий слой)"""
+        audio = self._memory_get(key)
+        if audio is not None:
+            return audio
+        return self._disk_get(key)
+
+    async def aget(self, key):
+        """get для event loop: память проверяется сразу, чтение диска - в отдельном потоке"""
+        audio = self._memory_get(key)
+        if audio is not None:
+            return audio
+        return await asyncio.to_thread(self._disk_get, key)
+
+    def put(self, key, audio, persist=True):
+        """
+        Сохраняет аудио в горячий слой и (если persist) атомарно на диск.
+        Без persist файл не создается - он нужен только когда клиенту выдается ссылка.
+        """
+        if not persist:
+            with self._lock:
+                self._stats['stores'] += 1
+                self._remember(key, audio)
+            return
+
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._stats['stores'] += 1
+            self._remember(key, audio)
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(audio)
+            over_limit = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+        if over_limit:
+            self._enforce_disk_limit()
+
+    async def aput(self, key, audio, persist=True):
+        if not persist:
+            return self.put(key, audio, persist=False)
+        return await asyncio.to_thread(self.put, key, audio, True)
+
+    def _enforce_disk_limit(self):
+        """Удаляет давно не использованные файлы, пока кэш больше лимита"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(tuple(TTSConfig.AUDIO_EXTENSIONS.values())):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        if total > self.max_disk_bytes:
+            entries.sort()
+            total = self._evict(entries, total)
+        with self._lock:
+            self._disk_bytes = total
+
+    def resync(self):
+        """
+        Пересчитывает размер кэша на диске. Вызывается после того, как файлы
+        удалил кто-то другой (AudioRetention), иначе инкрементальный учет завышен.
+        """
+        self._enforce_disk_limit()
+
+    def _evict(self, entries, total):
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self._stats['evictions'] += 1
+            except OSError:
+                pass
+        return total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+            stats['disk_bytes'] = self._disk_bytes
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 3) if lookups else None
+        return stats
@@ -9,6 +9,15 @@ OUTPUT_DIR = os.path.join(settings.MEDIA_ROOT, 'tts')
 # Создаем папку, если нет
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Фразы, которые views произносят постоянно (озвучиваются заранее при старте).
+# Переопределяются через TTS_PRERENDER_PHRASES="фраза 1|фраза 2"
+DEFAULT_PRERENDER_PHRASES = [
+    "Путь свободен",
+    "Не удалось распознать запрос.",
+    "Извините, произошла ошибка связи. Попробуйте еще раз.",
+    "Извините, я не смог определить адрес назначения. Попробуйте сказать, например: 'Как дойти до улицы Турусбекова, дом 109'",
+]
+
 class TTSConfig:
     # Имя модели
     MODEL_NAME = "nineninesix/kani-tts-450m-0.1-pt"
@@ -22,3 +31,32 @@ class TTSConfig:
     
     # URL префикс (для формирования ссылки)
     MEDIA_URL = settings.MEDIA_URL + 'tts/'
+
+    # Голос EdgeTTS по умолчанию
+    DEFAULT_VOICE = "ru-RU-DmitryNeural"
+
+    # Частота дискретизации KaniTTS
+    SAMPLE_RATE = 24000
+
+    # Расширение файла по бэкенду: KaniTTS дает WAV, EdgeTTS - MP3
+    AUDIO_EXTENSIONS = {"kani": ".wav", "edge": ".mp3"}
+
+    # Кэш синтезированной речи: media/tts/cache
+    CACHE_PATH = os.path.join(OUTPUT_DIR, 'cache')
+    CACHE_URL = MEDIA_URL + 'cache/'
+    CACHE_DISK_BYTES = int(float(os.getenv('TTS_CACHE_DISK_MB', '200')) * 1024 * 1024)
+    CACHE_MEMORY_BYTES = int(float(os.getenv('TTS_CACHE_MEMORY_MB', '16')) * 1024 * 1024)
+
+    # Предварительная озвучка частых фраз при старте сервера
+    PRERENDER = os.getenv('TTS_PRERENDER', 'True') == 'True'
+    PRERENDER_PHRASES = (
+        [p.strip() for p in os.getenv('TTS_PRERENDER_PHRASES', '').split('|') if p.strip()]
+        or DEFAULT_PRERENDER_PHRASES
+    )
+
+    # Ограничение хранения аудио в media/tts и media/tts/cache (см. retention.py)
+    RETENTION_MAX_BYTES = int(float(os.getenv('TTS_RETENTION_MAX_MB', '500')) * 1024 * 1024)
+    RETENTION_MAX_AGE = float(os.getenv('TTS_RETENTION_MAX_AGE', '86400'))
+    RETENTION_MAX_FILES = int(os.getenv('TTS_RETENTION_MAX_FILES', '5000'))
+    RETENTION_GRACE = float(os.getenv('TTS_RETENTION_GRACE', '120'))
+    RETENTION_INTERVAL = float(os.getenv('TTS_RETENTION_INTERVAL', '300'))
@@ -1,8 +1,11 @@
 import os
-import uuid
+import asyncio
 import logging
 from django.conf import settings
 from .config import TTSConfig
+from .cache import TTSCache
+from .retention import AudioRetention
+from ..executors import run_inference
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +16,12 @@ class TTSManager:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(TTSManager, cls).__new__(cls)
+            cls._instance.cache = TTSCache(
+                TTSConfig.CACHE_PATH,
+                TTSConfig.CACHE_URL,
+                max_disk_bytes=TTSConfig.CACHE_DISK_BYTES,
+                max_memory_bytes=TTSConfig.CACHE_MEMORY_BYTES,
+            )
             cls._instance._load_model()
         return cls._instance
 
@@ -36,33 +45,179 @@ class TTSManager:
         #     logger.error(f"❌ Failed to load KaniTTS: {e}")
         #     self._model = None
 
-    async def generate_speech(self, text: str) -> str:
+    @property
+    def backend(self) -> str:
+        return "kani" if self._model else "edge"
+
+    @property
+    def content_type(self) -> str:
+        """MIME аудио, которое отдает текущий бэкенд"""
+        return "audio/wav" if self._model else "audio/mpeg"
+
+    async def synthesize(self, text: str, voice: str = None, speed: float = 1.0):
+        """
+        Генерирует речь и возвращает байты аудио без записи на диск.
+        Повторный запрос того же (текст, голос, скорость, бэкенд) отдается из кэша без синтеза.
+        """
+        _, audio = await self._synthesize(text, voice or TTSConfig.DEFAULT_VOICE, speed)
+        return audio
+
+    async def stream(self, text: str, voice: str = None, speed: float = 1.0):
         """
-        Генерирует речь и возвращает RELATIVE URL к файлу (например, /media/tts/xyz.wav).
-        Асинхронный метод для Django views.
+        Асинхронный генератор чанков аудио по мере синтеза (EdgeTTS отдает
+        первые кадры задолго до конца фразы). Готовый результат кладется в кэш.
         """
-        filename = f"tts_{uuid.uuid4().hex[:8]}.wav"
-        full_path = os.path.join(TTSConfig.OUTPUT_PATH, filename)
+        voice = voice or TTSConfig.DEFAULT_VOICE
+        key = TTSCache.key(text, voice, speed, self.backend)
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            yield cached
+            return
+
+        if self._model:
+            # KaniTTS генерирует фразу целиком - отдаем одним чанком
+            _, audio = await self._synthesize(text, voice, speed)
+            if audio:
+                yield audio
+            return
+
+        try:
+            import edge_tts
+            communicate = edge_tts.Communicate(text, voice, rate=self._edge_rate(speed))
+            chunks = []
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    chunks.append(chunk["data"])
+                    yield chunk["data"]
+            if chunks:
+                self.cache.put(key, b"".join(chunks), persist=False)
+        except Exception as e:
+            logger.error(f"EdgeTTS stream failed: {e}")
+
+    async def generate_speech(self, text: str, voice: str = None, speed: float = 1.0) -> str:
+        """
+        Генерирует речь и возвращает RELATIVE URL к файлу (например, /media/tts/cache/xyz.mp3).
+        Асинхронный метод для Django views. На диск пишется только здесь, когда нужна ссылка.
+        """
+        key, audio = await self._synthesize(text, voice or TTSConfig.DEFAULT_VOICE, speed)
+        if audio is None:
+            return None
+        if not await asyncio.to_thread(os.path.exists, self.cache.path(key)):
+            await self.cache.aput(key, audio, persist=True)
+        return self.cache.url(key)
+
+    async def _synthesize(self, text, voice, speed):
+        key = TTSCache.key(text, voice, speed, self.backend)
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            return key, cached
         
         # 1. Попытка использовать KaniTTS
         if self._model:
             try:
-                # KaniTTS sync generation (нужно запускать в threadpool, если блокирует)
-                # Но пока сделаем синхронно, т.к. generate достаточно быстр на GPU
-                audio = self._model.generate(text)
-                self._model.save_audio(audio, full_path)
-                
-                # Возвращаем URL
-                return f"{TTSConfig.MEDIA_URL}{filename}"
+                # KaniTTS sync generation - выполняем в пуле 'tts', чтобы не блокировать event loop
+                audio = await run_inference('tts', self._model.generate, text)
+                wav = await run_inference('tts', self._to_wav_bytes, audio)
+                self.cache.put(key, wav, persist=False)
+                return key, wav
             except Exception as e:
                 logger.error(f"KaniTTS generation failed: {e}. Falling back to EdgeTTS.")
+                key = TTSCache.key(text, voice, speed, "edge")
+                cached = await self.cache.aget(key)
+                if cached is not None:
+                    return key, cached
 
-        # 2. Fallback на EdgeTTS (если Kani нет или ошибка)
+        # 2. Fallback на EdgeTTS (если Kani нет или ошибка): собираем чанки потока в памяти
         try:
             import edge_tts
-            communicate = edge_tts.Communicate(text, "ru-RU-DmitryNeural") # Default to Russian
-            await communicate.save(full_path)
-            return f"{TTSConfig.MEDIA_URL}{filename}"
+            communicate = edge_tts.Communicate(text, voice, rate=self._edge_rate(speed))
+            chunks = []
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    chunks.append(chunk["data"])
+            if not chunks:
+                return key, None
+            audio = b"".join(chunks)
+            self.cache.put(key, audio, persist=False)
+            return key, audio
         except Exception as e:
             logger.error(f"EdgeTTS failed: {e}")
-            return None
+            return key, None
+
+    @staticmethod
+    def _edge_rate(speed: float) -> str:
+        """1.0 -> '+0%', 1.2 -> '+20%'"""
+        return f"{int(round((speed - 1.0) * 100)):+d}%"
+
+    @staticmethod
+    def _to_wav_bytes(audio) -> bytes:
+        """Массив KaniTTS (float, -1..1) -> WAV 16-bit mono в памяти"""
+        import io
+        import wave
+        import numpy as np
+
+        if hasattr(audio, "detach"):
+            audio = audio.detach().cpu().numpy()
+        samples = np.clip(np.asarray(audio, dtype=np.float32).reshape(-1), -1.0, 1.0)
+        pcm = (samples * 32767).astype(np.int16)
+
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(TTSConfig.SAMPLE_RATE)
+            wav.writeframes(pcm.tobytes())
+        return buffer.getvalue()
+
+    async def prerender(self, phrases=None):
+        """Озвучивает частые фразы заранее, чтобы первый же запрос попал в кэш"""
+        phrases = phrases or TTSConfig.PRERENDER_PHRASES
+        rendered = 0
+        for phrase in phrases:
+            if await self.generate_speech(phrase):
+                rendered += 1
+        logger.info(f"TTS prerender: {rendered}/{len(phrases)} phrases cached")
+        return rendered
+
+
+def start_prerender_job():
+    """Фоновая предварительная озвучка частых фраз (не блокирует старт сервера)"""
+    import threading
+
+    def run():
+        try:
+            asyncio.run(TTSManager().prerender())
+        except Exception as e:
+            logger.error(f"TTS prerender failed: {e}")
+
+    threading.Thread(target=run, name="tts-prerender", daemon=True).start()
+
+
+_retention = None
+
+def _resync_cache(result):
+    if TTSManager._instance is not None:
+        TTSManager._instance.cache.resync()
+
+
+def get_retention():
+    """
+    Очистка media/tts и media/tts/cache (туда пишет generate_speech и prerender).
+    После удаления файлов TTSCache пересчитывает размер диска. Удаленная фраза,
+    оставшаяся в памяти, снова запишется на диск при следующем generate_speech.
+    """
+    global _retention
+    if _retention is None:
+        _retention = AudioRetention(
+            [TTSConfig.OUTPUT_PATH, TTSConfig.CACHE_PATH],
+            max_bytes=TTSConfig.RETENTION_MAX_BYTES,
+            max_age=TTSConfig.RETENTION_MAX_AGE,
+            max_files=TTSConfig.RETENTION_MAX_FILES,
+            grace=TTSConfig.RETENTION_GRACE,
+            on_sweep=_resync_cache,
+        )
+    return _retention
+
+
+def start_retention_job():
+    get_retention().start(interval=TTSConfig.RETENTION_INTERVAL)
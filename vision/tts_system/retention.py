@@ -0,0 +1,139 @@
+"""
+Ограниченное хранение сгенерированного аудио.
+
+Фоновый поток периодически чистит папки с аудио по трем лимитам:
+максимальный общий размер, максимальный возраст и максимальное число файлов.
+Удаляются самые старые файлы. Файлы моложе grace-периода не трогаются:
+клиент мог только что получить ссылку и еще скачивает файл.
+
+Настройки (media/tts и media/tts/cache):
+    TTS_RETENTION_MAX_MB=500
+    TTS_RETENTION_MAX_AGE=86400     # секунд
+    TTS_RETENTION_MAX_FILES=5000
+    TTS_RETENTION_GRACE=120         # секунд
+    TTS_RETENTION_INTERVAL=300      # период очистки, секунд
+"""
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+AUDIO_SUFFIXES = ('.wav', '.mp3', '.ogg', '.part', '.tmp')
+
+
+class AudioRetention:
+    """
+    Использование:
+        retention = AudioRetention([OUTPUT_DIR], max_bytes=..., max_age=..., max_files=...)
+        retention.start(interval=300)
+        retention.sweep()   # {'deleted': 3, 'reclaimed_bytes': 123456, ...}
+
+    on_sweep(result) вызывается после прохода, в котором что-то удалено:
+    владелец папки (например, TTSCache) пересчитывает свой учет размера.
+    """
+
+    def __init__(self, directories, max_bytes=None, max_age=None, max_files=None, grace=120.0,
+                 on_sweep=None):
+        self.directories = list(directories)
+        self.on_sweep = on_sweep
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_files = max_files
+        self.grace = grace
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {'sweeps': 0, 'deleted': 0, 'reclaimed_bytes': 0, 'failed': 0, 'last_sweep': None}
+
+    def _scan(self):
+        files = []
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(AUDIO_SUFFIXES):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # уже удален кем-то другим
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()  # от самого старого к самому новому
+        return files
+
+    def sweep(self):
+        """Один проход очистки. Возвращает статистику этого прохода."""
+        now = time.time()
+        files = self._scan()
+        total_bytes = sum(size for _, size, _ in files)
+        total_files = len(files)
+        deleted = reclaimed = failed = 0
+
+        for mtime, size, path in files:
+            age = now - mtime
+            too_old = self.max_age is not None and age > self.max_age
+            too_big = self.max_bytes is not None and total_bytes > self.max_bytes
+            too_many = self.max_files is not None and total_files > self.max_files
+            if not (too_old or too_big or too_many):
+                # Файлы отсортированы по возрасту: дальше только новее
+                break
+            if age < self.grace:
+                break
+
+            try:
+                # Файл могли перезаписать (кэш) после сканирования - перепроверяем
+                if os.stat(path).st_mtime != mtime:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Windows: файл открыт на чтение (скачивается) - попробуем в следующий раз
+                logger.debug(f"Retention: cannot remove {path}: {e}")
+                failed += 1
+                continue
+            else:
+                deleted += 1
+                reclaimed += size
+            total_bytes -= size
+            total_files -= 1
+
+        with self._lock:
+            self._stats['sweeps'] += 1
+            self._stats['deleted'] += deleted
+            self._stats['reclaimed_bytes'] += reclaimed
+            self._stats['failed'] += failed
+            self._stats['last_sweep'] = now
+        result = {'deleted': deleted, 'reclaimed_bytes': reclaimed, 'failed': failed,
+                  'remaining_files': total_files, 'remaining_bytes': total_bytes}
+        if deleted:
+            logger.info(f"Audio retention: removed {deleted} files, reclaimed {reclaimed / 1024 / 1024:.1f} MB")
+            if self.on_sweep is not None:
+                self.on_sweep(result)
+        return result
+
+    def start(self, interval=300.0):
+        """Запускает фоновую очистку (daemon-поток, запросы не блокируются)"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Audio retention sweep failed: {e}")
+
+        self._thread = threading.Thread(target=run, name="audio-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,181 @@
+"""
+Unit of work: одна запись в БД на запрос вместо нескольких save().
+
+За один запрос SmartAnalyzeView раньше сохранял пользователя и VisionUser
+до шести раз (CAG, две реплики истории, лимиты, счетчик). Теперь модели
+только отмечают измененные поля, а в конце запроса все пишется одной
+транзакцией: UPDATE ... SET <только измененные поля> + bulk INSERT реплик.
+
+Без активного unit of work (shell, админка, фоновые задачи) save_fields()
+и add_message() пишут сразу, как раньше.
+
+Использование:
+    async with UnitOfWork():
+        ...                      # user.increment_request_count(), vision_user.add_message(...)
+    # здесь все уже записано
+
+    with QueryCounter('smart_analyze') as queries:
+        ...
+    queries.count                # число SQL-запросов внутри блока (в т.ч. из sync_to_async)
+"""
+import logging
+import threading
+import contextvars
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_current_unit = contextvars.ContextVar('unit_of_work', default=None)
+_current_counter = contextvars.ContextVar('query_counter', default=None)
+
+
+class UnitOfWork:
+    def __init__(self):
+        self._dirty = {}    # id(obj) -> (obj, set(fields))
+        self._inserts = []  # новые объекты для bulk_create (в порядке добавления)
+        self._callbacks = []  # атомарные UPDATE (счетчики), выполняются в той же транзакции
+        self._lock = threading.Lock()
+        self._token = None
+
+    @staticmethod
+    def current():
+        return _current_unit.get()
+
+    def mark(self, obj, *fields):
+        with self._lock:
+            entry = self._dirty.setdefault(id(obj), (obj, set()))
+            entry[1].update(fields)
+
+    def add(self, obj):
+        with self._lock:
+            self._inserts.append(obj)
+
+    def on_flush(self, func):
+        with self._lock:
+            self._callbacks.append(func)
+
+    def flush(self):
+        """Записывает все накопленное одной транзакцией (синхронно)"""
+        with self._lock:
+            dirty = list(self._dirty.values())
+            inserts = self._inserts
+            callbacks = self._callbacks
+            self._dirty = {}
+            self._inserts = []
+            self._callbacks = []
+        if not dirty and not inserts and not callbacks:
+            return
+
+        by_model = defaultdict(list)
+        for obj in inserts:
+            by_model[type(obj)].append(obj)
+
+        with transaction.atomic():
+            for obj, fields in dirty:
+                if obj.pk is None:
+                    obj.save()
+                else:
+                    obj.save(update_fields=sorted(fields))
+            for model, objs in by_model.items():
+                model.objects.bulk_create(objs)
+            for func in callbacks:
+                func()
+
+    async def aflush(self):
+        await sync_to_async(self.flush)()
+
+    def _activate(self):
+        self._token = _current_unit.set(self)
+
+    def _deactivate(self):
+        _current_unit.reset(self._token)
+        self._token = None
+
+    def __enter__(self):
+        self._activate()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._deactivate()
+        if exc_type is None:
+            self.flush()
+
+    async def __aenter__(self):
+        self._activate()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._deactivate()
+        if exc_type is None:
+            await self.aflush()
+
+
+def run_or_defer(func):
+    """Выполнить запись сразу или в конце текущего UnitOfWork"""
+    unit = _current_unit.get()
+    if unit is not None:
+        unit.on_flush(func)
+    else:
+        func()
+
+
+def save_fields(obj, *fields):
+    """Сохранить поля модели: отложенно внутри UnitOfWork, иначе сразу"""
+    unit = _current_unit.get()
+    if unit is not None:
+        unit.mark(obj, *fields)
+    else:
+        obj.save(update_fields=list(fields))
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _current_counter.get()
+    if counter is not None:
+        counter._increment()
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender=None, connection=None, **kwargs):
+    """Обработчик сигнала connection_created: подключает счетчик к каждому соединению"""
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class QueryCounter:
+    """Считает SQL-запросы внутри блока (контекст переносится и в sync_to_async потоки)"""
+    _lock = threading.Lock()
+    _stats = {}  # label -> {'blocks': n, 'queries': n, 'max': n}
+
+    def __init__(self, label=None):
+        self.label = label
+        self.count = 0
+        self._count_lock = threading.Lock()
+        self._token = None
+
+    def _increment(self):
+        with self._count_lock:
+            self.count += 1
+
+    def __enter__(self):
+        self._token = _current_counter.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_counter.reset(self._token)
+        if self.label:
+            with QueryCounter._lock:
+                stats = QueryCounter._stats.setdefault(self.label, {'blocks': 0, 'queries': 0, 'max': 0})
+                stats['blocks'] += 1
+                stats['queries'] += self.count
+                stats['max'] = max(stats['max'], self.count)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                label: dict(s, avg=round(s['queries'] / s['blocks'], 2) if s['blocks'] else None)
+                for label, s in cls._stats.items()
+            }
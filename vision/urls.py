@@ -1,6 +1,6 @@
 from django.urls import path
 from .views import DetectAPIView, SmartAnalyzeView, NavigationView, index
-from . import auth_views
+from . import auth_views, metrics_views
 
 urlpatterns = [
     path('', index, name='index'),
@@ -17,4 +17,7 @@ urlpatterns = [
     path('api/detect/', DetectAPIView.as_view(), name='detect_api'),
     path('api/smart-analyze/', SmartAnalyzeView.as_view(), name='smart_analyze_api'),
     path('api/navigate/', NavigationView.as_view(), name='navigate_api'),
+
+    # Monitoring
+    path('api/metrics/', metrics_views.metrics, name='metrics'),
 ]
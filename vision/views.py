@@ -1,140 +1,56 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
-from .yolo import model
-import cv2
-import numpy as np
-from PIL import Image
-import io
-
-# Маппинг классов на русский
-CLASS_NAMES_RU = {
-    'person': 'человек',
-    'bicycle': 'велосипед',
-    'car': 'автомобиль',
-    'motorcycle': 'мотоцикл',
-    'airplane': 'самолет',
-    'bus': 'автобус',
-    'train': 'поезд',
-    'truck': 'грузовик',
-    'boat': 'лодка',
-    'traffic light': 'светофор',
-    'fire hydrant': 'пожарный гидрант',
-    'stop sign': 'знак стоп',
-    'parking meter': 'парвокочный автомат',
-    'bench': 'скамейка',
-    'bird': 'птица',
-    'cat': 'кошка',
-    'dog': 'собака',
-    'horse': 'лошадь',
-    'sheep': 'овца',
-    'cow': 'корова',
-    'elephant': 'слон',
-    'bear': 'медведь',
-    'zebra': 'зебра',
-    'giraffe': 'жираф',
-    'backpack': 'рюкзак',
-    'umbrella': 'зонтик',
-    'handbag': 'сумка',
-    'tie': 'галстук',
-    'suitcase': 'чемодан',
-    'frisbee': 'фрисби',
-    'skis': 'лыжи',
-    'snowboard': 'сноуборд',
-    'sports ball': 'мяч',
-    'kite': 'воздушный змей',
-    'baseball bat': 'бейсбольная бита',
-    'baseball glove': 'бейсбольная перчатка',
-    'skateboard': 'скейтборд',
-    'surfboard': 'серфборд',
-    'tennis racket': 'теннисная ракетка',
-    'bottle': 'бутылка',
-    'wine glass': 'бокал вина',
-    'cup': 'чашка',
-    'fork': 'вилка',
-    'knife': 'нож',
-    'spoon': 'ложка',
-    'bowl': 'миска',
-    'banana': 'банан',
-    'apple': 'яблоко',
-    'sandwich': 'сэндвич',
-    'orange': 'апельсин',
-    'broccoli': 'брокколи',
-    'carrot': 'морковь',
-    'hot dog': 'хот-дог',
-    'pizza': 'пицца',
-    'donut': 'пончик',
-    'cake': 'торт',
-    'chair': 'стул',
-    'couch': 'диван',
-    'potted plant': 'растение в горшке',
-    'bed': 'кровать',
-    'dining table': 'обеденный стол',
-    'toilet': 'туалет',
-    'tv': 'телевизор',
-    'laptop': 'ноутбук',
-    'mouse': 'мышь',
-    'remote': 'пульт',
-    'keyboard': 'клавиатура',
-    'cell phone': 'телефон',
-    'microwave': 'микроволновка',
-    'oven': 'печь',
-    'toaster': 'тостер',
-    'sink': 'раковина',
-    'refrigerator': 'холодильник',
-    'book': 'книга',
-    'clock': 'часы',
-    'vase': 'ваза',
-    'scissors': 'ножницы',
-    'teddy bear': 'плюшевый мишка',
-    'hair drier': 'фен',
-    'toothbrush': 'зубная щетка'
-}
+from .scene_cache import SceneCache
+from .frames import Frame
+from .executors import run_inference
+from .llm_client import get_llm_client
+from .navigator import ru_names, navigator_message
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _detect_on_image(image_bytes, user_id=None):
+    """
+    Декодирование, preprocessing и детекция YOLO (выполняется в пуле 'yolo').
+    Возвращает None, если изображение не удалось декодировать.
+    """
+    # Декодируем один раз, resize до 1280 и CLAHE считаются кадром лениво
+    frame = Frame.from_bytes(image_bytes, max_dim=1280)
+    if frame is None:
+        return None
+
+    # Детекция через общий батчер (conf=0.3, iou=0.45 для лучшего обнаружения),
+    # почти одинаковые кадры берутся из кэша сцен
+    try:
+        class_names = SceneCache.detections().get_or_compute(
+            frame, lambda: detect_frame_classes(frame), user_id
+        )
+    except Exception as e:
+        logger.error(f"YOLO Error: {e}")
+        return None
+
+    return ru_names(class_names)
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class DetectAPIView(View):
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         if 'image' not in request.FILES:
             return JsonResponse({'message': 'Нет изображения'}, status=400)
 
         # Читаем изображение
         image_file = request.FILES['image']
         image_bytes = image_file.read()
-        
-        # Конвертируем в OpenCV формат
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
-        if img is None:
-            return JsonResponse({'message': 'Ошибка обработки изображения'}, status=400)
+        # Детекция в выделенном пуле, не занимая общий sync-поток
+        user_id = request.POST.get('user_id')
+        detected_objects = await run_inference('yolo', _detect_on_image, image_bytes, user_id)
 
-        # Preprocessing для улучшения распознавания
-        # 1. Resize если изображение слишком большое (оптимизация)
-        max_dimension = 1280
-        h, w = img.shape[:2]
-        if max(h, w) > max_dimension:
-            scale = max_dimension / max(h, w)
-            img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
-        
-        # 2. Улучшение контраста (CLAHE)
-        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-        l, a, b = cv2.split(lab)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        l = clahe.apply(l)
-        img = cv2.cvtColor(cv2.merge([l, a, b]), cv2.COLOR_LAB2BGR)
-
-        # Детекция (понижаем confidence для лучшего обнаружения)
-        results = model.predict(img, conf=0.3, iou=0.45)
-        
-        detected_objects = []
-        for result in results:
-            for box in result.boxes:
-                class_id = int(box.cls[0])
-                class_name = model.names[class_id]
-                ru_name = CLASS_NAMES_RU.get(class_name, class_name)
-                if ru_name not in detected_objects:
-                    detected_objects.append(ru_name)
+        if detected_objects is None:
+            return JsonResponse({'message': 'Ошибка обработки изображения'}, status=400)
 
         if not detected_objects:
             message = "Путь свободен"
@@ -144,23 +60,43 @@ class DetectAPIView(View):
         return JsonResponse({'message': message})
 
 
-from .services import speech_to_text, analyze_image_local, generate_ai_response_async, text_to_speech_async, read_text_local, detect_objects_local
-from .models import VisionUser
+from .services import (
+    speech_to_text, transcribe_audio, analyze_image_local, text_to_speech_async,
+    detect_frame_classes, detect_boxes_local,
+)
+from .tracker import TrackerStore
+from .tts_engine import TTSBrain
+from rest_framework.exceptions import AuthenticationFailed
+from .identity_cache import IdentityCache, aresolve_user
+from .unit_of_work import UnitOfWork, QueryCounter
+from .stt_profiles import resolve_stt_profile, stt_language
+from .audio_input import read_audio_input, request_params
+from .pipeline import chat_reply, stream_chat_reply, maybe_read_text
 import base64
 import json
-from asgiref.sync import sync_to_async
 
 @method_decorator(csrf_exempt, name='dispatch')
 class SmartAnalyzeView(View):
     async def post(self, request, *args, **kwargs):
+        # Все изменения пользователя, CAG и истории пишутся одной транзакцией в конце
+        with QueryCounter('smart_analyze') as queries:
+            async with UnitOfWork():
+                response = await self._handle(request)
+        logger.debug(f"SmartAnalyze: {queries.count} DB queries")
+        return response
+
+    async def _handle(self, request):
         import asyncio
         
         # 1. Проверка аутентификации (опционально для совместимости)
-        user = None
-        if request.user.is_authenticated:
-            user = request.user
-            # Проверка лимитов
-            if not await sync_to_async(user.can_make_request)():
+        # Token-заголовок или сессия; активные пользователи берутся из кэша без запросов к БД
+        try:
+            user = await aresolve_user(request)
+        except AuthenticationFailed as e:
+            return JsonResponse({'error': str(e.detail)}, status=401)
+        if user:
+            # Проверка лимитов (кэш процесса; после QUOTA_CACHE_TTL - один запрос к БД)
+            if not await user.acan_make_request():
                 return JsonResponse({
                     'error': 'Daily limit reached',
                     'subscription_type': user.subscription_type,
@@ -168,77 +104,84 @@ class SmartAnalyzeView(View):
                 }, status=429)
         
         # 2. Получаем данные
+        # Аудио: файл-контейнер или объявленный сырой PCM/Opus (уже numpy, без декодера)
+        params = request_params(request)
+        try:
+            audio_input = read_audio_input(request, params)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
         image_file = request.FILES.get('image')
-        audio_file = request.FILES.get('audio')
-        text_input = request.POST.get('text', '')
-        user_id = request.POST.get('user_id', 'anonymous')
-        mode = request.POST.get('mode', 'chat') # 'chat' or 'navigator'
+        text_input = params.get('text', '')
+        user_id = params.get('user_id', 'anonymous')
+        mode = params.get('mode', 'chat') # 'chat' or 'navigator'
 
         # 3. Получаем пользователя (для обратной совместимости с Telegram)
-        user_tuple = await sync_to_async(VisionUser.objects.get_or_create)(telegram_id=user_id)
-        vision_user = user_tuple[0]
+        vision_user = await IdentityCache.avision_user(user_id)
 
         # Подготовка тасков
         stt_task = None
         vision_task = None
-        image_bytes = None
+        frame = None
 
         # Запускаем STT
-        if audio_file:
-            # Важно: если audio_file это InMemoryUploadedFile, передача его в другой поток может быть tricky,
-            # но faster_whisper обычно принимает путь или file-like.
-            # Для надежности читаем в BytesIO если это не путь
-            stt_task = sync_to_async(speech_to_text)(audio_file)
-
-        # Подготовка изображения (Resize)
-        if image_file:
-            image_bytes = image_file.read()
-            # Оптимизация размера ПЕРЕД отправкой в модели (снижаем нагрузку на BLIP/OCR)
-            # Сделаем resize тут, в памяти
-            def optimize_image(img_data):
-                nparr = np.frombuffer(img_data, np.uint8)
-                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                if img is None: return img_data
-                
-                # Max dimension 640 for speed
-                max_dim = 640
-                h, w = img.shape[:2]
-                if max(h, w) > max_dim:
-                    scale = max_dim / max(h, w)
-                    img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
-                    # Encode back to bytes
-                    _, encoded_img = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
-                    return encoded_img.tobytes()
-                return img_data
-
-            # Запускаем оптимизацию и Vision параллельно
-            # Но Vision требует байты. Лучше сначала оптимизировать (быстро), потом Vision.
-            # optimize_image - CPU bound, sync.
-            image_bytes = await sync_to_async(optimize_image)(image_bytes)
-
+        if audio_input is not None:
+            # faster_whisper принимает и file-like (контейнер), и float32 numpy (сырой PCM)
+            # Запускаем сразу как задачу, чтобы STT шел параллельно с подготовкой изображения
+            # Профиль: поле stt_profile (fast/balanced/accurate) или по тарифу; язык из профиля пользователя
+            stt_profile = resolve_stt_profile(params.get('stt_profile'), user)
+            stt_task = asyncio.ensure_future(run_inference(
+                'whisper', transcribe_audio, audio_input, stt_profile, stt_language(user)
+            ))
+
+        # Если подготовка кадра или детекция упадут, STT не должна остаться висеть
+        # (незабранное исключение задачи, занятый пул whisper)
+        try:
+            # Подготовка изображения: декодируем ОДИН раз, дальше YOLO/BLIP/OCR
+            # работают с общим кадром (без пережатия в JPEG и повторного декодирования)
+            # Навигатор: трекер решает, нужна ли детекция на этом кадре
+            # (между детекциями рамки предсказываются, кадр даже не декодируется)
+            tracker = None
             if mode == 'navigator':
-                 # Fast YOLO only
-                 # Мы можем запустить это сразу
-                 vision_task = sync_to_async(detect_objects_local)(image_bytes)
-            else:
-                 # BLIP
-                 vision_task = sync_to_async(analyze_image_local)(image_bytes)
-
-        # Выполняем параллельно STT и Vision
-        tasks = []
-        if stt_task: tasks.append(stt_task) # index 0 if exists
-        if vision_task: tasks.append(vision_task) # index 0 or 1
-
-        results = await asyncio.gather(*tasks)
+                tracker_key = _tracker_key(user, params)
+                tracker = TrackerStore.default().get(tracker_key) if tracker_key else None
+            if image_file and (tracker is None or tracker.should_detect()):
+                image_bytes = image_file.read()
+                # Max dimension 640 for speed (снижаем нагрузку на BLIP/OCR)
+                frame = await run_inference('preprocess', Frame.from_bytes, image_bytes, 640)
+
+            if frame is not None:
+                if mode == 'navigator':
+                     # Fast YOLO only (рамки для трекера)
+                     vision_task = run_inference('yolo', detect_boxes_local, frame)
+                else:
+                     # BLIP
+                     vision_task = run_inference('blip', analyze_image_local, frame, user_id)
+
+            # Выполняем параллельно STT и Vision
+            tasks = []
+            if stt_task: tasks.append(stt_task) # index 0 if exists
+            if vision_task: tasks.append(vision_task) # index 0 or 1
+
+            results = await asyncio.gather(*tasks)
+        finally:
+            if stt_task is not None:
+                if not stt_task.done():
+                    stt_task.cancel()
+                # Забираем результат/исключение, чтобы задача не осталась "never retrieved"
+                await asyncio.gather(stt_task, return_exceptions=True)
 
         # Разбираем результаты
         transcript = None
         visual_result = None
         
         current_res_idx = 0
+        stt_info = None
         if stt_task:
-            transcript = results[current_res_idx]
-            print(f"🎤 DEBUG TRANCRIPT: '{transcript}' (Type: {type(transcript)})")
+            stt_result = results[current_res_idx]
+            if stt_result:
+                transcript = stt_result.text
+                stt_info = stt_result.as_dict()
+            logger.debug(f"Transcript: '{transcript}' ({stt_info})")
             current_res_idx += 1
         if vision_task:
             visual_result = results[current_res_idx]
@@ -247,23 +190,33 @@ class SmartAnalyzeView(View):
         if transcript:
             text_input = f"{text_input} {transcript}".strip()
 
-        # Если режим навигатора - возвращаем быстрый ответ
+        # Если режим навигатора - возвращаем быстрый ответ: только изменения сцены
         if mode == 'navigator':
-            objects = visual_result if visual_result else []
-            if objects:
-                 response_text = ", ".join(objects)
+            if tracker is None:
+                # Без идентификатора клиента трекать не с чем: весь список объектов кадра
+                objects = ru_names(box[0] for box in visual_result or [])
+                return JsonResponse({'message': ", ".join(objects), 'audio': None, 'stt': stt_info})
+            if vision_task:
+                events = tracker.update(visual_result or [])
+            elif image_file:
+                events = tracker.predict()
             else:
-                 response_text = ""
-            return JsonResponse({'message': response_text, 'audio': None})
+                events = []
+            return JsonResponse({
+                'message': navigator_message(events),
+                'audio': None,
+                'events': events,
+                'objects': tracker.objects(),
+                'detected': bool(vision_task),
+                'stt': stt_info,
+            })
 
         # Режим чата
         visual_description = visual_result
-        ocr_text = None
 
         # Теперь, имея полный текст, решаем про OCR
         # OCR все еще может быть долгой, но она нужна только по запросу
-        if image_bytes and any(w in text_input.lower() for w in ['читай', 'прочти', 'текст', 'написано', 'цифры']):
-             ocr_text = await sync_to_async(read_text_local)(image_bytes)
+        ocr_text = await maybe_read_text(frame, text_input)
 
         if not text_input:
              # Если текста нет, но есть картинка -> "Что изображено?"
@@ -272,28 +225,13 @@ class SmartAnalyzeView(View):
              else:
                  return JsonResponse({'message': 'Не удалось распознать запрос.', 'audio': None})
 
-        # Сохраняем запрос
-        if vision_user:
-            await sync_to_async(vision_user.add_message)("user", text_input)
+        if _wants_stream(request):
+            # Потоковый режим: LLM генерирует, а готовые предложения уже озвучиваются
+            events = stream_chat_reply(text_input, vision_user, user, visual_description, ocr_text)
+            return _sse_response(_sse_reply(events, {'debug_vision': visual_description, 'stt': stt_info}))
 
-        # 5. LLM - передаем vision_user только если он существует
-        response_text = await generate_ai_response_async(
-            text_input, 
-            visual_context=visual_description, 
-            user_obj=vision_user if vision_user else None,
-            ocr_context=ocr_text
-        )
-
-        # Сохраняем ответ
-        if vision_user:
-            await sync_to_async(vision_user.add_message)("assistant", response_text)
-        
-        # Увеличиваем счетчик для аутентифицированных пользователей
-        if user:
-            await sync_to_async(user.increment_request_count)()
-
-        # 6. TTS
-        audio_content = await text_to_speech_async(response_text)
+        # 5. LLM + история + счетчик (внутри UnitOfWork - одна запись в конце), 6. TTS
+        response_text, audio_content = await chat_reply(text_input, vision_user, user, visual_description, ocr_text)
         audio_b64 = None
         if audio_content:
             audio_b64 = base64.b64encode(audio_content).decode('utf-8')
@@ -301,9 +239,57 @@ class SmartAnalyzeView(View):
         return JsonResponse({
             'message': response_text,
             'audio': audio_b64,
-            'debug_vision': visual_description
+            'debug_vision': visual_description,
+            'stt': stt_info,
         })
 
+def _tracker_key(user, params):
+    """
+    Ключ трекера навигатора: аутентифицированный пользователь или явный user_id.
+    Анонимные клиенты без user_id не трекаются, иначе они портят треки друг друга.
+    """
+    if user is not None:
+        return f"user:{user.pk}"
+    user_id = params.get('user_id')
+    if user_id and user_id != 'anonymous':
+        return f"id:{user_id}"
+    return None
+
+
+async def _sse_reply(events, done_extra):
+    """
+    SSE-поток ответа: для каждого предложения событие 'text' и события
+    'audio' с чанками его аудио (по порядку seq/part), в конце 'done' с полным текстом.
+    """
+    content_type = TTSBrain.content_type()
+    async for event, data in events:
+        if event == 'audio':
+            data = {
+                'seq': data['seq'],
+                'part': data['part'],
+                'content_type': content_type,
+                'chunk': base64.b64encode(data['audio']).decode('utf-8'),
+            }
+        elif event == 'done':
+            data = dict(data, **done_extra)
+        yield _sse_event(event, data)
+
+def _wants_stream(request):
+    """Потоковый ответ включается явно: stream=1 или Accept: text/event-stream"""
+    if request_params(request).get('stream') in ('1', 'true', 'sse'):
+        return True
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(events):
+    """Server-Sent Events поверх асинхронного генератора"""
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx не должен буферизовать поток
+    return response
+
 def index(request):
     from django.shortcuts import render
     return render(request, 'index.html')
@@ -317,19 +303,23 @@ class NavigationView(View):
     и возвращает инструкции для навигации.
     """
     async def post(self, request, *args, **kwargs):
-        audio_file = request.FILES.get('audio')
-        text_input = request.POST.get('text', '')
-        user_id = request.POST.get('user_id', 'anonymous')
-        current_lat = request.POST.get('current_lat')
-        current_lon = request.POST.get('current_lon')
+        params = request_params(request)
+        try:
+            audio_input = read_audio_input(request, params)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        text_input = params.get('text', '')
+        user_id = params.get('user_id', 'anonymous')
+        current_lat = params.get('current_lat')
+        current_lon = params.get('current_lon')
         
         # Получаем пользователя
-        user_tuple = await sync_to_async(VisionUser.objects.get_or_create)(telegram_id=user_id)
-        user = user_tuple[0]
+        user = await IdentityCache.avision_user(user_id)
         
         # Обработка аудио
-        if audio_file:
-            transcript = await sync_to_async(speech_to_text)(audio_file)
+        if audio_input is not None:
+            profile = resolve_stt_profile(params.get('stt_profile'))
+            transcript = await run_inference('whisper', speech_to_text, audio_input, profile, stt_language())
             if transcript:
                 text_input = f"{text_input} {transcript}".strip()
         
@@ -366,20 +356,11 @@ class NavigationView(View):
         """
         Использует AI для извлечения адреса из естественного языка.
         """
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        client, model_name = get_llm_client()
+        if not client:
             # Fallback: простой парсинг
             return self._simple_address_extraction(text)
         
-        base_url = "https://api.deepseek.com"
-        model_name = "deepseek-chat"
-        if api_key.startswith("sk-or-v1"):
-            base_url = "https://openrouter.ai/api/v1"
-            model_name = "deepseek/deepseek-chat"
-        
-        from openai import AsyncOpenAI
-        client = AsyncOpenAI(api_key=api_key, base_url=base_url)
-        
         try:
             response = await client.chat.completions.create(
                 model=model_name,
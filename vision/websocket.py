@@ -0,0 +1,100 @@
+"""
+Минимальная обертка над ASGI WebSocket (без Channels).
+
+Маршруты WebSocket подключаются в core/asgi.py; обычные HTTP-запросы
+по-прежнему обслуживает Django.
+"""
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from .identity_cache import IdentityCache
+
+logger = logging.getLogger(__name__)
+
+
+class WebSocketDisconnect(Exception):
+    pass
+
+
+class WebSocket:
+    """
+    Использование:
+        ws = WebSocket(scope, receive, send)
+        await ws.accept()
+        kind, payload = await ws.receive()   # ('bytes', b'...') | ('text', {...})
+        await ws.send_json({'type': 'partial', 'text': '...'})
+    """
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self._receive = receive
+        self._send = send
+        self.query = {k: v[-1] for k, v in parse_qs(scope.get('query_string', b'').decode()).items()}
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.closed = False
+        self._send_lock = asyncio.Lock()  # сообщения шлют несколько задач сессии
+
+    async def accept(self):
+        message = await self._receive()
+        if message['type'] != 'websocket.connect':
+            raise WebSocketDisconnect()
+        await self._send({'type': 'websocket.accept'})
+
+    async def receive(self):
+        """('bytes', bytes) или ('text', dict). Невалидный JSON -> ('text', {})"""
+        message = await self._receive()
+        if message['type'] == 'websocket.disconnect':
+            self.closed = True
+            raise WebSocketDisconnect()
+        if message.get('bytes') is not None:
+            return 'bytes', message['bytes']
+        try:
+            data = json.loads(message.get('text') or '{}')
+        except ValueError:
+            data = {}
+        return 'text', data if isinstance(data, dict) else {}
+
+    async def send_json(self, data, payload=None):
+        """JSON-сообщение; payload - бинарное сообщение сразу следом (без вклинивания других)"""
+        async with self._send_lock:
+            if self.closed:
+                return
+            await self._send({'type': 'websocket.send', 'text': json.dumps(data, ensure_ascii=False)})
+            if payload is not None:
+                await self._send({'type': 'websocket.send', 'bytes': payload})
+
+    async def close(self, code=1000):
+        async with self._send_lock:
+            if not self.closed:
+                self.closed = True
+                await self._send({'type': 'websocket.close', 'code': code})
+
+    def token(self):
+        """Токен из ?token=... или заголовка 'Authorization: Token <key>'"""
+        if self.query.get('token'):
+            return self.query['token']
+        auth = self.headers.get('authorization', '').split()
+        if len(auth) == 2 and auth[0].lower() == 'token':
+            return auth[1]
+        return None
+
+    async def authenticate(self):
+        """User по токену (через кэш идентичности) или None для анонимного подключения"""
+        key = self.token()
+        if not key:
+            return None
+        user = await IdentityCache.auser_for_token(key)
+        return user if user is not None and user.is_active else None
+
+
+async def release_db_connections():
+    """
+    Сигналы request_started/finished для WebSocket не приходят - закрываем
+    устаревшие соединения сами (после каждой реплики и при отключении).
+    """
+    await sync_to_async(close_old_connections)()
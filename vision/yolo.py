@@ -1,15 +1,16 @@
-from ultralytics import YOLO
-import os
+from .model_registry import ModelRegistry
 
 class YOLOModel:
-    _instance = None
+    """
+    Обертка для обратной совместимости: модель берется из общего реестра
+    и загружается лениво при первом запросе, а не при импорте модуля.
+    """
 
     @classmethod
     def get_instance(cls):
-        if cls._instance is None:
-            # Загружаем модель один раз
-            cls._instance = YOLO('yolov8n.pt')
-        return cls._instance
+        return ModelRegistry.get('yolo')
 
-# Загружаем модель заранее
-model = YOLOModel.get_instance()
+    @classmethod
+    def lease(cls):
+        """with YOLOModel.lease() as model: ... - модель не вытесняется, пока используется"""
+        return ModelRegistry.lease('yolo')
@@ -28,3 +28,9 @@ class TTSConfig:
     
     # Частота дискретизации (обычно определяется моделью, но можно использовать для плеера)
     SAMPLE_RATE = 24000
+
+    # Ограничение хранения .wav в OUTPUT_PATH (самые старые удаляются первыми)
+    OUTPUT_MAX_FILES = int(os.getenv("TTS_OUTPUT_MAX_FILES", "200"))
+    OUTPUT_MAX_AGE = float(os.getenv("TTS_OUTPUT_MAX_AGE", "3600"))  # секунд
+    OUTPUT_MAX_BYTES = int(float(os.getenv("TTS_OUTPUT_MAX_MB", "200")) * 1024 * 1024)
+    OUTPUT_GRACE = float(os.getenv("TTS_OUTPUT_GRACE", "30"))  # свежий файл может еще воспроизводиться
@@ -1,6 +1,7 @@
 import os
 import uuid
 import logging
+import threading
 import torch
 import numpy as np
 from typing import Optional, Union
@@ -12,6 +13,10 @@ except ImportError:
     # Fallback если запускаем не из корня
     from .config import TTSConfig
 
+# Очистка аудио - общая с основным проектом (модуль без зависимостей от Django).
+# Корень проекта должен быть в PYTHONPATH (см. README.md)
+from vision.tts_system.retention import AudioRetention
+
 # Настройка логгера
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("TTSManager")
@@ -83,12 +88,32 @@ class TTSManager:
             self.model.save_audio(audio, full_path)
             
             logger.info(f"💾 Audio saved to: {full_path}")
+            self._schedule_cleanup()
             return full_path
 
         except Exception as e:
             logger.error(f"❌ Error during TTS generation: {e}")
             return None
 
+    def _schedule_cleanup(self):
+        """Запускает очистку OUTPUT_PATH в фоне (не чаще одной одновременно)"""
+        if getattr(self, "_cleanup_thread", None) and self._cleanup_thread.is_alive():
+            return
+        self._cleanup_thread = threading.Thread(target=self._cleanup_output_dir, daemon=True)
+        self._cleanup_thread.start()
+
+    def _cleanup_output_dir(self) -> int:
+        """Удаляет самые старые файлы сверх лимитов. Возвращает освобожденные байты."""
+        if getattr(self, "_retention", None) is None:
+            self._retention = AudioRetention(
+                [TTSConfig.OUTPUT_PATH],
+                max_bytes=TTSConfig.OUTPUT_MAX_BYTES,
+                max_age=TTSConfig.OUTPUT_MAX_AGE,
+                max_files=TTSConfig.OUTPUT_MAX_FILES,
+                grace=TTSConfig.OUTPUT_GRACE,
+            )
+        return self._retention.sweep()['reclaimed_bytes']
+
     def tts_to_buffer(self, text: str):
         """
         Возвращает raw audio data (опционально, если нужно для stream play).